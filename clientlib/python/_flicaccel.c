@@ -0,0 +1,352 @@
+/*
+ * Optional accelerator for flicprotocol.
+ *
+ * Implements the hot parts of the receive path in C: splitting the received byte stream into packets,
+ * unpacking the fields of an event packet and formatting bd addrs. flicprotocol uses this module when it
+ * can be imported and falls back to its pure python implementation otherwise. The results must be identical,
+ * which is checked by accel_check.py.
+ *
+ * Build with "make" in this directory.
+ *
+ * The module keeps no state besides the event table, which configure() sets once and which is read-only afterwards,
+ * so it declares that it does not need the GIL on free-threaded builds of python.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdatomic.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define MAX_EVENTS 64
+#define MAX_FIELDS 16
+
+typedef struct {
+	char code;
+	int size;
+	PyObject *name;
+} field_t;
+
+typedef struct {
+	int nb_fields;
+	int size;
+	field_t fields[MAX_FIELDS];
+} event_format_t;
+
+typedef struct {
+	int nb_event_formats;
+	event_format_t event_formats[MAX_EVENTS];
+} event_table_t;
+
+/* Published once, fully built, by configure(); never changed or freed afterwards, so readers need no lock */
+static _Atomic(event_table_t *) event_table = NULL;
+/* Serializes configure() */
+static PyThread_type_lock configure_lock = NULL;
+
+static void free_table(event_table_t *table) {
+	for (int i = 0; i < table->nb_event_formats; i++) {
+		for (int j = 0; j < table->event_formats[i].nb_fields; j++) {
+			Py_CLEAR(table->event_formats[i].fields[j].name);
+		}
+	}
+	free(table);
+}
+
+static int same_tables(const event_table_t *a, const event_table_t *b) {
+	if (a->nb_event_formats != b->nb_event_formats) {
+		return 0;
+	}
+	for (int i = 0; i < a->nb_event_formats; i++) {
+		const event_format_t *x = &a->event_formats[i];
+		const event_format_t *y = &b->event_formats[i];
+		if (x->nb_fields != y->nb_fields || x->size != y->size) {
+			return 0;
+		}
+		for (int j = 0; j < x->nb_fields; j++) {
+			if (x->fields[j].code != y->fields[j].code || x->fields[j].size != y->fields[j].size) {
+				return 0;
+			}
+			int equal = PyObject_RichCompareBool(x->fields[j].name, y->fields[j].name, Py_EQ);
+			if (equal <= 0) {
+				return equal;
+			}
+		}
+	}
+	return 1;
+}
+
+static int parse_format(event_format_t *format, const char *fmt, PyObject *names) {
+	format->nb_fields = 0;
+	format->size = 0;
+	if (*fmt == '<') {
+		fmt++;
+	}
+	while (*fmt != '\0') {
+		int count = 0;
+		while (*fmt >= '0' && *fmt <= '9') {
+			count = count * 10 + (*fmt++ - '0');
+		}
+		char code = *fmt++;
+		int size;
+		switch (code) {
+		case 'B': case 'b': case '?': size = 1; break;
+		case 'H': case 'h': size = 2; break;
+		case 'I': size = 4; break;
+		case 'q': size = 8; break;
+		case 's': case 'p': size = count; break;
+		default:
+			PyErr_Format(PyExc_ValueError, "unsupported format code '%c'", code);
+			return -1;
+		}
+		if (code != 's' && code != 'p' && count > 1) {
+			PyErr_SetString(PyExc_ValueError, "repeat counts are only supported for s and p");
+			return -1;
+		}
+		if (format->nb_fields == MAX_FIELDS || format->nb_fields >= PyList_GET_SIZE(names)) {
+			PyErr_SetString(PyExc_ValueError, "number of fields does not match the format");
+			return -1;
+		}
+		field_t *field = &format->fields[format->nb_fields++];
+		field->code = code;
+		field->size = size;
+		field->name = PyList_GET_ITEM(names, format->nb_fields - 1);
+		Py_INCREF(field->name);
+		format->size += size;
+	}
+	if (format->nb_fields != PyList_GET_SIZE(names)) {
+		PyErr_SetString(PyExc_ValueError, "number of fields does not match the format");
+		return -1;
+	}
+	return 0;
+}
+
+static PyObject *configure(PyObject *self, PyObject *events) {
+	PyObject *seq = PySequence_Fast(events, "events must be a sequence");
+	if (seq == NULL) {
+		return NULL;
+	}
+	Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+	if (n > MAX_EVENTS) {
+		Py_DECREF(seq);
+		PyErr_SetString(PyExc_ValueError, "too many events");
+		return NULL;
+	}
+	event_table_t *table = calloc(1, sizeof(event_table_t));
+	if (table == NULL) {
+		Py_DECREF(seq);
+		return PyErr_NoMemory();
+	}
+	for (Py_ssize_t i = 0; i < n; i++) {
+		PyObject *event = PySequence_Fast_GET_ITEM(seq, i);
+		table->nb_event_formats = (int)i + 1;
+		table->event_formats[i].nb_fields = -1;
+		if (event == Py_None) {
+			continue;
+		}
+		const char *name, *fmt, *field_names;
+		if (!PyArg_ParseTuple(event, "sss", &name, &fmt, &field_names)) {
+			goto error;
+		}
+		PyObject *names = PyUnicode_Split(PyTuple_GET_ITEM(event, 2), NULL, -1);
+		if (names == NULL) {
+			goto error;
+		}
+		int res = parse_format(&table->event_formats[i], fmt, names);
+		Py_DECREF(names);
+		if (res < 0) {
+			/* Only the fields parsed so far hold references */
+			table->nb_event_formats = (int)i + 1;
+			goto error;
+		}
+	}
+	Py_DECREF(seq);
+
+	/* The table can only be set once: it is read without a lock, so it must never change after being published.
+	 * Setting the same table again does nothing. */
+	Py_BEGIN_ALLOW_THREADS
+	PyThread_acquire_lock(configure_lock, WAIT_LOCK);
+	Py_END_ALLOW_THREADS
+	event_table_t *current = atomic_load(&event_table);
+	if (current == NULL) {
+		atomic_store(&event_table, table);
+		PyThread_release_lock(configure_lock);
+		Py_RETURN_NONE;
+	}
+	PyThread_release_lock(configure_lock);
+	int same = same_tables(current, table);
+	free_table(table);
+	if (same < 0) {
+		return NULL;
+	}
+	if (!same) {
+		PyErr_SetString(PyExc_RuntimeError, "_flicaccel is already configured with a different event table");
+		return NULL;
+	}
+	Py_RETURN_NONE;
+
+error:
+	Py_DECREF(seq);
+	free_table(table);
+	return NULL;
+}
+
+static PyObject *unpack_field(const field_t *field, const unsigned char *p) {
+	switch (field->code) {
+	case 'B': return PyLong_FromLong(p[0]);
+	case 'b': return PyLong_FromLong((signed char)p[0]);
+	case '?': return PyBool_FromLong(p[0] != 0);
+	case 'H': return PyLong_FromLong(p[0] | (p[1] << 8));
+	case 'h': return PyLong_FromLong((int16_t)(p[0] | (p[1] << 8)));
+	case 'I': return PyLong_FromUnsignedLong((uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24));
+	case 'q': {
+		uint64_t v = 0;
+		for (int i = 7; i >= 0; i--) {
+			v = (v << 8) | p[i];
+		}
+		return PyLong_FromLongLong((int64_t)v);
+	}
+	case 's': return PyBytes_FromStringAndSize((const char *)p, field->size);
+	case 'p': {
+		int n = p[0];
+		if (n >= field->size) {
+			n = field->size - 1;
+		}
+		return PyBytes_FromStringAndSize((const char *)p + 1, n);
+	}
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject *unpack_event(PyObject *self, PyObject *arg) {
+	Py_buffer view;
+	if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	const unsigned char *data = view.buf;
+	PyObject *result = NULL;
+	const event_table_t *table = atomic_load(&event_table);
+	if (table == NULL || view.len == 0 || data[0] >= table->nb_event_formats || table->event_formats[data[0]].nb_fields < 0) {
+		goto none;
+	}
+	const event_format_t *format = &table->event_formats[data[0]];
+	if (view.len - 1 < format->size) {
+		goto none;
+	}
+
+	PyObject *items = PyDict_New();
+	if (items == NULL) {
+		goto done;
+	}
+	const unsigned char *p = data + 1;
+	for (int i = 0; i < format->nb_fields; i++) {
+		PyObject *value = unpack_field(&format->fields[i], p);
+		if (value == NULL || PyDict_SetItem(items, format->fields[i].name, value) < 0) {
+			Py_XDECREF(value);
+			Py_DECREF(items);
+			goto done;
+		}
+		Py_DECREF(value);
+		p += format->fields[i].size;
+	}
+	result = Py_BuildValue("(iN)", data[0], items);
+	goto done;
+
+none:
+	result = Py_None;
+	Py_INCREF(result);
+done:
+	PyBuffer_Release(&view);
+	return result;
+}
+
+static PyObject *format_bdaddr(const unsigned char *p) {
+	static const char hex[] = "0123456789abcdef";
+	char s[17];
+	for (int i = 0; i < 6; i++) {
+		unsigned char b = p[5 - i];
+		s[i * 3] = hex[b >> 4];
+		s[i * 3 + 1] = hex[b & 0xf];
+		if (i < 5) {
+			s[i * 3 + 2] = ':';
+		}
+	}
+	return PyUnicode_FromStringAndSize(s, 17);
+}
+
+static PyObject *bdaddr_bytes_to_string(PyObject *self, PyObject *arg) {
+	Py_buffer view;
+	if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	PyObject *result;
+	if (view.len != 6) {
+		PyErr_SetString(PyExc_TypeError, "bd addr must be 6 bytes");
+		result = NULL;
+	} else {
+		result = format_bdaddr(view.buf);
+	}
+	PyBuffer_Release(&view);
+	return result;
+}
+
+static PyObject *split_packets(PyObject *self, PyObject *arg) {
+	Py_buffer view;
+	if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	const unsigned char *buffer = view.buf;
+	Py_ssize_t pos = 0;
+	Py_ssize_t end = view.len;
+	PyObject *packets = PyList_New(0);
+	if (packets == NULL) {
+		PyBuffer_Release(&view);
+		return NULL;
+	}
+	while (end - pos >= 2) {
+		Py_ssize_t packet_len = buffer[pos] | (buffer[pos + 1] << 8);
+		if (end - pos - 2 < packet_len) {
+			break;
+		}
+		PyObject *packet = PyBytes_FromStringAndSize((const char *)buffer + pos + 2, packet_len);
+		if (packet == NULL || PyList_Append(packets, packet) < 0) {
+			Py_XDECREF(packet);
+			Py_DECREF(packets);
+			PyBuffer_Release(&view);
+			return NULL;
+		}
+		Py_DECREF(packet);
+		pos += 2 + packet_len;
+	}
+	PyBuffer_Release(&view);
+	return Py_BuildValue("(Nn)", packets, pos);
+}
+
+static PyMethodDef methods[] = {
+	{"configure", configure, METH_O, "configure(events)\n\nSet the event table, a sequence of (name, struct format, space separated field names) tuples indexed by opcode.\nIt can only be set once; setting the same table again does nothing, a different one raises RuntimeError."},
+	{"unpack_event", unpack_event, METH_O, "unpack_event(data)\n\nReturns (opcode, items) with the raw fields of an event packet, or None if the opcode is unknown or the packet is too short."},
+	{"split_packets", split_packets, METH_O, "split_packets(buffer)\n\nReturns (packets, consumed) for the complete length prefixed packets at the start of buffer."},
+	{"bdaddr_bytes_to_string", bdaddr_bytes_to_string, METH_O, "bdaddr_bytes_to_string(bdaddr_bytes)\n\nFormats a 6 byte little endian bd addr as \"aa:bb:cc:dd:ee:ff\"."},
+	{NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+	PyModuleDef_HEAD_INIT, "_flicaccel", "Optional C accelerator for flicprotocol.", -1, methods
+};
+
+PyMODINIT_FUNC PyInit__flicaccel(void) {
+	if (configure_lock == NULL) {
+		configure_lock = PyThread_allocate_lock();
+		if (configure_lock == NULL) {
+			return PyErr_NoMemory();
+		}
+	}
+	PyObject *m = PyModule_Create(&module);
+#ifdef Py_GIL_DISABLED
+	if (m != NULL && PyUnstable_Module_SetGIL(m, Py_MOD_GIL_NOT_USED) < 0) {
+		Py_DECREF(m);
+		return NULL;
+	}
+#endif
+	return m;
+}
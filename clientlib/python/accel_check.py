@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Differential check and benchmark of the optional _flicaccel extension.
+#
+# Feeds the same random and edge case input (valid packets of every event, truncated and oversized packets,
+# unknown opcodes, random byte streams split at random points) to the pure python functions of flicprotocol
+# and to their C counterparts, and fails on the first difference in value or type.
+# Then measures the decode path (framing + decode_event) with both implementations.
+#
+# Build the extension first with "make".
+
+import argparse
+import random
+import sys
+import time
+
+import flicprotocol
+
+try:
+	import _flicaccel
+except ImportError:
+	_flicaccel = None
+
+if _flicaccel is not None:
+	# flicprotocol only configures the extension when it uses it, which it doesn't with FLICLIB_NO_ACCEL set
+	_flicaccel.configure(flicprotocol._EVENTS)
+
+def random_packet(rnd, opcode):
+	size = flicprotocol._EVENT_STRUCTS[opcode].size
+	choice = rnd.random()
+	if choice < 0.1:
+		size = rnd.randrange(size) if size > 0 else 0
+	elif choice < 0.2:
+		size += rnd.randrange(1, 80)
+	data = bytes([opcode]) + bytes(rnd.getrandbits(8) for i in range(size))
+	if flicprotocol._EVENTS[opcode][0] == "EvtGetInfoResponse" and len(data) >= 1 + size and rnd.random() < 0.8:
+		# Mostly consistent verified button lists, sometimes too short
+		nb = rnd.randrange(5)
+		data = data[:-2] + bytes([nb, 0]) + bytes(rnd.getrandbits(8) for i in range(6 * nb - rnd.randrange(2)))
+	return data
+
+def same(a, b):
+	return type(a) == type(b) and repr(a) == repr(b)
+
+def decode_with(unpack_event, bdaddr_bytes_to_string, data):
+	saved = flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string
+	flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string = unpack_event, bdaddr_bytes_to_string
+	try:
+		return flicprotocol.decode_event(data)
+	finally:
+		flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string = saved
+
+def check(iterations, seed):
+	rnd = random.Random(seed)
+	nb_opcodes = len(flicprotocol._EVENTS)
+	packets = [b"", bytes([nb_opcodes]), bytes([255])]
+	for i in range(iterations):
+		packets.append(random_packet(rnd, rnd.randrange(nb_opcodes)))
+		if i % 16 == 0:
+			packets.append(bytes(rnd.getrandbits(8) for j in range(rnd.randrange(40))))
+
+	for data in packets:
+		for arg in (data, bytearray(data), memoryview(data)):
+			expected = flicprotocol._py_unpack_event(arg)
+			actual = _flicaccel.unpack_event(arg)
+			if not same(expected, actual):
+				return "unpack_event(%s): %r != %r" % (data.hex(), expected, actual)
+		try:
+			expected = decode_with(flicprotocol._py_unpack_event, flicprotocol._py_bdaddr_bytes_to_string, data)
+		except ValueError as e:
+			# Invalid enum values raise in both implementations
+			expected = type(e)
+		try:
+			actual = decode_with(_flicaccel.unpack_event, _flicaccel.bdaddr_bytes_to_string, data)
+		except ValueError as e:
+			actual = type(e)
+		if not same(expected, actual):
+			return "decode_event(%s): %r != %r" % (data.hex(), expected, actual)
+
+	for i in range(iterations):
+		addr = bytes(rnd.getrandbits(8) for j in range(6))
+		if flicprotocol._py_bdaddr_bytes_to_string(addr) != _flicaccel.bdaddr_bytes_to_string(bytearray(addr)):
+			return "bdaddr_bytes_to_string(%s)" % addr.hex()
+
+	# Framing: a stream of valid and random packets, received in random chunks
+	stream = bytearray()
+	for data in packets:
+		stream += bytes([len(data) & 0xff, len(data) >> 8]) + data
+	for chunking in range(20):
+		expected_engine = (flicprotocol._py_split_packets, bytearray())
+		actual_engine = (_flicaccel.split_packets, bytearray())
+		pos = 0
+		while pos < len(stream):
+			chunk = stream[pos : pos + rnd.randrange(1, 300)]
+			pos += len(chunk)
+			results = []
+			for split_packets, buffer in (expected_engine, actual_engine):
+				buffer += chunk
+				packets_out, consumed = split_packets(buffer)
+				del buffer[:consumed]
+				results.append((packets_out, consumed))
+			if not same(results[0], results[1]):
+				return "split_packets at offset %d: %r != %r" % (pos, results[0], results[1])
+	return None
+
+def benchmark(packets, split_packets, unpack_event, bdaddr_bytes_to_string, repeat):
+	stream = b"".join(bytes([len(data) & 0xff, len(data) >> 8]) + data for data in packets)
+	saved = flicprotocol._split_packets, flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string
+	flicprotocol._split_packets, flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string = split_packets, unpack_event, bdaddr_bytes_to_string
+	try:
+		engine = flicprotocol.ProtocolEngine()
+		start = time.perf_counter()
+		count = 0
+		for i in range(repeat):
+			for offset in range(0, len(stream), 4096):
+				count += len(engine.receive_events(stream[offset : offset + 4096]))
+		return count, time.perf_counter() - start
+	finally:
+		flicprotocol._split_packets, flicprotocol._unpack_event, flicprotocol.bdaddr_bytes_to_string = saved
+
+def main():
+	parser = argparse.ArgumentParser(description="Differential check and benchmark of the _flicaccel extension.")
+	parser.add_argument("--iterations", type=int, default=20000)
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--repeat", type=int, default=20, help="benchmark rounds over 10000 events")
+	args = parser.parse_args()
+
+	if _flicaccel is None:
+		print("_flicaccel is not built, run make first")
+		sys.exit(1)
+
+	error = check(args.iterations, args.seed)
+	if error is not None:
+		print("MISMATCH " + error)
+		sys.exit(1)
+	print("differential check passed (%d packets, seed %d)" % (args.iterations, args.seed))
+
+	# A burst of mostly button events with some status changes and advertisements
+	rnd = random.Random(args.seed)
+	mix = []
+	for i in range(10000):
+		kind = rnd.random()
+		if kind < 0.8:
+			mix.append(bytes([flicprotocol._EVENT_NAME_TO_OPCODE["EvtButtonUpOrDown"]]) + flicprotocol._EVENT_STRUCTS[4].pack(i % 20, i % 2, 0, 0))
+		elif kind < 0.9:
+			mix.append(bytes([flicprotocol._EVENT_NAME_TO_OPCODE["EvtConnectionStatusChanged"]]) + flicprotocol._EVENT_STRUCTS[2].pack(i % 20, 2, 0))
+		else:
+			mix.append(bytes([flicprotocol._EVENT_NAME_TO_OPCODE["EvtAdvertisementPacket"]]) + flicprotocol._EVENT_STRUCTS[0].pack(0, bytes(6), b"F019tcHh", -60, False, True, False, False))
+
+	results = {}
+	for label, functions in (("python", (flicprotocol._py_split_packets, flicprotocol._py_unpack_event, flicprotocol._py_bdaddr_bytes_to_string)),
+	                         ("accel", (_flicaccel.split_packets, _flicaccel.unpack_event, _flicaccel.bdaddr_bytes_to_string))):
+		count, elapsed = benchmark(mix, *functions, repeat=args.repeat)
+		results[label] = count / elapsed
+		print("%-6s %d events in %.3f s: %.0f events/s" % (label, count, elapsed, count / elapsed))
+	print("speedup %.2fx" % (results["accel"] / results["python"]))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Scaling benchmark of FlicClient(callback_threads = n).
+#
+# Feeds button events for a number of connection channels through a socketpair into a FlicClient, whose callbacks each do
+# a fixed amount of pure python work, and measures the events handled per second for several numbers of callback threads.
+# With the GIL, the callback threads take turns and the rate stays flat (or drops slightly);
+# on a free-threaded build of python it should grow with the number of threads, up to the number of cores.
+#
+# Usage:
+# python3 callback_benchmark.py --channels 16 --events 20000 --work 2000 --threads 0 1 2 4 8
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+
+import fliclib
+from flicprotocol import _EVENT_NAME_TO_OPCODE
+
+def _events(nb_channels, conn_ids, nb_events):
+	opcode = _EVENT_NAME_TO_OPCODE["EvtButtonUpOrDown"]
+	frame = struct.Struct("<HBIBBI")
+	return b"".join(frame.pack(11, opcode, conn_ids[i % nb_channels], i & 1, 0, 0) for i in range(nb_events))
+
+def measure(nb_channels, nb_events, work, callback_threads):
+	client_sock, server_sock = socket.socketpair()
+	client = fliclib.FlicClient(None, sock = client_sock, callback_threads = callback_threads)
+	per_channel = nb_events // nb_channels
+	counts = [0] * nb_channels
+	remaining = [nb_channels]
+	remaining_lock = threading.Lock()
+	done = threading.Event()
+
+	channels = []
+	for index in range(nb_channels):
+		channel = fliclib.ButtonConnectionChannel("00:00:00:00:%02x:%02x" % (index >> 8, index & 0xff))
+		def on_button_up_or_down(channel, click_type, was_queued, time_diff, index = index):
+			x = 0
+			for i in range(work):
+				x += i * i
+			counts[index] += 1
+			if counts[index] == per_channel:
+				with remaining_lock:
+					remaining[0] -= 1
+					if remaining[0] == 0:
+						done.set()
+		channel.on_button_up_or_down = on_button_up_or_down
+		client.add_connection_channel(channel)
+		channels.append(channel)
+
+	def drain():
+		while len(server_sock.recv(65536)) > 0:
+			pass
+	threading.Thread(target=drain, daemon=True).start()
+	thread = threading.Thread(target=client.handle_events, daemon=True)
+	thread.start()
+
+	data = _events(nb_channels, [channel._conn_id for channel in channels], per_channel * nb_channels)
+	start = time.perf_counter()
+	server_sock.sendall(data)
+	done.wait()
+	elapsed = time.perf_counter() - start
+	client.close()
+	thread.join()
+	server_sock.close()
+	return per_channel * nb_channels / elapsed
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure how channel callbacks scale with FlicClient callback_threads.")
+	parser.add_argument("--channels", type=int, default=16)
+	parser.add_argument("--events", type=int, default=20000)
+	parser.add_argument("--work", type=int, default=2000, help="loop iterations done by each callback")
+	parser.add_argument("--threads", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+	args = parser.parse_args()
+
+	gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+	print("python %s, GIL %s" % (sys.version.split()[0], "enabled" if gil_enabled else "disabled"))
+	baseline = None
+	for callback_threads in args.threads:
+		rate = measure(args.channels, args.events, args.work, callback_threads)
+		if baseline is None:
+			baseline = rate
+		print("callback_threads %2d: %9.0f events/s (%.2fx)" % (callback_threads, rate, rate / baseline))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for flicd
+
+Speaks the Flic protocol over TCP or a Unix socket without any Bluetooth hardware, so that
+clients, proxies and benchmarks can be exercised on loopback (for example in CI).
+
+Buttons listed as verified are treated as connected and in range: connection channels to them become Ready right away.
+Channels to other buttons stay pending (Disconnected) and count against max_pending_connections.
+Button events are only generated on request, by calling emit_button_event().
+Buttons added with add_public_button() advertise to all scanners and are offered to scan wizards; a connection channel to one
+(or a scan wizard) connects to it after connect_delay seconds and verifies it.
+
+Usage:
+python3 fakeflicd.py --port 5551 --verified aa:bb:cc:dd:ee:ff
+"""
+
+import argparse
+import asyncio
+import struct
+import time
+
+import flicprotocol
+
+_FRAME_HEADER = struct.Struct("<H")
+
+def _bdaddr_bytes(bd_addr):
+    return bytes(flicprotocol.bdaddr_string_to_bytes(bd_addr))
+
+def _event(name, *fields):
+    opcode = flicprotocol._EVENT_NAME_TO_OPCODE[name]
+    return bytes([opcode]) + flicprotocol._EVENT_STRUCTS[opcode].pack(*fields)
+
+def _frame(packet):
+    return _FRAME_HEADER.pack(len(packet)) + packet
+
+class _Client(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b""
+        self.channels = {}
+        self.scanners = set()
+        self.scan_wizards = set()
+        self.battery_status_listeners = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._clients.add(self)
+
+    def connection_lost(self, exc):
+        self.server._clients.discard(self)
+
+    def data_received(self, data):
+        self.buffer += data
+        pos = 0
+        while len(self.buffer) - pos >= 2:
+            packet_len = self.buffer[pos] | (self.buffer[pos + 1] << 8)
+            if len(self.buffer) - pos - 2 < packet_len:
+                break
+            packet = self.buffer[pos + 2 : pos + 2 + packet_len]
+            pos += 2 + packet_len
+            if len(packet) > 0:
+                self.server.commands_received += 1
+                self.server._handle_command(self, packet)
+        self.buffer = self.buffer[pos:]
+
+    def send(self, packet):
+        if not self.transport.is_closing():
+            self.transport.write(_frame(packet))
+
+class FakeFlicd:
+    """FakeFlicd class.
+
+    Start it with start_tcp() or start_unix() on a running event loop. The command_delay (seconds)
+    is added before every response, to simulate a loaded daemon.
+    """
+
+    def __init__(self, verified_buttons=(), max_pending_connections=8, max_concurrently_connected_buttons=20, command_delay=0, connect_delay=0):
+        self.verified_buttons = list(verified_buttons)
+        self.public_buttons = {}
+        self.max_pending_connections = max_pending_connections
+        self.max_concurrently_connected_buttons = max_concurrently_connected_buttons
+        self.command_delay = command_delay
+        self.connect_delay = connect_delay
+        self.commands_received = 0
+        self.events_sent = 0
+        self._clients = set()
+        self._servers = []
+
+    async def start_tcp(self, host="127.0.0.1", port=0):
+        """Listen on TCP. Returns the bound (host, port)."""
+        server = await asyncio.get_event_loop().create_server(lambda: _Client(self), host, port)
+        self._servers.append(server)
+        return server.sockets[0].getsockname()[:2]
+
+    async def start_unix(self, path):
+        """Listen on a Unix socket."""
+        server = await asyncio.get_event_loop().create_unix_server(lambda: _Client(self), path)
+        self._servers.append(server)
+
+    async def serve_socket(self, sock):
+        """Serve a single already connected socket, such as one end of a socket.socketpair()."""
+        await asyncio.get_event_loop().connect_accepted_socket(lambda: _Client(self), sock)
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+        for client in list(self._clients):
+            client.transport.close()
+
+    @property
+    def pending_connections(self):
+        return len(set(bd_addr for client in self._clients for bd_addr in client.channels.values() if bd_addr not in self.verified_buttons))
+
+    def add_public_button(self, bd_addr, name="F023", rssi=-60, failed_connects=0):
+        """Make a button in public mode appear. The first failed_connects connection attempts to it never complete."""
+        self.public_buttons[bd_addr] = [name, failed_connects]
+        for client in list(self._clients):
+            for scan_id in client.scanners:
+                client.send(_event("EvtAdvertisementPacket", scan_id, _bdaddr_bytes(bd_addr), name.encode("utf-8"), rssi, False, False, False, False))
+        for client in list(self._clients):
+            if len(client.scan_wizards) > 0:
+                self._run_scan_wizard(client, next(iter(client.scan_wizards)), bd_addr)
+                break
+
+    def _run_scan_wizard(self, client, scan_wizard_id, bd_addr):
+        client.scan_wizards.discard(scan_wizard_id)
+        self.public_buttons[bd_addr][1] = 0
+        client.send(_event("EvtScanWizardFoundPublicButton", scan_wizard_id, _bdaddr_bytes(bd_addr), self.public_buttons[bd_addr][0].encode("utf-8")))
+        def connected():
+            client.send(_event("EvtScanWizardButtonConnected", scan_wizard_id))
+            self._verify(bd_addr)
+            client.send(_event("EvtScanWizardCompleted", scan_wizard_id, 0))
+        asyncio.get_event_loop().call_later(self.connect_delay, connected)
+
+    def _verify(self, bd_addr):
+        if bd_addr in self.public_buttons:
+            del self.public_buttons[bd_addr]
+            self.verified_buttons.append(bd_addr)
+            for client in list(self._clients):
+                client.send(_event("EvtNewVerifiedButton", _bdaddr_bytes(bd_addr)))
+
+    def _connect_public(self, bd_addr):
+        button = self.public_buttons.get(bd_addr)
+        if button is None:
+            return
+        if button[1] > 0:
+            button[1] -= 1
+            return
+        for client in list(self._clients):
+            for conn_id, channel_bd_addr in client.channels.items():
+                if channel_bd_addr == bd_addr:
+                    client.send(_event("EvtConnectionStatusChanged", conn_id, 1, 0))
+                    client.send(_event("EvtConnectionStatusChanged", conn_id, 2, 0))
+        self._verify(bd_addr)
+
+    def emit_button_event(self, bd_addr, click_type, event_name="EvtButtonUpOrDown", was_queued=False, time_diff=0):
+        """Send a button event to every connection channel of a verified button, on all clients.
+
+        Returns the number of events sent.
+        """
+        if bd_addr not in self.verified_buttons:
+            return 0
+        count = 0
+        for client in self._clients:
+            for conn_id, channel_bd_addr in client.channels.items():
+                if channel_bd_addr == bd_addr:
+                    client.send(_event(event_name, conn_id, getattr(click_type, "value", click_type), was_queued, time_diff))
+                    count += 1
+        self.events_sent += count
+        return count
+
+    def _handle_command(self, client, packet):
+        if self.command_delay > 0:
+            asyncio.get_event_loop().call_later(self.command_delay, self._execute_command, client, packet)
+        else:
+            self._execute_command(client, packet)
+
+    def _execute_command(self, client, packet):
+        opcode = packet[0]
+        if opcode >= len(flicprotocol._COMMANDS):
+            return
+        name = flicprotocol._COMMANDS[opcode][0]
+        command_struct = flicprotocol._COMMAND_STRUCTS[opcode]
+        if len(packet) - 1 < command_struct.size:
+            return
+        fields = command_struct.unpack_from(packet, 1)
+        bd_addr = None
+        for value in fields:
+            if isinstance(value, bytes) and len(value) == 6:
+                bd_addr = flicprotocol.bdaddr_bytes_to_string(value)
+
+        if name == "CmdGetInfo":
+            addrs = b"".join(_bdaddr_bytes(x) for x in self.verified_buttons)
+            client.send(_event("EvtGetInfoResponse", 2, b"\0" * 6, 0, self.max_pending_connections, self.max_concurrently_connected_buttons, self.pending_connections, False, len(self.verified_buttons)) + addrs)
+        elif name == "CmdCreateScanner":
+            client.scanners.add(fields[0])
+        elif name == "CmdRemoveScanner":
+            client.scanners.discard(fields[0])
+        elif name == "CmdCreateConnectionChannel":
+            conn_id = fields[0]
+            if conn_id in client.channels:
+                return
+            if bd_addr not in self.verified_buttons and bd_addr not in set(x for c in self._clients for x in c.channels.values()) and self.pending_connections >= self.max_pending_connections:
+                client.send(_event("EvtCreateConnectionChannelResponse", conn_id, 1, 0))
+                return
+            client.channels[conn_id] = bd_addr
+            client.send(_event("EvtCreateConnectionChannelResponse", conn_id, 0, 0))
+            if bd_addr in self.verified_buttons:
+                client.send(_event("EvtConnectionStatusChanged", conn_id, 1, 0))
+                client.send(_event("EvtConnectionStatusChanged", conn_id, 2, 0))
+            elif bd_addr in self.public_buttons:
+                asyncio.get_event_loop().call_later(self.connect_delay, self._connect_public, bd_addr)
+        elif name == "CmdRemoveConnectionChannel":
+            if client.channels.pop(fields[0], None) is not None:
+                client.send(_event("EvtConnectionChannelRemoved", fields[0], 0))
+        elif name == "CmdForceDisconnect":
+            for other in self._clients:
+                for conn_id in [conn_id for conn_id, x in other.channels.items() if x == bd_addr]:
+                    del other.channels[conn_id]
+                    other.send(_event("EvtConnectionChannelRemoved", conn_id, 1 if other is client else 2))
+        elif name == "CmdPing":
+            client.send(_event("EvtPingResponse", fields[0]))
+        elif name == "CmdGetButtonInfo":
+            if bd_addr in self.verified_buttons:
+                client.send(_event("EvtGetButtonInfoResponse", fields[0], bytes(range(16)), b"white", b"FAKE" + bd_addr[-5:].replace(":", "").encode("ascii"), 2, 1))
+            else:
+                client.send(_event("EvtGetButtonInfoResponse", fields[0], b"\0" * 16, b"", b"", 0, 0))
+        elif name == "CmdCreateScanWizard":
+            client.scan_wizards.add(fields[0])
+            busy = set(self.public_buttons) & set(x for c in self._clients for x in c.channels.values())
+            for public_bd_addr in self.public_buttons:
+                if public_bd_addr not in busy:
+                    self._run_scan_wizard(client, fields[0], public_bd_addr)
+                    break
+        elif name == "CmdCancelScanWizard":
+            if fields[0] in client.scan_wizards:
+                client.scan_wizards.discard(fields[0])
+                client.send(_event("EvtScanWizardCompleted", fields[0], 1))
+        elif name == "CmdDeleteButton":
+            if bd_addr in self.verified_buttons:
+                self.verified_buttons.remove(bd_addr)
+                for other in self._clients:
+                    other.send(_event("EvtButtonDeleted", fields[0], other is client))
+        elif name == "CmdCreateBatteryStatusListener":
+            client.battery_status_listeners[fields[0]] = bd_addr
+            client.send(_event("EvtBatteryStatus", fields[0], 100 if bd_addr in self.verified_buttons else -1, int(time.time())))
+        elif name == "CmdRemoveBatteryStatusListener":
+            client.battery_status_listeners.pop(fields[0], None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for flicd, without Bluetooth.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5551)
+    parser.add_argument("--unix", help="also listen on this Unix socket path")
+    parser.add_argument("--verified", nargs="*", default=[], help="bd addrs of verified buttons")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    flicd = FakeFlicd(args.verified)
+    print("Listening on %s:%d" % loop.run_until_complete(flicd.start_tcp(args.host, args.port)))
+    if args.unix:
+        loop.run_until_complete(flicd.start_unix(args.unix))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flicd.close()
+        loop.close()
+
+if __name__ == "__main__":
+    main()
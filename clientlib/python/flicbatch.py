@@ -0,0 +1,170 @@
+"""Batch decoding of Flic protocol streams into columns
+
+For offline analysis of large captured flicd streams, where one python callback per event is too slow.
+decode_batch() takes a buffer with many length prefixed event packets, as received from the server, and returns one column per field:
+
+opcode: the event opcode
+conn_id: the connection channel id, for events that have one (0 otherwise)
+click_type: the ClickType value of button events (0 otherwise)
+was_queued: the was_queued flag of button events, 1 if the byte sent is not zero (0 otherwise), as a bool column with NumPy
+time_diff: the time_diff of button events (0 otherwise)
+bd_addr: the bd addr as a 48 bit integer (0 for events without one), e.g. 0xaabbccddeeff for "aa:bb:cc:dd:ee:ff"
+
+The columns are NumPy arrays if NumPy is installed, decoded with structured dtypes derived from the event structs.
+Otherwise they are array.array objects of the same types.
+
+Usage:
+columns, consumed = decode_batch(data)
+ups = columns["click_type"] == ClickType.ButtonUp.value
+"""
+
+import array
+import re
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from flicprotocol import _EVENTS, _EVENT_STRUCTS, _BUTTON_EVENTS
+
+COLUMNS = ("opcode", "conn_id", "click_type", "was_queued", "time_diff", "bd_addr")
+
+_NUMPY_COLUMN_TYPES = {"opcode": "u1", "conn_id": "<u4", "click_type": "u1", "was_queued": "?", "time_diff": "<u4", "bd_addr": "<u8"}
+_ARRAY_COLUMN_TYPES = {"opcode": "B", "conn_id": "L", "click_type": "B", "was_queued": "B", "time_diff": "L", "bd_addr": "Q"}
+
+_NUMPY_FIELD_TYPES = {"B": "u1", "b": "i1", "?": "?", "H": "<u2", "h": "<i2", "I": "<u4", "q": "<i8"}
+
+def _columns_of_event(opcode):
+	"""Returns a dictionary column name -> index of the field in the event struct, for the columns that the event has."""
+	event = _EVENTS[opcode]
+	if event == None:
+		return {}
+	field_names = event[2].split()
+	columns = {}
+	for column in ("conn_id", "bd_addr"):
+		if column in field_names:
+			columns[column] = field_names.index(column)
+	if event[0] in _BUTTON_EVENTS:
+		for column in ("click_type", "was_queued", "time_diff"):
+			columns[column] = field_names.index(column)
+	return columns
+
+_EVENT_COLUMNS = [_columns_of_event(opcode) for opcode in range(len(_EVENTS))]
+
+def _event_dtype(opcode):
+	"""The NumPy structured dtype with the same layout as the struct of an event."""
+	names = _EVENTS[opcode][2].split()
+	formats = []
+	for count, code in re.findall(r"(\d*)([a-zA-Z?])", _EVENTS[opcode][1]):
+		if code in ("s", "p"):
+			formats.append(("u1", (int(count),)))
+		else:
+			formats.append(_NUMPY_FIELD_TYPES[code])
+	return numpy.dtype({"names": names, "formats": formats})
+
+def _frame_offsets(buffer):
+	"""Returns (offsets, lengths, consumed) of the complete packets in buffer. Offsets point past the length prefix."""
+	offsets = array.array("L")
+	lengths = array.array("L")
+	pos = 0
+	end = len(buffer)
+	while end - pos >= 2:
+		packet_len = buffer[pos] | (buffer[pos + 1] << 8)
+		if end - pos - 2 < packet_len:
+			break
+		offsets.append(pos + 2)
+		lengths.append(packet_len)
+		pos += 2 + packet_len
+	return offsets, lengths, pos
+
+def _decode_numpy(buffer, offsets, lengths, opcodes):
+	data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+	offsets = numpy.frombuffer(offsets, dtype=numpy.dtype("L")).astype(numpy.int64)
+	lengths = numpy.frombuffer(lengths, dtype=numpy.dtype("L")).astype(numpy.int64)
+
+	nonempty = lengths > 0
+	offsets = offsets[nonempty]
+	lengths = lengths[nonempty]
+	opcode = data[offsets]
+
+	sizes = numpy.array([-1 if x == None else _EVENT_STRUCTS[i].size for i, x in enumerate(_EVENTS)] + [-1] * (256 - len(_EVENTS)), dtype=numpy.int64)
+	valid = sizes[opcode] >= 0
+	valid &= lengths - 1 >= sizes[opcode]
+	if opcodes is not None:
+		valid &= numpy.isin(opcode, numpy.array(sorted(opcodes), dtype=numpy.uint8))
+	offsets = offsets[valid]
+	opcode = opcode[valid]
+
+	columns = dict((name, numpy.zeros(len(offsets), dtype=_NUMPY_COLUMN_TYPES[name])) for name in COLUMNS)
+	columns["opcode"][:] = opcode
+	for event_opcode in numpy.unique(opcode):
+		rows = numpy.nonzero(opcode == event_opcode)[0]
+		dtype = _event_dtype(event_opcode)
+		# Gather the struct bytes of all packets of this event into one contiguous block and reinterpret it
+		block = data[offsets[rows, None] + 1 + numpy.arange(dtype.itemsize)]
+		records = block.view(dtype).reshape(len(rows))
+		for column in _EVENT_COLUMNS[event_opcode]:
+			if column == "bd_addr":
+				addr = records["bd_addr"].astype(numpy.uint64)
+				columns["bd_addr"][rows] = sum(addr[:, i] << numpy.uint64(8 * i) for i in range(6))
+			else:
+				columns[column][rows] = records[column]
+	return columns
+
+def _decode_array(buffer, offsets, lengths, opcodes):
+	columns = dict((name, array.array(_ARRAY_COLUMN_TYPES[name])) for name in COLUMNS)
+	column_lists = [(name, columns[name]) for name in COLUMNS[1:]]
+	event_layouts = []
+	for opcode, event in enumerate(_EVENTS):
+		if event == None or (opcodes is not None and opcode not in opcodes):
+			event_layouts.append(None)
+		else:
+			event_layouts.append((_EVENT_STRUCTS[opcode], [(columns_list, _EVENT_COLUMNS[opcode].get(name), name == "was_queued") for name, columns_list in column_lists]))
+
+	opcode_column = columns["opcode"]
+	nb_events = len(_EVENTS)
+	for offset, length in zip(offsets, lengths):
+		if length == 0:
+			continue
+		opcode = buffer[offset]
+		if opcode >= nb_events:
+			continue
+		layout = event_layouts[opcode]
+		if layout is None:
+			continue
+		event_struct, fields = layout
+		if length - 1 < event_struct.size:
+			continue
+		values = event_struct.unpack_from(buffer, offset + 1)
+		opcode_column.append(opcode)
+		for column, index, is_flag in fields:
+			if index is None:
+				column.append(0)
+			elif is_flag:
+				# Same as the NumPy bool column: any non zero byte is true
+				column.append(1 if values[index] else 0)
+			else:
+				value = values[index]
+				column.append(int.from_bytes(value, "little") if type(value) is bytes else value)
+	return columns
+
+def decode_batch(buffer, opcodes = None, use_numpy = None):
+	"""Decode all complete event packets in buffer.
+
+	Returns (columns, consumed): a dictionary with one column per name in COLUMNS and one row per event,
+	and the number of bytes of buffer that were used. An incomplete packet at the end is left for the next call.
+	Packets with an unknown opcode or too short for their event are skipped, as are events not in opcodes (an iterable of opcodes), if given.
+	use_numpy selects the implementation; by default NumPy is used if it is installed.
+	"""
+	if use_numpy is None:
+		use_numpy = numpy is not None
+	if opcodes is not None:
+		opcodes = frozenset(opcodes)
+
+	offsets, lengths, consumed = _frame_offsets(buffer)
+	if use_numpy:
+		columns = _decode_numpy(buffer, offsets, lengths, opcodes)
+	else:
+		columns = _decode_array(buffer, offsets, lengths, opcodes)
+	return columns, consumed
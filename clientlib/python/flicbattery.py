@@ -0,0 +1,289 @@
+"""Battery telemetry store for Flic buttons
+
+Keeps a compact, downsampled time series of battery readings per button in a memory-mapped file,
+so that history survives restarts without being reloaded and memory stays bounded for large fleets.
+
+Usage:
+store = BatteryStore("battery.dat")
+listener = fliclib.BatteryStatusListener(bd_addr)
+listener.on_battery_status = store.on_battery_status
+client.add_battery_status_listener(listener)
+...
+print(store.days_until_empty(bd_addr))
+
+Readings are grouped into fixed-size buckets of bucket_seconds each. Every button owns a ring of
+buckets_per_button buckets, so the oldest buckets are overwritten once the ring is full.
+The file layout is columnar (one array per field, indexed by slot * buckets_per_button + bucket)
+and is little endian; BatteryStore refuses to open it on a big endian machine.
+Bd addrs are stored as bytes, so they are reported in lower case; any case is accepted by the methods taking a bd addr.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+_MAGIC = b"FLBT"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHIII")
+_HEADER_SIZE = 32
+
+def _align8(n):
+	return (n + 7) & ~7
+
+class BatteryStore:
+	"""BatteryStore class.
+
+	A fixed-capacity battery history for up to max_buttons buttons, persisted in the file at path.
+	If the file already exists, its own dimensions are used and the constructor arguments are ignored.
+	When all slots are taken, the button that was least recently recorded is evicted to make room for a new one.
+	"""
+
+	def __init__(self, path, max_buttons = 1024, buckets_per_button = 240, bucket_seconds = 6 * 3600):
+		if sys.byteorder != "little":
+			raise OSError("BatteryStore requires a little endian machine")
+
+		exists = os.path.exists(path) and os.path.getsize(path) > 0
+		self._file = open(path, "r+b" if exists else "w+b")
+
+		if exists:
+			magic, version, _, max_buttons, buckets_per_button, bucket_seconds = _HEADER.unpack(self._file.read(_HEADER.size))
+			if magic != _MAGIC or version != _VERSION:
+				self._file.close()
+				raise ValueError("Not a battery store file: " + path)
+
+		if max_buttons <= 0 or buckets_per_button <= 0 or bucket_seconds <= 0:
+			self._file.close()
+			raise ValueError("Store dimensions must be positive")
+
+		self._max_buttons = max_buttons
+		self._buckets = buckets_per_button
+		self._bucket_seconds = bucket_seconds
+
+		n = max_buttons * buckets_per_button
+		layout = [
+			("_addrs", "B", max_buttons * 6),
+			("_heads", "I", max_buttons),
+			("_counts", "I", max_buttons),
+			("_times", "q", n),
+			("_sums", "I", n),
+			("_nbs", "H", n),
+			("_mins", "b", n),
+			("_maxs", "b", n)
+		]
+
+		offsets = []
+		size = _HEADER_SIZE
+		for name, fmt, length in layout:
+			offsets.append(size)
+			size = _align8(size + length * struct.calcsize(fmt))
+
+		if not exists:
+			self._file.write(_HEADER.pack(_MAGIC, _VERSION, 0, max_buttons, buckets_per_button, bucket_seconds))
+			self._file.truncate(size)
+			self._file.flush()
+		elif os.path.getsize(path) != size:
+			self._file.close()
+			raise ValueError("Battery store file has an unexpected size: " + path)
+
+		self._mm = mmap.mmap(self._file.fileno(), size)
+		view = memoryview(self._mm)
+		self._views = [view]
+		for (name, fmt, length), offset in zip(layout, offsets):
+			column = view[offset : offset + length * struct.calcsize(fmt)].cast(fmt)
+			self._views.append(column)
+			setattr(self, name, column)
+
+		# bd_addr -> slot, least recently recorded first
+		self._slots = OrderedDict()
+		# Unused slots, lowest last so that they are taken in order
+		self._free = []
+		used = []
+		for slot in range(max_buttons - 1, -1, -1):
+			if self._counts[slot] > 0:
+				used.append(slot)
+			else:
+				self._free.append(slot)
+		used.sort(key=self._newest_time)
+		for slot in used:
+			self._slots[self._slot_bd_addr(slot)] = slot
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return len(self._slots)
+
+	def __contains__(self, bd_addr):
+		return bd_addr.lower() in self._slots
+
+	def __iter__(self):
+		return iter(list(self._slots))
+
+	@property
+	def bucket_seconds(self):
+		return self._bucket_seconds
+
+	def flush(self):
+		"""Write all pending changes to disk."""
+		self._mm.flush()
+
+	def close(self):
+		"""Flush and close the store. Any further use of this object is illegal."""
+		if self._mm is None:
+			return
+		self._mm.flush()
+		for view in reversed(self._views):
+			view.release()
+		self._views = []
+		self._mm.close()
+		self._mm = None
+		self._file.close()
+
+	def on_battery_status(self, battery_status_listener, battery_percentage, timestamp):
+		"""Callback that can be assigned directly to BatteryStatusListener.on_battery_status."""
+		self.record(battery_status_listener.bd_addr, battery_percentage, timestamp)
+
+	def record(self, bd_addr, battery_percentage, timestamp):
+		"""Add a reading. Unknown readings (battery_percentage -1) are ignored.
+
+		The timestamp is a UNIX timestamp in seconds, as delivered by EvtBatteryStatus.
+		Readings older than the newest bucket are merged into their bucket if it is still kept, otherwise dropped.
+		"""
+		if battery_percentage < 0:
+			return
+
+		bd_addr = bd_addr.lower()
+		slot = self._slots.get(bd_addr)
+		if slot is None:
+			slot = self._allocate_slot(bd_addr)
+		else:
+			self._slots.move_to_end(bd_addr)
+
+		bucket_time = timestamp - timestamp % self._bucket_seconds
+		base = slot * self._buckets
+		count = self._counts[slot]
+		head = self._heads[slot]
+
+		if count > 0:
+			last = (head - 1) % self._buckets
+			last_time = self._times[base + last]
+			if bucket_time < last_time:
+				for age in range(1, count):
+					i = base + (head - 1 - age) % self._buckets
+					if self._times[i] == bucket_time:
+						self._add_to_bucket(i, battery_percentage)
+						break
+				return
+			if bucket_time == last_time:
+				self._add_to_bucket(base + last, battery_percentage)
+				return
+
+		i = base + head
+		self._times[i] = bucket_time
+		self._sums[i] = battery_percentage
+		self._nbs[i] = 1
+		self._mins[i] = battery_percentage
+		self._maxs[i] = battery_percentage
+		self._heads[slot] = (head + 1) % self._buckets
+		self._counts[slot] = min(count + 1, self._buckets)
+
+	def remove(self, bd_addr):
+		"""Forget all readings of a button."""
+		slot = self._slots.pop(bd_addr.lower(), None)
+		if slot is not None:
+			self._counts[slot] = 0
+			self._heads[slot] = 0
+			self._free.append(slot)
+
+	def readings(self, bd_addr):
+		"""Get the downsampled history of a button, oldest first.
+
+		Returns a list of (bucket_start_timestamp, mean_percentage, min_percentage, max_percentage) tuples.
+		"""
+		slot = self._slots.get(bd_addr.lower())
+		if slot is None:
+			return []
+
+		base = slot * self._buckets
+		count = self._counts[slot]
+		head = self._heads[slot]
+		result = []
+		for age in range(count - 1, -1, -1):
+			i = base + (head - 1 - age) % self._buckets
+			result.append((self._times[i], self._sums[i] / self._nbs[i], self._mins[i], self._maxs[i]))
+		return result
+
+	def latest(self, bd_addr):
+		"""Get the mean percentage of the newest bucket of a button, or None if there are no readings."""
+		slot = self._slots.get(bd_addr.lower())
+		if slot is None:
+			return None
+		i = slot * self._buckets + (self._heads[slot] - 1) % self._buckets
+		return self._sums[i] / self._nbs[i]
+
+	def drain_rate(self, bd_addr, window_days = 30):
+		"""Estimate the battery drain of a button in percent per day.
+
+		The estimate is a least squares fit over the buckets of the last window_days days, counted from the newest bucket.
+		Returns None if there is not enough data. A positive value means the battery is draining.
+		"""
+		history = self.readings(bd_addr)
+		if len(history) == 0:
+			return None
+
+		since = history[-1][0] - window_days * 86400
+		points = [(t / 86400.0, mean) for t, mean, _, _ in history if t >= since]
+		if len(points) < 2:
+			return None
+
+		n = len(points)
+		mean_x = sum(p[0] for p in points) / n
+		mean_y = sum(p[1] for p in points) / n
+		sxx = sum((p[0] - mean_x) ** 2 for p in points)
+		if sxx == 0:
+			return None
+		sxy = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points)
+		return -sxy / sxx
+
+	def days_until_empty(self, bd_addr, window_days = 30):
+		"""Predict the number of days until the battery of a button is empty.
+
+		Returns None if the drain rate can't be estimated or the battery is not draining.
+		"""
+		rate = self.drain_rate(bd_addr, window_days)
+		if rate is None or rate <= 0:
+			return None
+		return self.latest(bd_addr) / rate
+
+	def _add_to_bucket(self, i, battery_percentage):
+		if self._nbs[i] == 0xffff:
+			return
+		self._sums[i] += battery_percentage
+		self._nbs[i] += 1
+		if battery_percentage < self._mins[i]:
+			self._mins[i] = battery_percentage
+		if battery_percentage > self._maxs[i]:
+			self._maxs[i] = battery_percentage
+
+	def _slot_bd_addr(self, slot):
+		return ":".join(map(lambda x: "%02x" % x, self._addrs[slot * 6 : slot * 6 + 6]))
+
+	def _newest_time(self, slot):
+		return self._times[slot * self._buckets + (self._heads[slot] - 1) % self._buckets]
+
+	def _allocate_slot(self, bd_addr):
+		if len(self._free) > 0:
+			slot = self._free.pop()
+		else:
+			_, slot = self._slots.popitem(last=False)
+
+		self._addrs[slot * 6 : slot * 6 + 6] = bytes.fromhex(bd_addr.replace(":", ""))
+		self._heads[slot] = 0
+		self._counts[slot] = 0
+		self._slots[bd_addr] = slot
+		return slot
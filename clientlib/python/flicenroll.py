@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""Parallel bulk enrollment of buttons
+
+scan_wizard.py enrolls one button at a time. An EnrollmentEngine instead runs a ButtonScanner and several ScanWizards at once.
+Public, not yet verified buttons seen by the scanner are queued, and a connection channel is created to each of them
+(which makes the server connect to and verify the button), with at most max_pending_connections attempts in progress,
+as reported by get_info, minus one for each scan wizard. An attempt that is not Ready within attempt_timeout seconds is
+cancelled and retried after retry_delay seconds, doubled for every further attempt, up to max_attempts times.
+When the server answers MaxPendingConnectionsReached because other clients use pending connections too, the number of attempts
+in progress is lowered for a while, and raised again from a fresh get_info after retry_delay seconds or when one of our attempts ends.
+Scan wizards are restarted right after they complete, so they keep picking up buttons in parallel.
+
+Every result is written as a JSON line to the manifest as soon as it is known, with bd_addr, result ("enrolled" or "failed"),
+via ("scanner" or "wizard"), attempts, seconds (since the button was first seen) and timestamp.
+
+Usage:
+engine = EnrollmentEngine(client, open("manifest.jsonl", "a"))
+engine.on_result = lambda bd_addr, result: ...
+engine.start()
+client.handle_events()
+
+Command line:
+python3 flicenroll.py --host localhost --manifest manifest.jsonl --wizards 2
+"""
+
+import argparse
+import json
+import time
+from collections import deque
+
+from flicprotocol import ConnectionStatus, CreateConnectionChannelError, ScanWizardResult, ButtonScanner, ScanWizard, ButtonConnectionChannel, _unhandled
+
+class _Attempt:
+	def __init__(self, bd_addr):
+		self.bd_addr = bd_addr
+		self.first_seen = time.monotonic()
+		self.attempts = 0
+		self.channel = None
+
+class EnrollmentEngine:
+	"""EnrollmentEngine class.
+
+	Callbacks run on the thread that handles the events of the client.
+	on_result: bd_addr, result ("enrolled" or "failed")
+
+	Counters: enrolled, failed. queued and in_progress tell how many buttons wait for, or have, a connection attempt.
+	"""
+
+	def __init__(self, client, manifest = None, nb_wizards = 2, attempt_timeout = 30.0, max_attempts = 3, retry_delay = 2.0):
+		self.client = client
+		self.manifest = manifest
+		self.nb_wizards = nb_wizards
+		self.attempt_timeout = attempt_timeout
+		self.max_attempts = max_attempts
+		self.retry_delay = retry_delay
+		self.max_in_progress = 1
+		self.enrolled = 0
+		self.failed = 0
+		self._queue = deque()
+		self._in_progress = {}
+		self._known = {}
+		self._done = set()
+		self._wizards = []
+		self._scanner = None
+		self._running = False
+		self._limited = False
+		self._refreshing_limit = False
+
+		self.on_result = _unhandled
+
+	@property
+	def queued(self):
+		return len(self._queue)
+
+	@property
+	def in_progress(self):
+		return len(self._in_progress)
+
+	def start(self):
+		"""Ask the server for its limits and already verified buttons, then start scanning."""
+		self._running = True
+		self.client.get_info(self._on_info)
+
+	def stop(self):
+		"""Stop scanning and cancel all attempts in progress. Queued buttons are not enrolled."""
+		self._running = False
+		if self._scanner is not None:
+			self.client.remove_scanner(self._scanner)
+			self._scanner = None
+		for wizard in self._wizards:
+			self.client.cancel_scan_wizard(wizard)
+		self._wizards = []
+		for attempt in list(self._in_progress.values()):
+			self.client.remove_connection_channel(attempt.channel)
+		self._in_progress = {}
+		self._queue.clear()
+
+	def _on_info(self, info):
+		if not self._running:
+			return
+		self._done.update(info["bd_addr_of_verified_buttons"])
+		self._set_limit(info)
+
+		self._scanner = ButtonScanner()
+		self._scanner.on_advertisement_packet = self._on_advertisement_packet
+		self.client.add_scanner(self._scanner)
+		for i in range(self.nb_wizards):
+			self._start_wizard()
+
+	def _on_advertisement_packet(self, scanner, bd_addr, name, rssi, is_private, already_verified, already_connected_to_this_device, already_connected_to_other_device):
+		if is_private or already_verified or bd_addr in self._done or bd_addr in self._known:
+			return
+		self._known[bd_addr] = _Attempt(bd_addr)
+		self._queue.append(bd_addr)
+		self._pump()
+
+	def _pump(self):
+		while self._running and len(self._queue) > 0 and len(self._in_progress) < self.max_in_progress:
+			self._connect(self._known[self._queue.popleft()])
+
+	def _connect(self, attempt):
+		attempt.attempts += 1
+		channel = ButtonConnectionChannel(attempt.bd_addr)
+		channel.on_create_connection_channel_response = lambda channel, error, connection_status: self._on_create_response(attempt, channel, error, connection_status)
+		channel.on_connection_status_changed = lambda channel, connection_status, disconnect_reason: self._on_status(attempt, channel, connection_status)
+		attempt.channel = channel
+		self._in_progress[attempt.bd_addr] = attempt
+		self.client.add_connection_channel(channel)
+		self.client.set_timer(int(self.attempt_timeout * 1000), lambda: self._on_timeout(attempt, channel))
+
+	def _on_create_response(self, attempt, channel, error, connection_status):
+		if attempt.channel is not channel:
+			return
+		error = getattr(error, "value", error)
+		if error == CreateConnectionChannelError.MaxPendingConnectionsReached.value:
+			# Someone else uses pending connections too: hold back until the server has room again
+			del self._in_progress[attempt.bd_addr]
+			attempt.channel = None
+			attempt.attempts -= 1
+			self.max_in_progress = max(1, len(self._in_progress))
+			self._limited = True
+			self._queue.appendleft(attempt.bd_addr)
+			self.client.set_timer(int(self.retry_delay * 1000), self._refresh_limit)
+		elif error != CreateConnectionChannelError.NoError.value:
+			self._attempt_failed(attempt)
+		else:
+			self._on_status(attempt, channel, connection_status)
+
+	def _on_status(self, attempt, channel, connection_status):
+		if attempt.channel is channel and getattr(connection_status, "value", connection_status) == ConnectionStatus.Ready.value:
+			self._finish(attempt.bd_addr, "enrolled", "scanner", attempt)
+
+	def _on_timeout(self, attempt, channel):
+		if attempt.channel is channel:
+			self._attempt_failed(attempt)
+
+	def _attempt_failed(self, attempt):
+		self._release(attempt)
+		if attempt.attempts >= self.max_attempts:
+			self._finish(attempt.bd_addr, "failed", "scanner", attempt)
+			return
+		def retry():
+			if self._running and attempt.bd_addr not in self._done:
+				self._queue.append(attempt.bd_addr)
+				self._pump()
+		self.client.set_timer(int(self.retry_delay * (2 ** (attempt.attempts - 1)) * 1000), retry)
+		self._pump()
+
+	def _release(self, attempt):
+		if self._in_progress.get(attempt.bd_addr) is attempt:
+			del self._in_progress[attempt.bd_addr]
+		if attempt.channel is not None:
+			self.client.remove_connection_channel(attempt.channel)
+			attempt.channel = None
+		if self._limited:
+			self._refresh_limit()
+
+	def _set_limit(self, info):
+		# Our own attempts are part of current_pending_connections; the rest belong to other clients and the wizards
+		others = max(0, info["current_pending_connections"] - len(self._in_progress))
+		self.max_in_progress = max(1, info["max_pending_connections"] - others - self.nb_wizards)
+
+	def _refresh_limit(self):
+		if self._running and not self._refreshing_limit:
+			self._refreshing_limit = True
+			self.client.get_info(self._on_limit_info)
+
+	def _on_limit_info(self, info):
+		self._refreshing_limit = False
+		if not self._running:
+			return
+		self._limited = False
+		self._set_limit(info)
+		self._pump()
+
+	def _start_wizard(self):
+		wizard = ScanWizard()
+		wizard.on_found_public_button = self._on_wizard_found_public_button
+		wizard.on_completed = self._on_wizard_completed
+		self._wizards.append(wizard)
+		self.client.add_scan_wizard(wizard)
+
+	def _on_wizard_found_public_button(self, wizard, bd_addr, name):
+		# The wizard connects to this button itself, so the scanner pipeline leaves it alone
+		attempt = self._known.get(bd_addr)
+		if attempt is None:
+			self._known[bd_addr] = _Attempt(bd_addr)
+		elif bd_addr in self._queue:
+			self._queue.remove(bd_addr)
+
+	def _on_wizard_completed(self, wizard, result, bd_addr, name):
+		if wizard in self._wizards:
+			self._wizards.remove(wizard)
+		if getattr(result, "value", result) == ScanWizardResult.WizardSuccess.value and bd_addr is not None:
+			self._finish(bd_addr, "enrolled", "wizard", self._known.get(bd_addr) or _Attempt(bd_addr))
+		elif bd_addr is not None and bd_addr not in self._done and bd_addr not in self._in_progress and bd_addr in self._known:
+			self._queue.append(bd_addr)
+		if self._running:
+			self._start_wizard()
+		self._pump()
+
+	def _finish(self, bd_addr, result, via, attempt):
+		if bd_addr in self._done:
+			return
+		self._done.add(bd_addr)
+		self._release(attempt)
+		if bd_addr in self._queue:
+			self._queue.remove(bd_addr)
+		if result == "enrolled":
+			self.enrolled += 1
+		else:
+			self.failed += 1
+		if self.manifest is not None:
+			self.manifest.write(json.dumps({"bd_addr": bd_addr, "result": result, "via": via, "attempts": max(attempt.attempts, 1), "seconds": round(time.monotonic() - attempt.first_seen, 3), "timestamp": time.time()}) + "\n")
+			self.manifest.flush()
+		self.on_result(bd_addr, result)
+		self._pump()
+
+def main():
+	parser = argparse.ArgumentParser(description="Enroll all public Flic buttons in range, writing a manifest.")
+	parser.add_argument("--host", default="localhost")
+	parser.add_argument("--port", type=int, default=5551)
+	parser.add_argument("--manifest", default="manifest.jsonl", help="JSON lines file to append the results to")
+	parser.add_argument("--wizards", type=int, default=2, help="number of scan wizards to run in parallel with the scanner")
+	parser.add_argument("--count", type=int, default=0, help="stop after this many buttons have been enrolled (0 = never)")
+	parser.add_argument("--timeout", type=float, default=30.0, help="seconds per connection attempt")
+	parser.add_argument("--attempts", type=int, default=3)
+	args = parser.parse_args()
+
+	import fliclib
+
+	client = fliclib.FlicClient(args.host, args.port)
+	with open(args.manifest, "a") as manifest:
+		engine = EnrollmentEngine(client, manifest, args.wizards, args.timeout, args.attempts)
+		def on_result(bd_addr, result):
+			print("%s %s (%d enrolled, %d failed, %d queued)" % (bd_addr, result, engine.enrolled, engine.failed, engine.queued))
+			if args.count > 0 and engine.enrolled >= args.count:
+				engine.stop()
+				client.close()
+		engine.on_result = on_result
+		engine.start()
+		print("Hold down each Flic button for 7 seconds to make it public.")
+		client.handle_events()
+
+if __name__ == "__main__":
+	main()
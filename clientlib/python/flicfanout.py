@@ -0,0 +1,244 @@
+"""Client-side fan-out of connection channels
+
+Every ButtonConnectionChannel is a channel in flicd, and every event is sent and decoded once per channel.
+When several subsystems of one program listen to the same button, a ChannelFanOut instead creates a single channel
+per (bd_addr, latency_mode) and delivers each event to all ButtonListeners of that button and latency mode,
+decoded once and shared as an immutable ButtonEvent.
+
+Listener callbacks mirror those of ButtonConnectionChannel, with the listener as the first parameter:
+on_create_connection_channel_response: listener, error, connection_status
+on_removed: listener, removed_reason
+on_connection_status_changed: listener, connection_status, disconnect_reason
+on_button_up_or_down / on_button_click_or_hold / on_button_single_or_double_click / on_button_single_or_double_click_or_hold: listener, event
+
+A listener added after the channel has been created gets on_create_connection_channel_response with the current connection status right away
+(on the thread that handles the events). Event kinds that no listener of a channel handles are left unhandled on the channel,
+so that the client skips them without decoding.
+
+Usage:
+fanout = ChannelFanOut(client)
+listener = ButtonListener("aa:bb:cc:dd:ee:ff")
+listener.on_button_single_or_double_click_or_hold = lambda listener, event: print(event.click_type)
+fanout.add_listener(listener)
+
+Command line (benchmark of separate channels against one shared channel):
+python3 flicfanout.py --listeners 8 --events 100000
+"""
+
+import argparse
+import time
+from collections import namedtuple
+
+from flicprotocol import CreateConnectionChannelError, LatencyMode, ButtonConnectionChannel, _unhandled
+
+ButtonEvent = namedtuple("ButtonEvent", "bd_addr event click_type was_queued time_diff")
+
+_BUTTON_CALLBACKS = [
+	("ButtonUpOrDown", "on_button_up_or_down"),
+	("ButtonClickOrHold", "on_button_click_or_hold"),
+	("ButtonSingleOrDoubleClick", "on_button_single_or_double_click"),
+	("ButtonSingleOrDoubleClickOrHold", "on_button_single_or_double_click_or_hold")
+]
+
+class ButtonListener:
+	"""ButtonListener class.
+
+	A local listener for the events of one button, added to a ChannelFanOut. Callbacks may be assigned before or after adding it.
+	"""
+
+	_fanout = None
+
+	def __init__(self, bd_addr, latency_mode = LatencyMode.NormalLatency):
+		self._bd_addr = bd_addr
+		self._latency_mode = latency_mode
+
+		self.on_create_connection_channel_response = _unhandled
+		self.on_removed = _unhandled
+		self.on_connection_status_changed = _unhandled
+		self.on_button_up_or_down = _unhandled
+		self.on_button_click_or_hold = _unhandled
+		self.on_button_single_or_double_click = _unhandled
+		self.on_button_single_or_double_click_or_hold = _unhandled
+
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		fanout = self._fanout
+		if name.startswith("on_button_") and fanout is not None:
+			fanout._refresh(self._key)
+
+	@property
+	def bd_addr(self):
+		return self._bd_addr
+
+	@property
+	def latency_mode(self):
+		return self._latency_mode
+
+	@property
+	def _key(self):
+		return (self._bd_addr, getattr(self._latency_mode, "value", self._latency_mode))
+
+class _SharedChannel:
+	def __init__(self, fanout, bd_addr, latency_mode):
+		self.fanout = fanout
+		self.listeners = ()
+		self.response = None
+		self.channel = ButtonConnectionChannel(bd_addr, latency_mode)
+		self.channel.on_create_connection_channel_response = self._on_create_connection_channel_response
+		self.channel.on_connection_status_changed = self._on_connection_status_changed
+		self.channel.on_removed = self._on_removed
+
+	def refresh(self):
+		# Rebuilt whenever listeners or their callbacks change, so that dispatching only reads a tuple
+		channel = self.channel
+		for event, callback in _BUTTON_CALLBACKS:
+			targets = tuple((listener, getattr(listener, callback)) for listener in self.listeners if getattr(listener, callback) is not _unhandled)
+			dispatcher = self._dispatcher(event, targets) if len(targets) > 0 else _unhandled
+			setattr(channel, callback, dispatcher)
+
+	def _dispatcher(self, event_name, targets):
+		bd_addr = self.channel.bd_addr
+		def dispatch(channel, click_type, was_queued, time_diff):
+			event = ButtonEvent(bd_addr, event_name, click_type, was_queued, time_diff)
+			for listener, callback in targets:
+				callback(listener, event)
+		return dispatch
+
+	def _on_create_connection_channel_response(self, channel, error, connection_status):
+		self.response = (error, connection_status)
+		if getattr(error, "value", error) != CreateConnectionChannelError.NoError.value:
+			self.fanout._discard(self)
+		for listener in self.listeners:
+			listener.on_create_connection_channel_response(listener, error, connection_status)
+
+	def _on_connection_status_changed(self, channel, connection_status, disconnect_reason):
+		if self.response is not None:
+			self.response = (self.response[0], connection_status)
+		for listener in self.listeners:
+			listener.on_connection_status_changed(listener, connection_status, disconnect_reason)
+
+	def _on_removed(self, channel, removed_reason):
+		self.fanout._discard(self)
+		for listener in self.listeners:
+			listener.on_removed(listener, removed_reason)
+
+class ChannelFanOut:
+	"""ChannelFanOut class.
+
+	Works with both fliclib and aioflic clients. channel_count and listener_count tell how many flicd channels serve how many listeners.
+	"""
+
+	def __init__(self, client):
+		self.client = client
+		self._channels = {}
+
+	@property
+	def channel_count(self):
+		return len(self._channels)
+
+	@property
+	def listener_count(self):
+		return sum(len(shared.listeners) for shared in self._channels.values())
+
+	def add_listener(self, listener):
+		"""Add a listener, creating the connection channel of its button and latency mode if it is the first one."""
+		with self.client._lock:
+			if listener._fanout is not None:
+				return
+
+			key = listener._key
+			shared = self._channels.get(key)
+			created = shared is None
+			if created:
+				shared = _SharedChannel(self, listener.bd_addr, listener.latency_mode)
+				self._channels[key] = shared
+			object.__setattr__(listener, "_fanout", self)
+			shared.listeners = shared.listeners + (listener,)
+			shared.refresh()
+
+			if created:
+				self.client.add_connection_channel(shared.channel)
+			elif shared.response is not None:
+				error, connection_status = shared.response
+				self.client.run_on_handle_events_thread(lambda: listener.on_create_connection_channel_response(listener, error, connection_status))
+
+	def remove_listener(self, listener):
+		"""Remove a listener. The connection channel is removed along with the last listener of it. No callbacks are called on the listener."""
+		with self.client._lock:
+			if listener._fanout is not self:
+				return
+
+			object.__setattr__(listener, "_fanout", None)
+			shared = self._channels.get(listener._key)
+			if shared is None or listener not in shared.listeners:
+				return
+			shared.listeners = tuple(x for x in shared.listeners if x is not listener)
+			if len(shared.listeners) == 0:
+				del self._channels[listener._key]
+				self.client.remove_connection_channel(shared.channel)
+			shared.refresh()
+
+	def _refresh(self, key):
+		with self.client._lock:
+			shared = self._channels.get(key)
+			if shared is not None:
+				shared.refresh()
+
+	def _discard(self, shared):
+		# The channel is gone on the server side; its listeners stay attached to nothing until they are removed or added again
+		with self.client._lock:
+			key = (shared.channel.bd_addr, getattr(shared.channel.latency_mode, "value", shared.channel.latency_mode))
+			if self._channels.get(key) is shared:
+				del self._channels[key]
+			for listener in shared.listeners:
+				object.__setattr__(listener, "_fanout", None)
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare separate connection channels per listener with one shared channel, replaying button events offline.")
+	parser.add_argument("--listeners", type=int, default=8, help="listeners per button")
+	parser.add_argument("--buttons", type=int, default=10)
+	parser.add_argument("--events", type=int, default=100000, help="button presses to deliver")
+	args = parser.parse_args()
+
+	import socket
+	import struct
+	import fliclib
+
+	bd_addrs = ["00:00:00:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(args.buttons)]
+	event_struct = struct.Struct("<BIBBI")
+	received = [0]
+	def on_event(*args):
+		received[0] += 1
+
+	for mode in ("channels", "fanout"):
+		sock, peer = socket.socketpair()
+		peer.setblocking(False)
+		client = fliclib.FlicClient(None, sock = sock)
+		fanout = ChannelFanOut(client)
+		for bd_addr in bd_addrs:
+			for i in range(args.listeners):
+				if mode == "channels":
+					channel = ButtonConnectionChannel(bd_addr)
+					channel.on_button_up_or_down = on_event
+					client.add_connection_channel(channel)
+				else:
+					listener = ButtonListener(bd_addr)
+					listener.on_button_up_or_down = on_event
+					fanout.add_listener(listener)
+		# What flicd would send: one packet per channel for each press
+		conn_ids = {}
+		for conn_id, channel in client._connection_channels.items():
+			conn_ids.setdefault(channel.bd_addr, []).append(conn_id)
+		packets = [event_struct.pack(4, conn_id, i % 2, 0, 0) for i in range(args.events) for conn_id in conn_ids[bd_addrs[i % len(bd_addrs)]]]
+
+		received[0] = 0
+		start = time.perf_counter()
+		for packet in packets:
+			client._dispatch_event(packet)
+		elapsed = time.perf_counter() - start
+		print("%-8s: %d flicd channels, %d packets decoded, %d callbacks in %.3f s: %.0f presses/s" % (mode, len(client._connection_channels), len(packets), received[0], elapsed, args.events / elapsed))
+		sock.close()
+		peer.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,256 @@
+"""Recent event history per button, with time range queries
+
+EventHistory keeps, per bd addr, a ring of the most recent button events and connection transitions, so that questions like
+"what did this button do in the last 5 minutes" can be answered without keeping lists of event objects around.
+Each event is stored as a fixed-width record of 16 bytes (timestamp, kind, click type or connection status, was_queued,
+disconnect reason, time_diff) in one bytearray per button, and decoded into a HistoryEvent only when queried.
+
+Records are kept in order of their timestamp, so a time range is found with two binary searches: O(log n) in the number of
+records of the button, plus the number of events returned. A timestamp older than the last one recorded for the button is
+replaced by the last one, so that the order holds even if the clock steps back.
+
+A ring starts small and doubles, up to max_records, while its button keeps producing events. Memory for all rings together is
+limited to max_bytes: when a ring needs to grow (or a new button appears) and the limit is reached, the ring of the least recently
+active other button is halved, dropping its oldest records, and removed once it is at its minimum size. A button that cannot
+grow overwrites its own oldest records instead.
+
+Usage:
+history = EventHistory()
+history.attach(channel)  # or call the record methods from your own callbacks
+...
+for event in history.events(bd_addr, since = time.time() - 300):
+	print(event.timestamp, event.kind, event.click_type)
+"""
+
+import struct
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from flicprotocol import ClickType, ConnectionStatus, DisconnectReason, RemovedReason, _unhandled
+
+KINDS = ("ButtonUpOrDown", "ButtonClickOrHold", "ButtonSingleOrDoubleClick", "ButtonSingleOrDoubleClickOrHold", "ConnectionStatusChanged", "ConnectionChannelRemoved")
+
+_KIND_INDEX = dict((kind, index) for index, kind in enumerate(KINDS))
+_CONNECTION_STATUS_CHANGED = _KIND_INDEX["ConnectionStatusChanged"]
+_CONNECTION_CHANNEL_REMOVED = _KIND_INDEX["ConnectionChannelRemoved"]
+
+_CALLBACK_KINDS = {
+	"on_button_up_or_down": "ButtonUpOrDown",
+	"on_button_click_or_hold": "ButtonClickOrHold",
+	"on_button_single_or_double_click": "ButtonSingleOrDoubleClick",
+	"on_button_single_or_double_click_or_hold": "ButtonSingleOrDoubleClickOrHold"
+}
+
+# timestamp, kind, click type / connection status / removed reason, was_queued, disconnect reason, time_diff
+_RECORD = struct.Struct("<dBBBBI")
+_TIMESTAMP = struct.Struct("<d")
+RECORD_SIZE = _RECORD.size
+
+_MIN_RECORDS = 16
+
+HistoryEvent = namedtuple("HistoryEvent", "timestamp kind click_type was_queued time_diff connection_status disconnect_reason removed_reason")
+HistoryEvent.__doc__ = """One recorded event. kind is one of KINDS; the fields that do not apply to the kind are None."""
+
+def _value(x):
+	return getattr(x, "value", x)
+
+class _Ring:
+	def __init__(self, capacity):
+		self.buffer = bytearray(capacity * RECORD_SIZE)
+		self.capacity = capacity
+		self.start = 0
+		self.count = 0
+		self.last_timestamp = float("-inf")
+
+	def append(self, timestamp, kind, value, was_queued, reason, time_diff):
+		timestamp = max(timestamp, self.last_timestamp)
+		self.last_timestamp = timestamp
+		if self.count == self.capacity:
+			position = self.start
+			self.start = (self.start + 1) % self.capacity
+		else:
+			position = (self.start + self.count) % self.capacity
+			self.count += 1
+		_RECORD.pack_into(self.buffer, position * RECORD_SIZE, timestamp, kind, value, was_queued, reason, time_diff)
+
+	def resize(self, capacity):
+		# Keeps the newest records that fit
+		keep = min(self.count, capacity)
+		buffer = bytearray(capacity * RECORD_SIZE)
+		for i in range(keep):
+			offset = self._offset(self.count - keep + i)
+			buffer[i * RECORD_SIZE : (i + 1) * RECORD_SIZE] = self.buffer[offset : offset + RECORD_SIZE]
+		self.buffer = buffer
+		self.capacity = capacity
+		self.start = 0
+		self.count = keep
+
+	def lower_bound(self, timestamp):
+		# Index of the first record not older than timestamp
+		lo = 0
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if _TIMESTAMP.unpack_from(self.buffer, self._offset(mid))[0] < timestamp:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def record(self, index):
+		return _RECORD.unpack_from(self.buffer, self._offset(index))
+
+	def _offset(self, index):
+		return ((self.start + index) % self.capacity) * RECORD_SIZE
+
+class EventHistory:
+	"""EventHistory class.
+
+	max_bytes: limit for the records of all buttons together
+	max_records: the most records kept for one button
+
+	Thread safe: the record methods may be called from the thread that handles the events while queries run on other threads.
+	"""
+
+	def __init__(self, max_bytes = 1048576, max_records = 4096):
+		if max_records < _MIN_RECORDS or max_bytes < _MIN_RECORDS * RECORD_SIZE:
+			raise ValueError("max_records must be at least %d and max_bytes at least %d" % (_MIN_RECORDS, _MIN_RECORDS * RECORD_SIZE))
+		self.max_bytes = max_bytes
+		self.max_records = max_records
+		self._lock = threading.Lock()
+		# bd_addr -> _Ring, least recently active first
+		self._rings = OrderedDict()
+		self._allocated = 0
+
+	@property
+	def bd_addrs(self):
+		"""The buttons that have a history, least recently active first."""
+		with self._lock:
+			return list(self._rings)
+
+	@property
+	def memory_usage(self):
+		"""Bytes allocated for records."""
+		return self._allocated
+
+	def attach(self, channel, callbacks = ("on_button_up_or_down", "on_button_single_or_double_click_or_hold")):
+		"""Record the events of a connection channel.
+
+		Sets the given button event callbacks, on_connection_status_changed and on_removed, calling the callbacks that were assigned before as well.
+		Only the button event kinds asked for are recorded, so that the client can keep skipping the others without decoding them.
+		"""
+		for callback in callbacks:
+			previous = getattr(channel, callback)
+			def on_button_event(channel, click_type, was_queued, time_diff, previous = previous, kind = _CALLBACK_KINDS[callback]):
+				self.record_button_event(channel.bd_addr, kind, click_type, was_queued, time_diff)
+				if previous is not _unhandled:
+					previous(channel, click_type, was_queued, time_diff)
+			setattr(channel, callback, on_button_event)
+
+		previous_status_changed = channel.on_connection_status_changed
+		def on_connection_status_changed(channel, connection_status, disconnect_reason):
+			self.record_connection_status(channel.bd_addr, connection_status, disconnect_reason)
+			if previous_status_changed is not _unhandled:
+				previous_status_changed(channel, connection_status, disconnect_reason)
+		channel.on_connection_status_changed = on_connection_status_changed
+
+		previous_removed = channel.on_removed
+		def on_removed(channel, removed_reason):
+			self.record_removed(channel.bd_addr, removed_reason)
+			if previous_removed is not _unhandled:
+				previous_removed(channel, removed_reason)
+		channel.on_removed = on_removed
+
+	def record_button_event(self, bd_addr, kind, click_type, was_queued = False, time_diff = 0, timestamp = None):
+		"""Record a button event. kind is one of the button event kinds in KINDS. timestamp defaults to time.time()."""
+		self._record(bd_addr, timestamp, _KIND_INDEX[kind], _value(click_type), 1 if was_queued else 0, 0, time_diff)
+
+	def record_connection_status(self, bd_addr, connection_status, disconnect_reason = None, timestamp = None):
+		"""Record a connection status change. timestamp defaults to time.time()."""
+		reason = 0 if disconnect_reason is None else _value(disconnect_reason)
+		self._record(bd_addr, timestamp, _CONNECTION_STATUS_CHANGED, _value(connection_status), 0, reason, 0)
+
+	def record_removed(self, bd_addr, removed_reason, timestamp = None):
+		"""Record the removal of a connection channel. timestamp defaults to time.time()."""
+		self._record(bd_addr, timestamp, _CONNECTION_CHANNEL_REMOVED, _value(removed_reason), 0, 0, 0)
+
+	def events(self, bd_addr, since = None, until = None, limit = None):
+		"""Returns the HistoryEvents of a button with since <= timestamp < until, oldest first.
+
+		since and until default to the start and end of the history. If limit is given, only the newest limit events are returned.
+		"""
+		with self._lock:
+			ring = self._rings.get(bd_addr)
+			if ring is None:
+				return []
+			first, end = self._range(ring, since, until)
+			if limit is not None:
+				first = max(first, end - limit)
+			records = [ring.record(i) for i in range(first, end)]
+		return [self._decode(record) for record in records]
+
+	def count(self, bd_addr, since = None, until = None):
+		"""Number of events of a button with since <= timestamp < until, without decoding them."""
+		with self._lock:
+			ring = self._rings.get(bd_addr)
+			if ring is None:
+				return 0
+			first, end = self._range(ring, since, until)
+			return end - first
+
+	def discard(self, bd_addr):
+		"""Forget the history of a button."""
+		with self._lock:
+			ring = self._rings.pop(bd_addr, None)
+			if ring is not None:
+				self._allocated -= ring.capacity * RECORD_SIZE
+
+	def _range(self, ring, since, until):
+		first = 0 if since is None else ring.lower_bound(since)
+		end = ring.count if until is None else ring.lower_bound(until)
+		return first, max(first, end)
+
+	def _decode(self, record):
+		timestamp, kind, value, was_queued, reason, time_diff = record
+		if kind == _CONNECTION_STATUS_CHANGED:
+			return HistoryEvent(timestamp, KINDS[kind], None, None, None, ConnectionStatus(value), DisconnectReason(reason), None)
+		if kind == _CONNECTION_CHANNEL_REMOVED:
+			return HistoryEvent(timestamp, KINDS[kind], None, None, None, None, None, RemovedReason(value))
+		return HistoryEvent(timestamp, KINDS[kind], ClickType(value), was_queued != 0, time_diff, None, None, None)
+
+	def _record(self, bd_addr, timestamp, kind, value, was_queued, reason, time_diff):
+		if timestamp is None:
+			timestamp = time.time()
+		with self._lock:
+			ring = self._rings.get(bd_addr)
+			if ring is None:
+				self._reserve(_MIN_RECORDS * RECORD_SIZE, None)
+				ring = _Ring(_MIN_RECORDS)
+				self._rings[bd_addr] = ring
+				self._allocated += ring.capacity * RECORD_SIZE
+			else:
+				self._rings.move_to_end(bd_addr)
+				if ring.count == ring.capacity and ring.capacity < self.max_records:
+					capacity = min(ring.capacity * 2, self.max_records)
+					if self._reserve((capacity - ring.capacity) * RECORD_SIZE, bd_addr):
+						self._allocated += (capacity - ring.capacity) * RECORD_SIZE
+						ring.resize(capacity)
+			ring.append(timestamp, kind, value, was_queued, reason, time_diff)
+
+	def _reserve(self, nbytes, keep):
+		# Shrinks or removes the rings of the least recently active buttons other than keep until nbytes more fit.
+		# Returns False if they don't, even with every other ring removed.
+		while self._allocated + nbytes > self.max_bytes:
+			victim = next((bd_addr for bd_addr in self._rings if bd_addr != keep), None)
+			if victim is None:
+				return False
+			ring = self._rings[victim]
+			if ring.capacity > _MIN_RECORDS:
+				capacity = max(ring.capacity // 2, _MIN_RECORDS)
+				self._allocated -= (ring.capacity - capacity) * RECORD_SIZE
+				ring.resize(capacity)
+			else:
+				del self._rings[victim]
+				self._allocated -= ring.capacity * RECORD_SIZE
+		return True
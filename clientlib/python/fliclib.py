@@ -9,214 +9,33 @@ All kind of integers are represented as python integers.
 Booleans use the Boolean type.
 Enums use the defined python enums below.
 Bd addr are represented as standard python strings, e.g. "aa:bb:cc:dd:ee:ff".
+
+The enums, the ButtonScanner, ScanWizard, BatteryStatusListener and ButtonConnectionChannel classes and the protocol handling
+live in flicprotocol and are shared with aioflic. This module adds the transport: a socket with an outbound send queue, timers and the handle_events() loop.
+
+To keep "import fliclib" fast for programs that only need the enums, socket and queue are imported when first used.
+select and threading, which the send and receive paths use all the time, are imported with the module.
 """
 
-from enum import Enum
-from collections import namedtuple
-import time
-import socket
-import select
-import struct
+import heapq
 import itertools
-import queue
+import select
 import threading
+import time
+from collections import deque
 
-class CreateConnectionChannelError(Enum):
-	NoError = 0
-	MaxPendingConnectionsReached = 1
-
-class ConnectionStatus(Enum):
-	Disconnected = 0
-	Connected = 1
-	Ready = 2
-
-class DisconnectReason(Enum):
-	Unspecified = 0
-	ConnectionEstablishmentFailed = 1
-	TimedOut = 2
-	BondingKeysMismatch = 3
-
-class RemovedReason(Enum):
-	RemovedByThisClient = 0
-	ForceDisconnectedByThisClient = 1
-	ForceDisconnectedByOtherClient = 2
-	
-	ButtonIsPrivate = 3
-	VerifyTimeout = 4
-	InternetBackendError = 5
-	InvalidData = 6
-	
-	CouldntLoadDevice = 7
-	
-	DeletedByThisClient = 8
-	DeletedByOtherClient = 9
-	ButtonBelongsToOtherPartner = 10
-	DeletedFromButton = 11
-
-class ClickType(Enum):
-	ButtonDown = 0
-	ButtonUp = 1
-	ButtonClick = 2
-	ButtonSingleClick = 3
-	ButtonDoubleClick = 4
-	ButtonHold = 5
-
-class BdAddrType(Enum):
-	PublicBdAddrType = 0
-	RandomBdAddrType = 1
-
-class LatencyMode(Enum):
-	NormalLatency = 0
-	LowLatency = 1
-	HighLatency = 2
-
-class BluetoothControllerState(Enum):
-	Detached = 0
-	Resetting = 1
-	Attached = 2
-
-class ScanWizardResult(Enum):
-	WizardSuccess = 0
-	WizardCancelledByUser = 1
-	WizardFailedTimeout = 2
-	WizardButtonIsPrivate = 3
-	WizardBluetoothUnavailable = 4
-	WizardInternetBackendError = 5
-	WizardInvalidData = 6
-	WizardButtonBelongsToOtherPartner = 7
-	WizardButtonAlreadyConnectedToOtherDevice = 8
-
-class ButtonScanner:
-	"""ButtonScanner class.
-	
-	Usage:
-	scanner = ButtonScanner()
-	scanner.on_advertisement_packet = lambda scanner, bd_addr, name, rssi, is_private, already_verified, already_connected_to_this_device, already_connected_to_other_device: ...
-	client.add_scanner(scanner)
-	"""
-	
-	_cnt = itertools.count()
-	
-	def __init__(self):
-		self._scan_id = next(ButtonScanner._cnt)
-		self.on_advertisement_packet = lambda scanner, bd_addr, name, rssi, is_private, already_verified, already_connected_to_this_device, already_connected_to_other_device: None
-
-class ScanWizard:
-	"""ScanWizard class
-	
-	Usage:
-	wizard = ScanWizard()
-	wizard.on_found_private_button = lambda scan_wizard: ...
-	wizard.on_found_public_button = lambda scan_wizard, bd_addr, name: ...
-	wizard.on_button_connected = lambda scan_wizard, bd_addr, name: ...
-	wizard.on_completed = lambda scan_wizard, result, bd_addr, name: ...
-	client.add_scan_wizard(wizard)
-	"""
-	
-	_cnt = itertools.count()
-	
-	def __init__(self):
-		self._scan_wizard_id = next(ScanWizard._cnt)
-		self._bd_addr = None
-		self._name = None
-		self.on_found_private_button = lambda scan_wizard: None
-		self.on_found_public_button = lambda scan_wizard, bd_addr, name: None
-		self.on_button_connected = lambda scan_wizard, bd_addr, name: None
-		self.on_completed = lambda scan_wizard, result, bd_addr, name: None
-
-class BatteryStatusListener:
-	"""BatteryStatusListener class
-	
-	Usage:
-	listener = BatteryStatusListener(bd_addr)
-	listener.on_battery_status = lambda battery_status_listener, bd_addr, battery_percentage, timestamp: ...
-	client.add_battery_status_listener(listener)
-	"""
-	
-	_cnt = itertools.count()
-	
-	def __init__(self, bd_addr):
-		self._listener_id = next(BatteryStatusListener._cnt)
-		self._bd_addr = bd_addr
-		self.on_battery_status = lambda battery_status_listener, battery_percentage, timestamp: None
-	
-	@property
-	def bd_addr(self):
-		return self._bd_addr
-
-class ButtonConnectionChannel:
-	"""ButtonConnectionChannel class.
-	
-	This class represents a connection channel to a Flic button.
-	Add this button connection channel to a FlicClient by executing client.add_connection_channel(connection_channel).
-	You may only have this connection channel added to one FlicClient at a time.
-	
-	Before you add the connection channel to the client, you should set up your callback functions by assigning
-	the corresponding properties to this object with a function. Each callback function has a channel parameter as the first one,
-	referencing this object.
-	
-	Available properties and the function parameters are:
-	on_create_connection_channel_response: channel, error, connection_status
-	on_removed: channel, removed_reason
-	on_connection_status_changed: channel, connection_status, disconnect_reason
-	on_button_up_or_down / on_button_click_or_hold / on_button_single_or_double_click / on_button_single_or_double_click_or_hold: channel, click_type, was_queued, time_diff
-	"""
-	
-	_cnt = itertools.count()
-	
-	def __init__(self, bd_addr, latency_mode = LatencyMode.NormalLatency, auto_disconnect_time = 511):
-		self._conn_id = next(ButtonConnectionChannel._cnt)
-		self._bd_addr = bd_addr
-		self._latency_mode = latency_mode
-		self._auto_disconnect_time = auto_disconnect_time
-		self._client = None
-		
-		self.on_create_connection_channel_response = lambda channel, error, connection_status: None
-		self.on_removed = lambda channel, removed_reason: None
-		self.on_connection_status_changed = lambda channel, connection_status, disconnect_reason: None
-		self.on_button_up_or_down = lambda channel, click_type, was_queued, time_diff: None
-		self.on_button_click_or_hold = lambda channel, click_type, was_queued, time_diff: None
-		self.on_button_single_or_double_click = lambda channel, click_type, was_queued, time_diff: None
-		self.on_button_single_or_double_click_or_hold = lambda channel, click_type, was_queued, time_diff: None
-	
-	@property
-	def bd_addr(self):
-		return self._bd_addr
-	
-	@property
-	def latency_mode(self):
-		return self._latency_mode
-	
-	@latency_mode.setter
-	def latency_mode(self, latency_mode):
-		if self._client is None:
-			self._latency_mode = latency_mode
-			return
-		
-		with self._client._lock:
-			self._latency_mode = latency_mode
-			if not self._client._closed:
-				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time})
-	
-	@property
-	def auto_disconnect_time(self):
-		return self._auto_disconnect_time
-	
-	@auto_disconnect_time.setter
-	def auto_disconnect_time(self, auto_disconnect_time):
-		if self._client is None:
-			self._auto_disconnect_time = auto_disconnect_time
-			return
-		
-		with self._client._lock:
-			self._auto_disconnect_time = auto_disconnect_time
-			if not self._client._closed:
-				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time})
+from flicprotocol import CreateConnectionChannelError, ConnectionStatus, DisconnectReason, RemovedReason, ClickType, BdAddrType, LatencyMode, BluetoothControllerState, ScanWizardResult
+from flicprotocol import ENUM_VALUES, int_enum
+from flicprotocol import ButtonScanner, ScanWizard, BatteryStatusListener, ButtonConnectionChannel
+from flicprotocol import FlicClientBase, ProtocolEngine, FlightRecorder
+from flictransport import TransportOptions
 
-class FlicClient:
+class FlicClient(FlicClientBase):
 	"""FlicClient class.
 	
-	When this class is constructed, a socket connection is established.
+	When this class is constructed, a socket connection is established (unless an already connected socket is given as sock).
+	host may also be "unix:" followed by the path of a Unix socket. transport_options (a flictransport.TransportOptions) sets TCP_NODELAY,
+	buffer sizes, keepalive and the connect timeout; by default only TCP_NODELAY is set.
 	You may then send commands to the server and set timers.
 	Once you are ready with the initialization you must call the handle_events() method which is a main loop that never exits, unless the socket is closed.
 	For a more detailed description of all commands, events and enums, check the protocol specification.
@@ -234,79 +53,71 @@ class FlicClient:
 	on_no_space_for_new_connection: max_concurrently_connected_buttons
 	on_got_space_for_new_connection: max_concurrently_connected_buttons
 	on_bluetooth_controller_state_change: state
+	on_button_deleted: bd_addr, deleted_by_this_client
+	
+	Commands are never written with a blocking send. What the socket doesn't accept right away is queued and sent by the thread that handles the events.
+	When more than send_high_watermark bytes are queued, send_policy decides what a thread other than the one handling the events does:
+	"block" waits until the queue has drained below the watermark, "raise" raises BlockingIOError without sending the command,
+	and "drop-coalesce" drops a still queued CmdChangeModeParameters for the same connection channel, replacing it by the new one,
+	but queues all other commands anyway, since dropping them would leave the client out of sync with the server or a response callback waiting forever.
+	When a command is refused with BlockingIOError, the client is left as if the method had not been called.
+	queued_bytes tells how many bytes are waiting, coalesced_commands how often drop-coalesce applied.
+	Commands are given to the recorders (see start_capture) when they are written to the socket, so a replaced command is not recorded.
+	
+	The client may be used from several threads, also on free-threaded (no GIL) builds of python: all shared state is either protected by a lock
+	or, for the registries of connection channels, scanners and listeners, copied on write (see FlicClientBase).
+	
+	By default all callbacks run on the thread that handles the events. With callback_threads > 0, the callbacks of connection channels
+	run on that many worker threads instead, so that slow callbacks of different buttons run in parallel (on several cores, without the GIL).
+	The callbacks of one connection channel always run on the same worker, in the order of the events. Exceptions raised by them are printed
+	and do not stop the worker. Other callbacks (scanners, get_info, timers, ...) still run on the thread that handles the events.
 	"""
 	
-	_EVENTS = [
-		("EvtAdvertisementPacket", "<I6s17pb????", "scan_id bd_addr name rssi is_private already_verified already_connected_to_this_device already_connected_to_other_device"),
-		("EvtCreateConnectionChannelResponse", "<IBB", "conn_id error connection_status"),
-		("EvtConnectionStatusChanged", "<IBB", "conn_id connection_status disconnect_reason"),
-		("EvtConnectionChannelRemoved", "<IB", "conn_id removed_reason"),
-		("EvtButtonUpOrDown", "<IBBI", "conn_id click_type was_queued time_diff"),
-		("EvtButtonClickOrHold", "<IBBI", "conn_id click_type was_queued time_diff"),
-		("EvtButtonSingleOrDoubleClick", "<IBBI", "conn_id click_type was_queued time_diff"),
-		("EvtButtonSingleOrDoubleClickOrHold", "<IBBI", "conn_id click_type was_queued time_diff"),
-		("EvtNewVerifiedButton", "<6s", "bd_addr"),
-		("EvtGetInfoResponse", "<B6sBBhBBH", "bluetooth_controller_state my_bd_addr my_bd_addr_type max_pending_connections max_concurrently_connected_buttons current_pending_connections currently_no_space_for_new_connection nb_verified_buttons"),
-		("EvtNoSpaceForNewConnection", "<B", "max_concurrently_connected_buttons"),
-		("EvtGotSpaceForNewConnection", "<B", "max_concurrently_connected_buttons"),
-		("EvtBluetoothControllerStateChange", "<B", "state"),
-		("EvtPingResponse", "<I", "ping_id"),
-		("EvtGetButtonInfoResponse", "<6s16s17p17pBI", "bd_addr uuid color serial_number flic_version firmware_version"),
-		("EvtScanWizardFoundPrivateButton", "<I", "scan_wizard_id"),
-		("EvtScanWizardFoundPublicButton", "<I6s17p", "scan_wizard_id bd_addr name"),
-		("EvtScanWizardButtonConnected", "<I", "scan_wizard_id"),
-		("EvtScanWizardCompleted", "<IB", "scan_wizard_id result"),
-		("EvtButtonDeleted", "<6s?", "bd_addr deleted_by_this_client"),
-		("EvtBatteryStatus", "<Ibq", "listener_id battery_percentage timestamp")
-	]
-	_EVENT_STRUCTS = list(map(lambda x: None if x == None else struct.Struct(x[1]), _EVENTS))
-	_EVENT_NAMED_TUPLES = list(map(lambda x: None if x == None else namedtuple(x[0], x[2]), _EVENTS))
-	
-	_COMMANDS = [
-		("CmdGetInfo", "", ""),
-		("CmdCreateScanner", "<I", "scan_id"),
-		("CmdRemoveScanner", "<I", "scan_id"),
-		("CmdCreateConnectionChannel", "<I6sBh", "conn_id bd_addr latency_mode auto_disconnect_time"),
-		("CmdRemoveConnectionChannel", "<I", "conn_id"),
-		("CmdForceDisconnect", "<6s", "bd_addr"),
-		("CmdChangeModeParameters", "<IBh", "conn_id latency_mode auto_disconnect_time"),
-		("CmdPing", "<I", "ping_id"),
-		("CmdGetButtonInfo", "<6s", "bd_addr"),
-		("CmdCreateScanWizard", "<I", "scan_wizard_id"),
-		("CmdCancelScanWizard", "<I", "scan_wizard_id"),
-		("CmdDeleteButton", "<6s", "bd_addr"),
-		("CmdCreateBatteryStatusListener", "<I6s", "listener_id bd_addr"),
-		("CmdRemoveBatteryStatusListener", "<I", "listener_id")
-	]
-	
-	_COMMAND_STRUCTS = list(map(lambda x: struct.Struct(x[1]), _COMMANDS))
-	_COMMAND_NAMED_TUPLES = list(map(lambda x: namedtuple(x[0], x[2]), _COMMANDS))
-	_COMMAND_NAME_TO_OPCODE = dict((x[0], i) for i, x in enumerate(_COMMANDS))
+	SEND_POLICIES = ("block", "raise", "drop-coalesce")
 	
-	def _bdaddr_bytes_to_string(bdaddr_bytes):
-		return ":".join(map(lambda x: "%02x" % x, reversed(bdaddr_bytes)))
-	
-	def _bdaddr_string_to_bytes(bdaddr_string):
-		return bytearray.fromhex("".join(reversed(bdaddr_string.split(":"))))
-	
-	def __init__(self, host, port = 5551):
-		self._sock = socket.create_connection((host, port), None)
+	def __init__(self, host, port = 5551, sock = None, send_high_watermark = 1048576, send_policy = "block", transport_options = None, callback_threads = 0):
+		import socket
+		
+		if send_policy not in FlicClient.SEND_POLICIES:
+			raise ValueError("send_policy must be one of " + ", ".join(FlicClient.SEND_POLICIES))
+		FlicClientBase.__init__(self)
+		if transport_options is None:
+			transport_options = TransportOptions()
+		if sock is None:
+			sock = transport_options.connect(host, port)
+		else:
+			transport_options.apply(sock)
+		sock.setblocking(False)
+		self._sock = sock
 		self._lock = threading.RLock()
-		self._scanners = {}
-		self._scan_wizards = {}
-		self._connection_channels = {}
-		self._battery_status_listeners = {}
-		self._get_info_response_queue = queue.Queue()
-		self._get_button_info_queue = queue.Queue()
-		self._timers = queue.PriorityQueue()
+		self._engine = ProtocolEngine()
+		# Heap of (point_in_time, sequence number, callback)
+		self._timers = []
+		self._timers_lock = threading.Lock()
+		self._timer_sequence = itertools.count()
 		self._handle_event_thread_ident = None
-		self._closed = False
-		
-		self.on_new_verified_button = lambda bd_addr: None
-		self.on_no_space_for_new_connection = lambda max_concurrently_connected_buttons: None
-		self.on_got_space_for_new_connection = lambda max_concurrently_connected_buttons: None
-		self.on_bluetooth_controller_state_change = lambda state: None
-		self.on_button_deleted = lambda bd_addr, deleted_by_this_client: None
+		self.send_high_watermark = send_high_watermark
+		self.send_policy = send_policy
+		self.coalesced_commands = 0
+		self._send_queue = deque()
+		self._send_coalesce = {}
+		self._queued_bytes = 0
+		self._send_space = threading.Condition(self._lock)
+		# Written to by other threads to wake up the select() in handle_events
+		self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+		self._wakeup_receiver.setblocking(False)
+		self._wakeup_sender.setblocking(False)
+		# Queues of blocking get_buttons_info calls, woken up with None when the client closes
+		self._blocked_calls = set()
+		self._callback_workers = None
+		if callback_threads > 0:
+			self._callback_workers = _CallbackWorkers(callback_threads)
+			self._channel_callback_executor = self._callback_workers.submit
+	
+	@property
+	def queued_bytes(self):
+		"""Number of bytes of commands waiting to be sent."""
+		return self._queued_bytes
 	
 	def close(self):
 		"""Closes the client. The handle_events() method will return."""
@@ -314,147 +125,47 @@ class FlicClient:
 			if self._closed:
 				return
 			
-			if threading.get_ident() != self._handle_event_thread_ident:
-				self._send_command("CmdPing", {"ping_id": 0}) # To unblock socket select
-			
 			self._closed = True
+			self._send_space.notify_all()
+			self._wake_blocked_calls()
+			if threading.get_ident() != self._handle_event_thread_ident:
+				self._wakeup()
 	
-	def add_scanner(self, scanner):
-		"""Add a ButtonScanner object.
-		
-		The scan will start directly once the scanner is added.
-		"""
-		with self._lock:
-			if scanner._scan_id in self._scanners:
-				return
-			
-			self._scanners[scanner._scan_id] = scanner
-			self._send_command("CmdCreateScanner", {"scan_id": scanner._scan_id})
-	
-	def remove_scanner(self, scanner):
-		"""Remove a ButtonScanner object.
-		
-		You will no longer receive advertisement packets.
-		"""
-		with self._lock:
-			if scanner._scan_id not in self._scanners:
-				return
-			
-			del self._scanners[scanner._scan_id]
-			self._send_command("CmdRemoveScanner", {"scan_id": scanner._scan_id})
-	
-	def add_scan_wizard(self, scan_wizard):
-		"""Add a ScanWizard object.
-		
-		The scan wizard will start directly once the scan wizard is added.
-		"""
-		with self._lock:
-			if scan_wizard._scan_wizard_id in self._scan_wizards:
-				return
-			
-			self._scan_wizards[scan_wizard._scan_wizard_id] = scan_wizard
-			self._send_command("CmdCreateScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id})
-	
-	def cancel_scan_wizard(self, scan_wizard):
-		"""Cancel a ScanWizard.
-		
-		Note: The effect of this command will take place at the time the on_completed event arrives on the scan wizard object.
-		If cancelled due to this command, "result" in the on_completed event will be "WizardCancelledByUser".
-		"""
-		with self._lock:
-			if scan_wizard._scan_wizard_id not in self._scan_wizards:
-				return
-			
-			self._send_command("CmdCancelScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id})
-	
-	def add_connection_channel(self, channel):
-		"""Adds a connection channel to a specific Flic button.
+	def get_buttons_info(self, bd_addrs, callback = None):
+		"""Get button info for many buttons at once.
 		
-		This will start listening for a specific Flic button's connection and button events.
-		Make sure the Flic is either in public mode (by holding it down for 7 seconds) or already verified before calling this method.
+		All requests that are not already cached are sent in one write and the responses are collected in order.
+		The result is a list with one dictionary per requested bd addr, in the same order, with the keys
+		bd_addr, uuid, color, serial_number, flic_version and firmware_version (same meaning as for get_button_info).
 		
-		The on_create_connection_channel_response callback property will be called on the
-		connection channel after this command has been received by the server.
+		If a callback is given, it is called with the result on the thread that handles the events.
+		Otherwise this method blocks until the result is available and returns it, which is not allowed on the thread that handles the events.
+		If the client is closed, or the connection lost, before the result is available, ConnectionError is raised.
 		
-		You may have as many connection channels as you wish for a specific Flic Button.
-		"""
-		with self._lock:
-			if channel._conn_id in self._connection_channels:
-				return
-			
-			channel._client = self
-			
-			self._connection_channels[channel._conn_id] = channel
-			self._send_command("CmdCreateConnectionChannel", {"conn_id": channel._conn_id, "bd_addr": channel.bd_addr, "latency_mode": channel._latency_mode, "auto_disconnect_time": channel._auto_disconnect_time})
-	
-	def remove_connection_channel(self, channel):
-		"""Remove a connection channel.
-		
-		This will stop listening for new events for a specific connection channel that has previously been added.
-		Note: The effect of this command will take place at the time the on_removed event arrives on the connection channel object.
-		"""
-		with self._lock:
-			if channel._conn_id not in self._connection_channels:
-				return
-			
-			self._send_command("CmdRemoveConnectionChannel", {"conn_id": channel._conn_id})
-	
-	def add_battery_status_listener(self, listener):
-		"""Adds a battery status listener for a specific Flic button.
+		Responses are cached per bd addr. The cache entry of a button is invalidated when the button is deleted or verified.
 		"""
-		with self._lock:
-			if listener._listener_id in self._battery_status_listeners:
-				return
+		bd_addrs = list(bd_addrs)
+		if callback is None:
+			import queue
 			
-			self._battery_status_listeners[listener._listener_id] = listener
-			self._send_command("CmdCreateBatteryStatusListener", {"listener_id": listener._listener_id, "bd_addr": listener._bd_addr})
-	
-	def remove_battery_status_listener(self, listener):
-		"""Remove a battery status listener.
-		"""
-		with self._lock:
-			if listener._listener_id not in self._battery_status_listeners:
-				return
-			
-			del self._battery_status_listeners[listener._listener_id]
-			self._send_command("CmdRemoveBatteryStatusListener", {"listener_id": listener._listener_id})
-	
-	def force_disconnect(self, bd_addr):
-		"""Force disconnection or cancel pending connection of a specific Flic button.
-		
-		This removes all connection channels for all clients connected to the server for this specific Flic button.
-		"""
-		self._send_command("CmdForceDisconnect", {"bd_addr": bd_addr})
-	
-	def get_info(self, callback):
-		"""Get info about the current state of the server.
-		
-		The server will send back its information directly and the callback will be called once the response arrives.
-		The callback takes only one parameter: info. This info parameter is a dictionary with the following objects:
-		bluetooth_controller_state, my_bd_addr, my_bd_addr_type, max_pending_connections, max_concurrently_connected_buttons,
-		current_pending_connections, currently_no_space_for_new_connection, bd_addr_of_verified_buttons (a list of bd addresses).
-		"""
-		self._get_info_response_queue.put(callback)
-		self._send_command("CmdGetInfo", {})
-	
-	def delete_button(self, bd_addr):
-		"""Delete a verified button.
-		"""
-		self._send_command("CmdDeleteButton", {"bd_addr": bd_addr})
-	
-	def get_button_info(self, bd_addr, callback):
-		"""Get button info for a verified button.
-		
-		The server will send back its information directly and the callback will be called once the response arrives.
-		Responses will arrive in the same order as requested.
-		
-		The callback takes four parameters: bd_addr, uuid (hex string of 32 characters), color (string and None if unknown), serial_number, flic_version, firmware_version.
-		
-		Note: if the button isn't verified, the uuid sent to the callback will rather be None.
-		"""
-		with self._lock:
-			self._get_button_info_queue.put(callback)
-			self._send_command("CmdGetButtonInfo", {"bd_addr": bd_addr})
+			if threading.get_ident() == self._handle_event_thread_ident:
+				raise RuntimeError("get_buttons_info without callback would block the thread that handles the events")
+			result_queue = queue.Queue()
+			with self._lock:
+				if self._closed:
+					raise ConnectionError("The FlicClient is closed")
+				self._blocked_calls.add(result_queue)
+			try:
+				self.get_buttons_info(bd_addrs, result_queue.put)
+				result = result_queue.get()
+			finally:
+				with self._lock:
+					self._blocked_calls.discard(result_queue)
+			if result is None:
+				raise ConnectionError("The FlicClient was closed before the button info arrived")
+			return result
+		
+		self._get_buttons_info(bd_addrs, callback)
 	
 	def set_timer(self, timeout_millis, callback):
 		"""Set a timer
@@ -462,10 +173,11 @@ class FlicClient:
 		This timer callback will run after the specified timeout_millis on the thread that handles the events.
 		"""
 		point_in_time = time.monotonic() + timeout_millis / 1000.0
-		self._timers.put((point_in_time, callback))
+		with self._timers_lock:
+			heapq.heappush(self._timers, (point_in_time, next(self._timer_sequence), callback))
 		
 		if threading.get_ident() != self._handle_event_thread_ident:
-			self._send_command("CmdPing", {"ping_id": 0}) # To unblock socket select
+			self._wakeup()
 	
 	def run_on_handle_events_thread(self, callback):
 		"""Run a function on the thread that handles the events."""
@@ -474,198 +186,154 @@ class FlicClient:
 		else:
 			self.set_timer(0, callback)
 	
-	def _send_command(self, name, items):
-		for key, value in items.items():
-			if isinstance(value, Enum):
-				items[key] = value.value
-		
-		if "bd_addr" in items:
-			items["bd_addr"] = FlicClient._bdaddr_string_to_bytes(items["bd_addr"])
+	def _wakeup(self):
+		try:
+			self._wakeup_sender.send(b"\0")
+		except OSError:
+			pass # Already full (a wakeup is pending anyway) or closed
+	
+	def _wake_blocked_calls(self):
+		# Called with the lock held once the client is closed; no more responses will be dispatched
+		for result_queue in self._blocked_calls:
+			result_queue.put(None)
+	
+	def _write(self, data):
+		# Called with self._lock held
+		on_event_thread = threading.get_ident() == self._handle_event_thread_ident
+		if len(self._send_queue) == 0:
+			try:
+				sent = self._sock.send(data)
+			except BlockingIOError:
+				sent = 0
+			if sent > 0:
+				self._commands_written(data)
+			if sent == len(data):
+				return
+			if sent > 0:
+				# The rest of a partly sent command must go out next, whatever the policy
+				self._send_queue.append([None, data[sent:], True])
+				self._queued_bytes += len(data) - sent
+				if not on_event_thread:
+					self._wakeup()
+				return
 		
-		opcode = FlicClient._COMMAND_NAME_TO_OPCODE[name]
-		data_bytes = FlicClient._COMMAND_STRUCTS[opcode].pack(*FlicClient._COMMAND_NAMED_TUPLES[opcode](**items))
-		bytes = bytearray(3)
-		bytes[0] = (len(data_bytes) + 1) & 0xff
-		bytes[1] = (len(data_bytes) + 1) >> 8
-		bytes[2] = opcode
-		bytes += data_bytes
+		if not on_event_thread and self._queued_bytes + len(data) > self.send_high_watermark:
+			if self.send_policy == "raise":
+				raise BlockingIOError("Send queue of the FlicClient is full")
+			if self.send_policy == "block":
+				while not self._closed and self._queued_bytes > 0 and self._queued_bytes + len(data) > self.send_high_watermark:
+					self._send_space.wait()
+				if self._closed:
+					return
+			else:
+				data = self._coalesce(data)
+		
+		if len(data) > 0:
+			self._queue_packets(data)
+			if not on_event_thread:
+				self._wakeup()
+	
+	def _queue_packets(self, data):
+		pos = 0
+		while pos < len(data):
+			end = pos + 2 + (data[pos] | (data[pos + 1] << 8))
+			# coalesce key, packet, whether it has been recorded
+			entry = [None, data[pos:end], False]
+			if end - pos >= 7 and data[pos + 2] == self._COMMAND_NAME_TO_OPCODE["CmdChangeModeParameters"]:
+				entry[0] = data[pos + 3 : pos + 7] # The conn_id
+				self._send_coalesce[entry[0]] = entry
+			self._send_queue.append(entry)
+			self._queued_bytes += end - pos
+			pos = end
+	
+	def _coalesce(self, data):
+		# Returns the commands of data that were not merged into queued ones
+		pos = 0
+		remaining = bytearray()
+		while pos < len(data):
+			end = pos + 2 + (data[pos] | (data[pos + 1] << 8))
+			opcode = data[pos + 2] if end - pos >= 3 else None
+			if opcode == self._COMMAND_NAME_TO_OPCODE["CmdChangeModeParameters"] and data[pos + 3 : pos + 7] in self._send_coalesce:
+				entry = self._send_coalesce[data[pos + 3 : pos + 7]]
+				entry[1] = data[pos:end]
+				self.coalesced_commands += 1
+			else:
+				remaining += data[pos:end]
+			pos = end
+		return bytes(remaining)
+	
+	def _flush_send_queue(self):
 		with self._lock:
-			if not self._closed:
-				self._sock.sendall(bytes)
-	
-	def _dispatch_event(self, data):
-		if len(data) == 0:
-			return
-		opcode = data[0]
-		
-		if opcode >= len(FlicClient._EVENTS) or FlicClient._EVENTS[opcode] == None:
-			return
-		
-		event_name = FlicClient._EVENTS[opcode][0]
-		data_tuple = FlicClient._EVENT_STRUCTS[opcode].unpack(data[1 : 1 + FlicClient._EVENT_STRUCTS[opcode].size])
-		items = FlicClient._EVENT_NAMED_TUPLES[opcode]._make(data_tuple)._asdict()
-		
-		# Process some kind of items whose data type is not supported by struct
-		if "bd_addr" in items:
-			items["bd_addr"] = FlicClient._bdaddr_bytes_to_string(items["bd_addr"])
-		
-		if "name" in items:
-			items["name"] = items["name"].decode("utf-8")
-		
-		if event_name == "EvtCreateConnectionChannelResponse":
-			items["error"] = CreateConnectionChannelError(items["error"])
-			items["connection_status"] = ConnectionStatus(items["connection_status"])
-		
-		if event_name == "EvtConnectionStatusChanged":
-			items["connection_status"] = ConnectionStatus(items["connection_status"])
-			items["disconnect_reason"] = DisconnectReason(items["disconnect_reason"])
-		
-		if event_name == "EvtConnectionChannelRemoved":
-			items["removed_reason"] = RemovedReason(items["removed_reason"])
-		
-		if event_name == "EvtButtonUpOrDown" or event_name == "EvtButtonClickOrHold" or event_name == "EvtButtonSingleOrDoubleClick" or event_name == "EvtButtonSingleOrDoubleClickOrHold":
-			items["click_type"] = ClickType(items["click_type"])
-		
-		if event_name == "EvtGetInfoResponse":
-			items["bluetooth_controller_state"] = BluetoothControllerState(items["bluetooth_controller_state"])
-			items["my_bd_addr"] = FlicClient._bdaddr_bytes_to_string(items["my_bd_addr"])
-			items["my_bd_addr_type"] = BdAddrType(items["my_bd_addr_type"])
-			items["bd_addr_of_verified_buttons"] = []
-			
-			pos = FlicClient._EVENT_STRUCTS[opcode].size
-			for i in range(items["nb_verified_buttons"]):
-				items["bd_addr_of_verified_buttons"].append(FlicClient._bdaddr_bytes_to_string(data[1 + pos : 1 + pos + 6]))
-				pos += 6
-		
-		if event_name == "EvtBluetoothControllerStateChange":
-			items["state"] = BluetoothControllerState(items["state"])
-		
-		if event_name == "EvtGetButtonInfoResponse":
-			items["uuid"] = "".join(map(lambda x: "%02x" % x, items["uuid"]))
-			if items["uuid"] == "00000000000000000000000000000000":
-				items["uuid"] = None
-			items["color"] = items["color"].decode("utf-8")
-			if items["color"] == "":
-				items["color"] = None
-			items["serial_number"] = items["serial_number"].decode("utf-8")
-			if items["serial_number"] == "":
-				items["serial_number"] = None
-		
-		if event_name == "EvtScanWizardCompleted":
-			items["result"] = ScanWizardResult(items["result"])
-		
-		# Process event
-		if event_name == "EvtAdvertisementPacket":
-			scanner = self._scanners.get(items["scan_id"])
-			if scanner is not None:
-				scanner.on_advertisement_packet(scanner, items["bd_addr"], items["name"], items["rssi"], items["is_private"], items["already_verified"], items["already_connected_to_this_device"], items["already_connected_to_other_device"])
-		
-		if event_name == "EvtCreateConnectionChannelResponse":
-			channel = self._connection_channels[items["conn_id"]]
-			if items["error"] != CreateConnectionChannelError.NoError:
-				del self._connection_channels[items["conn_id"]]
-			channel.on_create_connection_channel_response(channel, items["error"], items["connection_status"])
-		
-		if event_name == "EvtConnectionStatusChanged":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_connection_status_changed(channel, items["connection_status"], items["disconnect_reason"])
-		
-		if event_name == "EvtConnectionChannelRemoved":
-			channel = self._connection_channels[items["conn_id"]]
-			del self._connection_channels[items["conn_id"]]
-			channel.on_removed(channel, items["removed_reason"])
-		
-		if event_name == "EvtButtonUpOrDown":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_up_or_down(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonClickOrHold":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_click_or_hold(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonSingleOrDoubleClick":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_single_or_double_click(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		if event_name == "EvtButtonSingleOrDoubleClickOrHold":
-			channel = self._connection_channels[items["conn_id"]]
-			channel.on_button_single_or_double_click_or_hold(channel, items["click_type"], items["was_queued"], items["time_diff"])
-		
-		if event_name == "EvtNewVerifiedButton":
-			self.on_new_verified_button(items["bd_addr"])
-		
-		if event_name == "EvtGetInfoResponse":
-			self._get_info_response_queue.get()(items)
-		
-		if event_name == "EvtNoSpaceForNewConnection":
-			self.on_no_space_for_new_connection(items["max_concurrently_connected_buttons"])
-		
-		if event_name == "EvtGotSpaceForNewConnection":
-			self.on_got_space_for_new_connection(items["max_concurrently_connected_buttons"])
-		
-		if event_name == "EvtBluetoothControllerStateChange":
-			self.on_bluetooth_controller_state_change(items["state"])
-		
-		if event_name == "EvtGetButtonInfoResponse":
-			self._get_button_info_queue.get()(items["bd_addr"], items["uuid"], items["color"], items["serial_number"], items["flic_version"], items["firmware_version"])
-		
-		if event_name == "EvtScanWizardFoundPrivateButton":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_found_private_button(scan_wizard)
-		
-		if event_name == "EvtScanWizardFoundPublicButton":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard._bd_addr = items["bd_addr"]
-			scan_wizard._name = items["name"]
-			scan_wizard.on_found_public_button(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
-		
-		if event_name == "EvtScanWizardButtonConnected":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_button_connected(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
-		
-		if event_name == "EvtScanWizardCompleted":
-			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
-			del self._scan_wizards[items["scan_wizard_id"]]
-			scan_wizard.on_completed(scan_wizard, items["result"], scan_wizard._bd_addr, scan_wizard._name)
-		
-		if event_name == "EvtButtonDeleted":
-			self.on_button_deleted(items["bd_addr"], items["deleted_by_this_client"])
-		
-		if event_name == "EvtBatteryStatus":
-			listener = self._battery_status_listeners.get(items["listener_id"])
-			if listener is not None:
-				listener.on_battery_status(listener, items["battery_percentage"], items["timestamp"])
+			queue = self._send_queue
+			while len(queue) > 0:
+				chunks = []
+				size = 0
+				for entry in queue:
+					chunks.append(entry[1])
+					size += len(entry[1])
+					if size >= 65536:
+						break
+				data = b"".join(chunks)
+				try:
+					sent = self._sock.send(data)
+				except BlockingIOError:
+					sent = 0
+				if sent == 0:
+					break
+				self._queued_bytes -= sent
+				while sent > 0:
+					entry = queue[0]
+					if not entry[2]:
+						entry[2] = True
+						self._commands_written(entry[1])
+					if len(entry[1]) <= sent:
+						sent -= len(entry[1])
+						queue.popleft()
+						if entry[0] is not None and self._send_coalesce.get(entry[0]) is entry:
+							del self._send_coalesce[entry[0]]
+					else:
+						# Partly sent, so it can no longer be replaced
+						if entry[0] is not None and self._send_coalesce.get(entry[0]) is entry:
+							del self._send_coalesce[entry[0]]
+						queue[0] = [None, entry[1][sent:], True]
+						sent = 0
+			if self._queued_bytes <= self.send_high_watermark:
+				self._send_space.notify_all()
 	
 	def _handle_one_event(self):
-		if len(self._timers.queue) > 0:
-			current_timer = self._timers.queue[0]
-			timeout = max(current_timer[0] - time.monotonic(), 0)
-			if timeout == 0:
-				self._timers.get()[1]()
-				return True
-			if len(select.select([self._sock], [], [], timeout)[0]) == 0:
-				return True
-		
-		len_arr = bytearray(2)
-		view = memoryview(len_arr)
-		
-		toread = 2
-		while toread > 0:
-			nbytes = self._sock.recv_into(view, toread)
-			if nbytes == 0:
-				return False
-			view = view[nbytes:]
-			toread -= nbytes
-		
-		packet_len = len_arr[0] | (len_arr[1] << 8)
-		data = bytearray(packet_len)
-		view = memoryview(data)
-		toread = packet_len
-		while toread > 0:
-			nbytes = self._sock.recv_into(view, toread)
-			if nbytes == 0:
-				return False
-			view = view[nbytes:]
-			toread -= nbytes
+		timeout = None
+		callback = None
+		with self._timers_lock:
+			if len(self._timers) > 0:
+				timeout = max(self._timers[0][0] - time.monotonic(), 0)
+				if timeout == 0:
+					callback = heapq.heappop(self._timers)[2]
+		if callback is not None:
+			callback()
+			return True
+		
+		readable, writable, exceptional = select.select([self._sock, self._wakeup_receiver], [self._sock] if len(self._send_queue) > 0 else [], [], timeout)
+		if self._wakeup_receiver in readable:
+			try:
+				self._wakeup_receiver.recv(4096)
+			except BlockingIOError:
+				pass
+		if len(writable) > 0:
+			self._flush_send_queue()
+		if self._sock not in readable:
+			return True
+		
+		try:
+			data = self._sock.recv(65536)
+		except BlockingIOError:
+			return True
+		if len(data) == 0:
+			return False
 		
-		self._dispatch_event(data)
+		for packet in self._engine.receive_packets(data):
+			if self._closed:
+				break
+			self._packet_received(packet)
 		return True
 		
 	def handle_events(self):
@@ -675,7 +343,52 @@ class FlicClient:
 		Once it has returned, any use of this FlicClient is illegal.
 		"""
 		self._handle_event_thread_ident = threading.get_ident()
-		while not self._closed:
-			if not self._handle_one_event():
-				break
-		self._sock.close()
+		try:
+			while not self._closed:
+				if not self._handle_one_event():
+					break
+		finally:
+			with self._lock:
+				self._closed = True
+				self._send_space.notify_all()
+				self._wake_blocked_calls()
+			self._sock.close()
+			self._wakeup_receiver.close()
+			self._wakeup_sender.close()
+			if self._callback_workers is not None:
+				self._callback_workers.close()
+
+class _CallbackWorkers:
+	# Threads running connection channel callbacks, each with its own queue; a key always goes to the same thread
+	
+	def __init__(self, nb_threads):
+		import queue
+		
+		queue_class = getattr(queue, "SimpleQueue", queue.Queue)
+		self._queues = [queue_class() for i in range(nb_threads)]
+		self._threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self._queues]
+		for thread in self._threads:
+			thread.start()
+	
+	def submit(self, key, callback, args):
+		self._queues[key % len(self._queues)].put((callback, args))
+	
+	def close(self):
+		"""Runs the callbacks already submitted, then stops the threads."""
+		for q in self._queues:
+			q.put(None)
+		for thread in self._threads:
+			if thread is not threading.current_thread():
+				thread.join()
+	
+	def _run(self, q):
+		import traceback
+		
+		while True:
+			item = q.get()
+			if item is None:
+				return
+			try:
+				item[0](*item[1])
+			except Exception:
+				traceback.print_exc()
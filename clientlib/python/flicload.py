@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+"""Load generator for flicd
+
+Opens a number of client connections and issues commands at a rate that is ramped up step by step, to find how much load
+one flicd sustains before command latency degrades. The commands are mixed according to weights:
+ping (CmdPing), button_info (CmdGetButtonInfo of a verified button), channel (CmdCreateConnectionChannel) and scanner (CmdCreateScanner).
+
+Commands are issued open loop, at the target rate whether or not earlier ones have been answered, so a saturated server shows up
+as growing latency rather than as a lower rate. Latency is the time from issuing a command until its response is handled:
+the ping or get button info response, the create connection channel response, and for scanners (which have no response)
+a ping sent right after the create. Connection channels go to verified buttons, except a fraction that go to unknown addresses;
+those stay pending and are removed again after the response, so the pending connections limit is exercised and
+MaxPendingConnectionsReached is counted as an error. Channels to verified buttons and scanners are kept open, up to
+max_channels and max_scanners per client, so that the server also carries a growing number of them during a run.
+
+Commands still unanswered timeout seconds after a step ends are counted as timeouts. The ramp stops after the first step
+where the p99 latency of any command exceeds the latency budget or more than 1% of them fail, unless --full is given.
+
+Without --host, a fakeflicd is started on a background thread, so the generator can run in CI.
+
+Usage:
+python3 flicload.py --host localhost --clients 16 --start-rate 100 --max-rate 20000 --report load.json
+python3 flicload.py --fake-verified 20 --step-seconds 2
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import fliclib
+
+OPERATIONS = ("ping", "button_info", "channel", "scanner")
+
+def _percentile(sorted_values, q):
+	if len(sorted_values) == 0:
+		return None
+	return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class StepResult:
+	"""StepResult class.
+
+	Latencies (seconds), errors and timeouts per operation for the commands issued during one step of the ramp.
+	"""
+
+	def __init__(self, target_rate):
+		self.target_rate = target_rate
+		self.duration = 0
+		self.issued = Counter()
+		self.latencies = dict((op, []) for op in OPERATIONS)
+		self.errors = dict((op, Counter()) for op in OPERATIONS)
+		self.timeouts = Counter()
+		self.open_channels = 0
+		self.open_scanners = 0
+
+	def to_dict(self):
+		operations = {}
+		for op in OPERATIONS:
+			if self.issued[op] == 0:
+				continue
+			latencies = sorted(self.latencies[op])
+			operations[op] = {
+				"issued": self.issued[op],
+				"completed": len(latencies),
+				"errors": dict(self.errors[op]),
+				"timeouts": self.timeouts[op],
+				"p50_ms": _ms(_percentile(latencies, 0.5)),
+				"p95_ms": _ms(_percentile(latencies, 0.95)),
+				"p99_ms": _ms(_percentile(latencies, 0.99)),
+				"max_ms": _ms(latencies[-1] if len(latencies) > 0 else None)
+			}
+		return {
+			"target_rate": self.target_rate,
+			"achieved_rate": sum(self.issued.values()) / self.duration if self.duration > 0 else 0,
+			"open_channels": self.open_channels,
+			"open_scanners": self.open_scanners,
+			"operations": operations
+		}
+
+	def failure_ratio(self):
+		issued = sum(self.issued.values())
+		failed = sum(sum(errors.values()) for errors in self.errors.values()) + sum(self.timeouts.values())
+		return failed / issued if issued > 0 else 0
+
+	def worst_p99(self):
+		values = [_percentile(sorted(latencies), 0.99) for latencies in self.latencies.values() if len(latencies) > 0]
+		return max(values) if len(values) > 0 else None
+
+def _ms(seconds):
+	return None if seconds is None else round(seconds * 1000, 3)
+
+class LoadClient:
+	"""LoadClient class.
+
+	One FlicClient, with its handle_events() running on its own thread, that issues the commands of the load generator.
+	"""
+
+	def __init__(self, create_client, verified_buttons, unverified_ratio = 0.1, max_channels = 500, max_scanners = 8):
+		self.client = create_client()
+		self.verified_buttons = verified_buttons
+		self.unverified_ratio = unverified_ratio
+		self.max_channels = max_channels
+		self.max_scanners = max_scanners
+		self._lock = threading.Lock()
+		self._pending = {}
+		self._next_token = 0
+		self._channels = deque()
+		self._scanners = deque()
+		self._thread = threading.Thread(target=self.client.handle_events, daemon=True)
+		self._thread.start()
+
+	@property
+	def open_channels(self):
+		return len(self._channels)
+
+	@property
+	def open_scanners(self):
+		return len(self._scanners)
+
+	def issue(self, op, step):
+		with self._lock:
+			token = self._next_token
+			self._next_token += 1
+			self._pending[token] = (op, step, time.perf_counter())
+		step.issued[op] += 1
+		if op == "ping":
+			self.client.ping(lambda: self._complete(token))
+		elif op == "button_info":
+			self.client.get_button_info(self._random_verified_button(), lambda *response: self._complete(token))
+		elif op == "channel":
+			self._create_channel(token)
+		elif op == "scanner":
+			scanner = fliclib.ButtonScanner()
+			self.client.add_scanner(scanner)
+			self._scanners.append(scanner)
+			if len(self._scanners) > self.max_scanners:
+				self.client.remove_scanner(self._scanners.popleft())
+			self.client.ping(lambda: self._complete(token))
+		else:
+			raise ValueError("Unknown operation " + op)
+
+	def expire(self, step):
+		"""Count the commands of step that are still unanswered as timeouts."""
+		with self._lock:
+			for token, (op, pending_step, start) in list(self._pending.items()):
+				if pending_step is step:
+					del self._pending[token]
+					step.timeouts[op] += 1
+
+	def close(self):
+		self.client.close()
+		self._thread.join()
+
+	def _random_verified_button(self):
+		if len(self.verified_buttons) == 0:
+			return "00:00:00:00:00:00"
+		return random.choice(self.verified_buttons)
+
+	def _create_channel(self, token):
+		verified = len(self.verified_buttons) > 0 and random.random() >= self.unverified_ratio
+		if verified:
+			bd_addr = self._random_verified_button()
+		else:
+			bd_addr = "0a:%02x:%02x:%02x:%02x:%02x" % tuple(random.getrandbits(8) for i in range(5))
+		channel = fliclib.ButtonConnectionChannel(bd_addr)
+		def on_response(channel, error, connection_status):
+			self._complete(token, error)
+			if not verified or error != fliclib.CreateConnectionChannelError.NoError:
+				self.client.remove_connection_channel(channel)
+		channel.on_create_connection_channel_response = on_response
+		self.client.add_connection_channel(channel)
+		if verified:
+			self._channels.append(channel)
+			if len(self._channels) > self.max_channels:
+				self.client.remove_connection_channel(self._channels.popleft())
+
+	def _complete(self, token, error = None):
+		end = time.perf_counter()
+		with self._lock:
+			pending = self._pending.pop(token, None)
+		if pending is None:
+			return # Already counted as a timeout
+		op, step, start = pending
+		if error is not None and error != fliclib.CreateConnectionChannelError.NoError:
+			step.errors[op][getattr(error, "name", str(error))] += 1
+		else:
+			step.latencies[op].append(end - start)
+
+class LoadGenerator:
+	"""LoadGenerator class.
+
+	create_client is called once per client connection and must return a new fliclib.FlicClient.
+	weights maps the names in OPERATIONS to their relative frequency.
+	"""
+
+	def __init__(self, create_client, nb_clients = 4, weights = None, unverified_ratio = 0.1, max_channels = 500, max_scanners = 8):
+		self.create_client = create_client
+		self.nb_clients = nb_clients
+		self.weights = weights if weights is not None else {"ping": 4, "button_info": 2, "channel": 2, "scanner": 1}
+		self.unverified_ratio = unverified_ratio
+		self.max_channels = max_channels
+		self.max_scanners = max_scanners
+		self.info = None
+		self.clients = []
+
+	def start(self):
+		"""Connect the clients. Returns the get_info response of the server."""
+		probe = self.create_client()
+		thread = threading.Thread(target=probe.handle_events, daemon=True)
+		thread.start()
+		info_received = threading.Event()
+		def on_info(info):
+			self.info = info
+			info_received.set()
+		probe.get_info(on_info)
+		if not info_received.wait(10):
+			probe.close()
+			raise RuntimeError("No response to get_info from the server")
+		probe.close()
+		thread.join()
+
+		verified_buttons = list(self.info["bd_addr_of_verified_buttons"])
+		for i in range(self.nb_clients):
+			self.clients.append(LoadClient(self.create_client, verified_buttons, self.unverified_ratio, self.max_channels, self.max_scanners))
+		return self.info
+
+	def run_step(self, rate, duration, timeout = 5.0):
+		"""Issue commands at rate per second, over all clients, for duration seconds. Returns a StepResult."""
+		step = StepResult(rate)
+		operations = [op for op in OPERATIONS if self.weights.get(op, 0) > 0]
+		weights = [self.weights[op] for op in operations]
+		interval = 1.0 / rate
+		start = time.perf_counter()
+		next_time = start
+		count = 0
+		while True:
+			now = time.perf_counter()
+			if now - start >= duration:
+				break
+			if now < next_time:
+				time.sleep(min(next_time - now, 0.01))
+				continue
+			# Catch up in a burst if the loop fell behind, as an open loop generator should
+			while next_time <= now:
+				op = random.choices(operations, weights)[0]
+				self.clients[count % len(self.clients)].issue(op, step)
+				count += 1
+				next_time += interval
+		step.duration = time.perf_counter() - start
+
+		deadline = time.perf_counter() + timeout
+		while time.perf_counter() < deadline and any(len(client._pending) > 0 for client in self.clients):
+			time.sleep(0.01)
+		for client in self.clients:
+			client.expire(step)
+		step.open_channels = sum(client.open_channels for client in self.clients)
+		step.open_scanners = sum(client.open_scanners for client in self.clients)
+		return step
+
+	def ramp(self, start_rate, max_rate, factor = 2.0, step_seconds = 5.0, latency_budget = 0.05, full = False, on_step = None):
+		"""Run steps from start_rate up to max_rate, multiplying the rate by factor each time.
+
+		Stops after the first step that exceeds the latency budget (p99, seconds) or fails more than 1% of the commands, unless full.
+		Returns the list of StepResult and the highest rate that stayed within the budget (or None).
+		"""
+		steps = []
+		sustained = None
+		rate = start_rate
+		while rate <= max_rate:
+			step = self.run_step(rate, step_seconds)
+			steps.append(step)
+			if on_step is not None:
+				on_step(step)
+			worst = step.worst_p99()
+			within_budget = (worst is None or worst <= latency_budget) and step.failure_ratio() <= 0.01
+			if within_budget:
+				sustained = rate
+			elif not full:
+				break
+			rate = rate * factor
+		return steps, sustained
+
+	def close(self):
+		for client in self.clients:
+			client.close()
+		self.clients = []
+
+def start_fake_flicd(nb_verified, max_pending_connections = 8, command_delay = 0):
+	"""Run a fakeflicd on a new thread. Returns (flicd, loop, (host, port))."""
+	import fakeflicd
+
+	loop = asyncio.new_event_loop()
+	flicd = fakeflicd.FakeFlicd(["00:00:00:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(1, nb_verified + 1)], max_pending_connections = max_pending_connections, command_delay = command_delay)
+	address = loop.run_until_complete(flicd.start_tcp())
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+	return flicd, loop, address
+
+def _print_step(step):
+	result = step.to_dict()
+	print("rate %8.0f/s  achieved %8.0f/s  channels %5d  scanners %4d" % (step.target_rate, result["achieved_rate"], step.open_channels, step.open_scanners))
+	for op, values in result["operations"].items():
+		errors = ", ".join("%s %d" % item for item in sorted(values["errors"].items()))
+		print("  %-12s %7d issued  p50 %8s  p99 %8s  max %8s ms  timeouts %d%s" % (op, values["issued"], values["p50_ms"], values["p99_ms"], values["max_ms"], values["timeouts"], "  errors: " + errors if errors else ""))
+
+def main():
+	parser = argparse.ArgumentParser(description="Ramp up the command rate against a flicd and report latency and errors.")
+	parser.add_argument("--host", help="flicd host, or unix:/path (default: start a local fakeflicd)")
+	parser.add_argument("--port", type=int, default=5551)
+	parser.add_argument("--clients", type=int, default=4, help="number of client connections")
+	parser.add_argument("--start-rate", type=float, default=100, help="commands per second over all clients in the first step")
+	parser.add_argument("--max-rate", type=float, default=12800)
+	parser.add_argument("--factor", type=float, default=2.0, help="rate multiplier between steps")
+	parser.add_argument("--step-seconds", type=float, default=5.0)
+	parser.add_argument("--latency-budget", type=float, default=50, help="p99 latency budget in milliseconds")
+	parser.add_argument("--full", action="store_true", help="run all steps, even after the budget was exceeded")
+	parser.add_argument("--mix", default="ping=4,button_info=2,channel=2,scanner=1", help="weights of " + ", ".join(OPERATIONS))
+	parser.add_argument("--unverified-ratio", type=float, default=0.1, help="fraction of connection channels to unknown buttons")
+	parser.add_argument("--max-channels", type=int, default=500, help="connection channels kept open per client")
+	parser.add_argument("--max-scanners", type=int, default=8, help="scanners kept open per client")
+	parser.add_argument("--fake-verified", type=int, default=10, help="verified buttons of the local fakeflicd")
+	parser.add_argument("--fake-command-delay", type=float, default=0, help="seconds the local fakeflicd waits before each response")
+	parser.add_argument("--report", help="write the report as JSON to this file")
+	args = parser.parse_args()
+
+	weights = {}
+	for item in args.mix.split(","):
+		name, weight = item.split("=")
+		if name not in OPERATIONS:
+			parser.error("unknown operation in --mix: " + name)
+		weights[name] = float(weight)
+
+	flicd = None
+	if args.host is None:
+		flicd, loop, (host, port) = start_fake_flicd(args.fake_verified, command_delay = args.fake_command_delay)
+		print("Started fakeflicd on %s:%d" % (host, port))
+	else:
+		host, port = args.host, args.port
+
+	generator = LoadGenerator(lambda: fliclib.FlicClient(host, port), args.clients, weights, args.unverified_ratio, args.max_channels, args.max_scanners)
+	info = generator.start()
+	print("%d clients, %d verified buttons, max %d pending connections" % (args.clients, len(info["bd_addr_of_verified_buttons"]), info["max_pending_connections"]))
+	try:
+		steps, sustained = generator.ramp(args.start_rate, args.max_rate, args.factor, args.step_seconds, args.latency_budget / 1000.0, args.full, _print_step)
+	finally:
+		generator.close()
+		if flicd is not None:
+			loop.call_soon_threadsafe(flicd.close)
+
+	if sustained is None:
+		print("The latency budget of %g ms was exceeded at the first step" % args.latency_budget)
+	else:
+		print("Sustained %g commands/s within a p99 of %g ms" % (sustained, args.latency_budget))
+	if args.report:
+		report = {
+			"server": "fakeflicd" if flicd is not None else "%s:%d" % (host, port),
+			"clients": args.clients,
+			"mix": weights,
+			"latency_budget_ms": args.latency_budget,
+			"sustained_rate": sustained,
+			"steps": [step.to_dict() for step in steps]
+		}
+		with open(args.report, "w") as f:
+			json.dump(report, f, indent = 1)
+
+if __name__ == "__main__":
+	main()
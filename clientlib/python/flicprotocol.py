@@ -0,0 +1,1149 @@
+"""Flic protocol core for python
+
+Shared by fliclib (blocking sockets and threads) and aioflic (asyncio).
+This module does no I/O: ProtocolEngine turns received bytes into packets and events, encode_command turns commands into bytes,
+and FlicClientBase keeps the client state and calls the callbacks, leaving the actual reading and writing to a transport adapter.
+
+Notes on the data type used in this python implementation compared to the protocol documentation:
+All kind of integers are represented as python integers.
+Booleans use the Boolean type.
+Enums use the defined python enums below.
+Bd addr are represented as standard python strings, e.g. "aa:bb:cc:dd:ee:ff".
+
+If the optional _flicaccel extension module has been built (run make in this directory), packet splitting,
+event unpacking and bd addr formatting are done in C, with identical results. Set the environment variable
+FLICLIB_NO_ACCEL to use the pure python implementation anyway. ACCELERATED tells which one is in use.
+"""
+
+from abc import ABCMeta, abstractmethod
+from enum import Enum, IntEnum
+from collections import namedtuple, deque
+import array
+import os
+import struct
+import itertools
+import threading
+import time
+
+try:
+	if os.environ.get("FLICLIB_NO_ACCEL"):
+		raise ImportError("disabled by FLICLIB_NO_ACCEL")
+	import _flicaccel
+except ImportError:
+	_flicaccel = None
+
+class CreateConnectionChannelError(Enum):
+	NoError = 0
+	MaxPendingConnectionsReached = 1
+
+class ConnectionStatus(Enum):
+	Disconnected = 0
+	Connected = 1
+	Ready = 2
+
+class DisconnectReason(Enum):
+	Unspecified = 0
+	ConnectionEstablishmentFailed = 1
+	TimedOut = 2
+	BondingKeysMismatch = 3
+
+class RemovedReason(Enum):
+	RemovedByThisClient = 0
+	ForceDisconnectedByThisClient = 1
+	ForceDisconnectedByOtherClient = 2
+	
+	ButtonIsPrivate = 3
+	VerifyTimeout = 4
+	InternetBackendError = 5
+	InvalidData = 6
+	
+	CouldntLoadDevice = 7
+	
+	DeletedByThisClient = 8
+	DeletedByOtherClient = 9
+	ButtonBelongsToOtherPartner = 10
+	DeletedFromButton = 11
+
+class ClickType(Enum):
+	ButtonDown = 0
+	ButtonUp = 1
+	ButtonClick = 2
+	ButtonSingleClick = 3
+	ButtonDoubleClick = 4
+	ButtonHold = 5
+
+class BdAddrType(Enum):
+	PublicBdAddrType = 0
+	RandomBdAddrType = 1
+
+class LatencyMode(Enum):
+	NormalLatency = 0
+	LowLatency = 1
+	HighLatency = 2
+
+class BluetoothControllerState(Enum):
+	Detached = 0
+	Resetting = 1
+	Attached = 2
+
+class ScanWizardResult(Enum):
+	WizardSuccess = 0
+	WizardCancelledByUser = 1
+	WizardFailedTimeout = 2
+	WizardButtonIsPrivate = 3
+	WizardBluetoothUnavailable = 4
+	WizardInternetBackendError = 5
+	WizardInvalidData = 6
+	WizardButtonBelongsToOtherPartner = 7
+	WizardButtonAlreadyConnectedToOtherDevice = 8
+
+_ENUM_CLASSES = (CreateConnectionChannelError, ConnectionStatus, DisconnectReason, RemovedReason, ClickType, BdAddrType, LatencyMode, BluetoothControllerState, ScanWizardResult)
+
+ENUM_VALUES = ("enum", "int", "intenum")
+
+_INT_ENUMS = {}
+
+def int_enum(enum_class):
+	"""Returns the IntEnum with the same names and values as one of the enums above, as delivered in the "intenum" mode."""
+	if enum_class not in _INT_ENUMS:
+		_INT_ENUMS[enum_class] = IntEnum(enum_class.__name__, [(x.name, x.value) for x in enum_class], module=__name__)
+	return _INT_ENUMS[enum_class]
+
+def _enum_table(enum_class):
+	table = [None] * (max(x.value for x in enum_class) + 1)
+	for x in enum_class:
+		table[x.value] = x
+	return tuple(table)
+
+_ENUM_TABLES = {"enum": dict((x, _enum_table(x)) for x in _ENUM_CLASSES)}
+
+def enum_tables(enum_values = "enum"):
+	"""Returns the lookup tables that decode_event uses to convert enum codes, for one of the modes in ENUM_VALUES.
+	
+	"enum" gives the enums above, "int" the raw integer codes and "intenum" the members of int_enum(enum_class),
+	which compare equal to the integer codes.
+	"""
+	if enum_values not in ENUM_VALUES:
+		raise ValueError("enum_values must be one of " + ", ".join(ENUM_VALUES))
+	if enum_values not in _ENUM_TABLES:
+		if enum_values == "int":
+			codes = tuple(range(256))
+			_ENUM_TABLES["int"] = dict((x, codes) for x in _ENUM_CLASSES)
+		else:
+			_ENUM_TABLES["intenum"] = dict((x, _enum_table(int_enum(x))) for x in _ENUM_CLASSES)
+	return _ENUM_TABLES[enum_values]
+
+def _to_enum(tables, enum_class, value):
+	table = tables[enum_class]
+	if value < len(table) and table[value] is not None:
+		return table[value]
+	return enum_class(value) # Raises ValueError for unknown codes
+
+def _unhandled(*args):
+	"""The default of all callbacks. Events that would only reach this function are skipped without being decoded."""
+	pass
+
+class _CallbackOwner:
+	"""Base of the classes with callbacks that a client can skip. Assigning a callback makes the client rebuild its subscription registry."""
+	
+	_client = None
+	
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		client = self._client
+		if name.startswith("on_") and client is not None:
+			with client._lock:
+				client._subscriptions = None
+
+class ButtonScanner(_CallbackOwner):
+	"""ButtonScanner class.
+	
+	Usage:
+	scanner = ButtonScanner()
+	scanner.on_advertisement_packet = lambda scanner, bd_addr, name, rssi, is_private, already_verified, already_connected_to_this_device, already_connected_to_other_device: ...
+	client.add_scanner(scanner)
+	"""
+	
+	_cnt = itertools.count()
+	
+	def __init__(self):
+		self._scan_id = next(ButtonScanner._cnt)
+		self.on_advertisement_packet = _unhandled
+
+class ScanWizard:
+	"""ScanWizard class
+	
+	Usage:
+	wizard = ScanWizard()
+	wizard.on_found_private_button = lambda scan_wizard: ...
+	wizard.on_found_public_button = lambda scan_wizard, bd_addr, name: ...
+	wizard.on_button_connected = lambda scan_wizard, bd_addr, name: ...
+	wizard.on_completed = lambda scan_wizard, result, bd_addr, name: ...
+	client.add_scan_wizard(wizard)
+	"""
+	
+	_cnt = itertools.count()
+	
+	def __init__(self):
+		self._scan_wizard_id = next(ScanWizard._cnt)
+		self._bd_addr = None
+		self._name = None
+		self.on_found_private_button = _unhandled
+		self.on_found_public_button = _unhandled
+		self.on_button_connected = _unhandled
+		self.on_completed = _unhandled
+
+class BatteryStatusListener(_CallbackOwner):
+	"""BatteryStatusListener class
+	
+	Usage:
+	listener = BatteryStatusListener(bd_addr)
+	listener.on_battery_status = lambda battery_status_listener, bd_addr, battery_percentage, timestamp: ...
+	client.add_battery_status_listener(listener)
+	"""
+	
+	_cnt = itertools.count()
+	
+	def __init__(self, bd_addr):
+		self._listener_id = next(BatteryStatusListener._cnt)
+		self._bd_addr = bd_addr
+		self.on_battery_status = _unhandled
+	
+	@property
+	def bd_addr(self):
+		return self._bd_addr
+
+class ButtonConnectionChannel(_CallbackOwner):
+	"""ButtonConnectionChannel class.
+	
+	This class represents a connection channel to a Flic button.
+	Add this button connection channel to a FlicClient by executing client.add_connection_channel(connection_channel).
+	You may only have this connection channel added to one FlicClient at a time.
+	
+	Before you add the connection channel to the client, you should set up your callback functions by assigning
+	the corresponding properties to this object with a function. Each callback function has a channel parameter as the first one,
+	referencing this object.
+	
+	Available properties and the function parameters are:
+	on_create_connection_channel_response: channel, error, connection_status
+	on_removed: channel, removed_reason
+	on_connection_status_changed: channel, connection_status, disconnect_reason
+	on_button_up_or_down / on_button_click_or_hold / on_button_single_or_double_click / on_button_single_or_double_click_or_hold: channel, click_type, was_queued, time_diff
+	"""
+	
+	_cnt = itertools.count()
+	
+	def __init__(self, bd_addr, latency_mode = LatencyMode.NormalLatency, auto_disconnect_time = 511):
+		self._conn_id = next(ButtonConnectionChannel._cnt)
+		self._bd_addr = bd_addr
+		self._latency_mode = latency_mode
+		self._auto_disconnect_time = auto_disconnect_time
+		self._client = None
+		
+		self.on_create_connection_channel_response = _unhandled
+		self.on_removed = _unhandled
+		self.on_connection_status_changed = _unhandled
+		self.on_button_up_or_down = _unhandled
+		self.on_button_click_or_hold = _unhandled
+		self.on_button_single_or_double_click = _unhandled
+		self.on_button_single_or_double_click_or_hold = _unhandled
+	
+	@property
+	def bd_addr(self):
+		return self._bd_addr
+	
+	@property
+	def latency_mode(self):
+		return self._latency_mode
+	
+	@latency_mode.setter
+	def latency_mode(self, latency_mode):
+		if self._client is None:
+			self._latency_mode = latency_mode
+			return
+		
+		with self._client._lock:
+			previous = self._latency_mode
+			self._latency_mode = latency_mode
+			if not self._client._closed:
+				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time},
+					lambda: object.__setattr__(self, "_latency_mode", previous))
+	
+	@property
+	def auto_disconnect_time(self):
+		return self._auto_disconnect_time
+	
+	@auto_disconnect_time.setter
+	def auto_disconnect_time(self, auto_disconnect_time):
+		if self._client is None:
+			self._auto_disconnect_time = auto_disconnect_time
+			return
+		
+		with self._client._lock:
+			previous = self._auto_disconnect_time
+			self._auto_disconnect_time = auto_disconnect_time
+			if not self._client._closed:
+				self._client._send_command("CmdChangeModeParameters", {"conn_id": self._conn_id, "latency_mode": self._latency_mode, "auto_disconnect_time": self._auto_disconnect_time},
+					lambda: object.__setattr__(self, "_auto_disconnect_time", previous))
+
+_EVENTS = [
+	("EvtAdvertisementPacket", "<I6s17pb????", "scan_id bd_addr name rssi is_private already_verified already_connected_to_this_device already_connected_to_other_device"),
+	("EvtCreateConnectionChannelResponse", "<IBB", "conn_id error connection_status"),
+	("EvtConnectionStatusChanged", "<IBB", "conn_id connection_status disconnect_reason"),
+	("EvtConnectionChannelRemoved", "<IB", "conn_id removed_reason"),
+	("EvtButtonUpOrDown", "<IBBI", "conn_id click_type was_queued time_diff"),
+	("EvtButtonClickOrHold", "<IBBI", "conn_id click_type was_queued time_diff"),
+	("EvtButtonSingleOrDoubleClick", "<IBBI", "conn_id click_type was_queued time_diff"),
+	("EvtButtonSingleOrDoubleClickOrHold", "<IBBI", "conn_id click_type was_queued time_diff"),
+	("EvtNewVerifiedButton", "<6s", "bd_addr"),
+	("EvtGetInfoResponse", "<B6sBBhBBH", "bluetooth_controller_state my_bd_addr my_bd_addr_type max_pending_connections max_concurrently_connected_buttons current_pending_connections currently_no_space_for_new_connection nb_verified_buttons"),
+	("EvtNoSpaceForNewConnection", "<B", "max_concurrently_connected_buttons"),
+	("EvtGotSpaceForNewConnection", "<B", "max_concurrently_connected_buttons"),
+	("EvtBluetoothControllerStateChange", "<B", "state"),
+	("EvtPingResponse", "<I", "ping_id"),
+	("EvtGetButtonInfoResponse", "<6s16s17p17pBI", "bd_addr uuid color serial_number flic_version firmware_version"),
+	("EvtScanWizardFoundPrivateButton", "<I", "scan_wizard_id"),
+	("EvtScanWizardFoundPublicButton", "<I6s17p", "scan_wizard_id bd_addr name"),
+	("EvtScanWizardButtonConnected", "<I", "scan_wizard_id"),
+	("EvtScanWizardCompleted", "<IB", "scan_wizard_id result"),
+	("EvtButtonDeleted", "<6s?", "bd_addr deleted_by_this_client"),
+	("EvtBatteryStatus", "<Ibq", "listener_id battery_percentage timestamp")
+]
+
+_COMMANDS = [
+	("CmdGetInfo", "", ""),
+	("CmdCreateScanner", "<I", "scan_id"),
+	("CmdRemoveScanner", "<I", "scan_id"),
+	("CmdCreateConnectionChannel", "<I6sBh", "conn_id bd_addr latency_mode auto_disconnect_time"),
+	("CmdRemoveConnectionChannel", "<I", "conn_id"),
+	("CmdForceDisconnect", "<6s", "bd_addr"),
+	("CmdChangeModeParameters", "<IBh", "conn_id latency_mode auto_disconnect_time"),
+	("CmdPing", "<I", "ping_id"),
+	("CmdGetButtonInfo", "<6s", "bd_addr"),
+	("CmdCreateScanWizard", "<I", "scan_wizard_id"),
+	("CmdCancelScanWizard", "<I", "scan_wizard_id"),
+	("CmdDeleteButton", "<6s", "bd_addr"),
+	("CmdCreateBatteryStatusListener", "<I6s", "listener_id bd_addr"),
+	("CmdRemoveBatteryStatusListener", "<I", "listener_id")
+]
+
+class _LazyTable:
+	"""Read-only list of entries built from the rows of a table when first accessed.
+	
+	Used for the namedtuple classes, which are comparatively expensive to create and not needed for decoding, to keep the import fast.
+	"""
+	
+	def __init__(self, rows, build):
+		self._rows = rows
+		self._build = build
+		self._entries = {}
+	
+	def __len__(self):
+		return len(self._rows)
+	
+	def __getitem__(self, index):
+		if index not in self._entries:
+			row = self._rows[index]
+			self._entries[index] = None if row == None else self._build(row)
+		return self._entries[index]
+
+_EVENT_STRUCTS = list(map(lambda x: None if x == None else struct.Struct(x[1]), _EVENTS))
+_EVENT_FIELDS = list(map(lambda x: None if x == None else tuple(x[2].split()), _EVENTS))
+_EVENT_NAMED_TUPLES = _LazyTable(_EVENTS, lambda x: namedtuple(x[0], x[2]))
+_EVENT_NAME_TO_OPCODE = dict((x[0], i) for i, x in enumerate(_EVENTS))
+
+_COMMAND_STRUCTS = list(map(lambda x: struct.Struct(x[1]), _COMMANDS))
+_COMMAND_FIELDS = list(map(lambda x: tuple(x[2].split()), _COMMANDS))
+_COMMAND_NAMED_TUPLES = _LazyTable(_COMMANDS, lambda x: namedtuple(x[0], x[2]))
+_COMMAND_NAME_TO_OPCODE = dict((x[0], i) for i, x in enumerate(_COMMANDS))
+
+# Events whose only effect is calling one callback, and where to find it: (event name, registry attribute of the client
+# or None for the client itself, callback name or None if the event has no callback). These are skipped when nobody handles them.
+_SKIPPABLE_EVENTS = [
+	("EvtAdvertisementPacket", "_scanners", "on_advertisement_packet"),
+	("EvtConnectionStatusChanged", "_connection_channels", "on_connection_status_changed"),
+	("EvtButtonUpOrDown", "_connection_channels", "on_button_up_or_down"),
+	("EvtButtonClickOrHold", "_connection_channels", "on_button_click_or_hold"),
+	("EvtButtonSingleOrDoubleClick", "_connection_channels", "on_button_single_or_double_click"),
+	("EvtButtonSingleOrDoubleClickOrHold", "_connection_channels", "on_button_single_or_double_click_or_hold"),
+	("EvtNoSpaceForNewConnection", None, "on_no_space_for_new_connection"),
+	("EvtGotSpaceForNewConnection", None, "on_got_space_for_new_connection"),
+	("EvtBluetoothControllerStateChange", None, "on_bluetooth_controller_state_change"),
+	("EvtPingResponse", "_ping_callbacks", None),
+	("EvtBatteryStatus", "_battery_status_listeners", "on_battery_status")
+]
+
+_BUTTON_EVENTS = frozenset(["EvtButtonUpOrDown", "EvtButtonClickOrHold", "EvtButtonSingleOrDoubleClick", "EvtButtonSingleOrDoubleClickOrHold"])
+
+def _py_bdaddr_bytes_to_string(bdaddr_bytes):
+	return "%02x:%02x:%02x:%02x:%02x:%02x" % tuple(reversed(bdaddr_bytes))
+
+def _py_split_packets(buffer):
+	"""Returns (packets, consumed) for the complete length prefixed packets at the start of buffer."""
+	packets = []
+	pos = 0
+	end = len(buffer)
+	while end - pos >= 2:
+		packet_len = buffer[pos] | (buffer[pos + 1] << 8)
+		if end - pos - 2 < packet_len:
+			break
+		packets.append(bytes(buffer[pos + 2 : pos + 2 + packet_len]))
+		pos += 2 + packet_len
+	return packets, pos
+
+def _py_unpack_event(data):
+	"""Returns (opcode, items) with the raw fields of an event packet, or None if the opcode is unknown or the packet is too short."""
+	if len(data) == 0:
+		return None
+	opcode = data[0]
+	
+	if opcode >= len(_EVENTS) or _EVENTS[opcode] == None:
+		return None
+	
+	event_struct = _EVENT_STRUCTS[opcode]
+	if len(data) - 1 < event_struct.size:
+		return None
+	return opcode, dict(zip(_EVENT_FIELDS[opcode], event_struct.unpack_from(data, 1)))
+
+if _flicaccel is not None:
+	_flicaccel.configure(_EVENTS)
+	bdaddr_bytes_to_string = _flicaccel.bdaddr_bytes_to_string
+	_split_packets = _flicaccel.split_packets
+	_unpack_event = _flicaccel.unpack_event
+else:
+	bdaddr_bytes_to_string = _py_bdaddr_bytes_to_string
+	_split_packets = _py_split_packets
+	_unpack_event = _py_unpack_event
+
+ACCELERATED = _flicaccel is not None
+
+def bdaddr_string_to_bytes(bdaddr_string):
+	return bytearray.fromhex("".join(reversed(bdaddr_string.split(":"))))
+
+def encode_command(name, items):
+	"""Encode a command, including its length prefix.
+	
+	items is a dictionary with the fields of the command. Enum values are converted to their integer values and bd addr strings to bytes.
+	"""
+	for key, value in items.items():
+		if isinstance(value, Enum):
+			items[key] = value.value
+	
+	if "bd_addr" in items:
+		items["bd_addr"] = bdaddr_string_to_bytes(items["bd_addr"])
+	
+	opcode = _COMMAND_NAME_TO_OPCODE[name]
+	data_bytes = _COMMAND_STRUCTS[opcode].pack(*[items[name] for name in _COMMAND_FIELDS[opcode]])
+	bytes = bytearray(3)
+	bytes[0] = (len(data_bytes) + 1) & 0xff
+	bytes[1] = (len(data_bytes) + 1) >> 8
+	bytes[2] = opcode
+	bytes += data_bytes
+	return bytes
+
+def decode_event(data, tables = None):
+	"""Decode an event packet (without its length prefix).
+	
+	Returns a tuple (event_name, items) where items is a dictionary with the fields of the event,
+	or None if the opcode is unknown or the packet is too short.
+	Enum codes are converted with tables, as returned by enum_tables(); by default to the enums above.
+	"""
+	unpacked = _unpack_event(data)
+	if unpacked is None:
+		return None
+	opcode, items = unpacked
+	event_name = _EVENTS[opcode][0]
+	if tables is None:
+		tables = _ENUM_TABLES["enum"]
+	
+	# Process some kind of items whose data type is not supported by struct
+	if "bd_addr" in items:
+		items["bd_addr"] = bdaddr_bytes_to_string(items["bd_addr"])
+	
+	if "name" in items:
+		items["name"] = items["name"].decode("utf-8")
+	
+	if event_name == "EvtCreateConnectionChannelResponse":
+		items["error"] = _to_enum(tables, CreateConnectionChannelError, items["error"])
+		items["connection_status"] = _to_enum(tables, ConnectionStatus, items["connection_status"])
+	
+	if event_name == "EvtConnectionStatusChanged":
+		items["connection_status"] = _to_enum(tables, ConnectionStatus, items["connection_status"])
+		items["disconnect_reason"] = _to_enum(tables, DisconnectReason, items["disconnect_reason"])
+	
+	if event_name == "EvtConnectionChannelRemoved":
+		items["removed_reason"] = _to_enum(tables, RemovedReason, items["removed_reason"])
+	
+	if event_name in _BUTTON_EVENTS:
+		items["click_type"] = _to_enum(tables, ClickType, items["click_type"])
+	
+	if event_name == "EvtGetInfoResponse":
+		items["bluetooth_controller_state"] = _to_enum(tables, BluetoothControllerState, items["bluetooth_controller_state"])
+		items["my_bd_addr"] = bdaddr_bytes_to_string(items["my_bd_addr"])
+		items["my_bd_addr_type"] = _to_enum(tables, BdAddrType, items["my_bd_addr_type"])
+		
+		pos = 1 + _EVENT_STRUCTS[opcode].size
+		if len(data) - pos < 6 * items["nb_verified_buttons"]:
+			return None
+		bd_addrs = struct.unpack_from("<" + "6s" * items["nb_verified_buttons"], data, pos)
+		items["bd_addr_of_verified_buttons"] = list(map(bdaddr_bytes_to_string, bd_addrs))
+	
+	if event_name == "EvtBluetoothControllerStateChange":
+		items["state"] = _to_enum(tables, BluetoothControllerState, items["state"])
+	
+	if event_name == "EvtGetButtonInfoResponse":
+		items["uuid"] = "".join(map(lambda x: "%02x" % x, items["uuid"]))
+		if items["uuid"] == "00000000000000000000000000000000":
+			items["uuid"] = None
+		items["color"] = items["color"].decode("utf-8")
+		if items["color"] == "":
+			items["color"] = None
+		items["serial_number"] = items["serial_number"].decode("utf-8")
+		if items["serial_number"] == "":
+			items["serial_number"] = None
+	
+	if event_name == "EvtScanWizardCompleted":
+		items["result"] = _to_enum(tables, ScanWizardResult, items["result"])
+	
+	return event_name, items
+
+class ProtocolEngine:
+	"""ProtocolEngine class.
+	
+	Sans-I/O framing of the Flic protocol. Feed it whatever bytes arrive from the server, in any chunk sizes,
+	and it returns the complete packets (or decoded events) that they finish.
+	
+	Usage:
+	engine = ProtocolEngine()
+	for event_name, items in engine.receive_events(data):
+		...
+	transport.write(engine.encode_command("CmdPing", {"ping_id": 1}))
+	
+	enum_values selects how receive_events delivers enum fields, see enum_tables().
+	"""
+	
+	def __init__(self, enum_values = "enum"):
+		self._buffer = bytearray()
+		self._enum_tables = enum_tables(enum_values)
+	
+	@property
+	def buffered_bytes(self):
+		"""Number of received bytes that don't form a complete packet yet."""
+		return len(self._buffer)
+	
+	def receive_packets(self, data):
+		"""Returns a list of the complete packets (without length prefix) ending in data."""
+		buffer = self._buffer
+		buffer += data
+		packets, pos = _split_packets(buffer)
+		del buffer[:pos]
+		return packets
+	
+	def receive_events(self, data):
+		"""Returns a list of (event_name, items) tuples for the complete packets ending in data. Undecodable packets are skipped."""
+		events = []
+		for packet in self.receive_packets(data):
+			event = decode_event(packet, self._enum_tables)
+			if event is not None:
+				events.append(event)
+		return events
+	
+	def encode_command(self, name, items):
+		"""Encode a command, including its length prefix."""
+		return encode_command(name, items)
+
+class _NullLock:
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		return False
+
+class FlightRecorder:
+	"""FlightRecorder class.
+	
+	Always-on ring buffer of the last size packets (events and commands, without length prefix) with their monotonic timestamps,
+	kept in preallocated slots of slot_size bytes, so recording a packet allocates nothing. Longer packets are truncated to slot_size bytes.
+	
+	frames() returns the recorded packets, oldest first, as (timestamp, direction, data) tuples like flicrecord.read_frames,
+	and dump(path) writes them as a flicrecord log, which can be inspected with "python3 flicrecord.py dump".
+	If dump_path is set, a dump is written there (with "%d" replaced by the process id and "%t" by the time) when an exception is raised
+	while dispatching an event, and when the signal given to dump_on_signal() arrives.
+	"""
+	
+	EVENT = 0
+	COMMAND = 1
+	
+	def __init__(self, size = 256, slot_size = 64, dump_path = None):
+		self.size = size
+		self.slot_size = slot_size
+		self.dump_path = dump_path
+		self.dumps = 0
+		self._data = bytearray(size * slot_size)
+		self._timestamps = array.array("d", bytes(8 * size))
+		self._lengths = array.array("H", bytes(2 * size))
+		self._directions = bytearray(size)
+		# Events and commands are recorded from different threads. Reentrant, since the dump_on_signal handler may interrupt record()
+		self._lock = threading.RLock()
+		self._count = 0
+	
+	def record_event(self, data):
+		self.record(FlightRecorder.EVENT, data)
+	
+	def record_command(self, data):
+		self.record(FlightRecorder.COMMAND, data)
+	
+	def record(self, direction, data):
+		slot_size = self.slot_size
+		length = len(data)
+		timestamp = time.monotonic()
+		with self._lock:
+			slot = self._count % self.size
+			offset = slot * slot_size
+			if length > slot_size:
+				self._data[offset:offset + slot_size] = data[:slot_size]
+			else:
+				self._data[offset:offset + length] = data
+			self._timestamps[slot] = timestamp
+			self._lengths[slot] = min(length, 0xffff)
+			self._directions[slot] = direction
+			self._count += 1
+	
+	def frames(self):
+		"""The recorded packets, oldest first, as a list of (timestamp, direction, data) tuples."""
+		frames = []
+		with self._lock:
+			count = self._count
+			for index in range(max(0, count - self.size), count):
+				slot = index % self.size
+				offset = slot * self.slot_size
+				frames.append((self._timestamps[slot], self._directions[slot], bytes(self._data[offset:offset + min(self._lengths[slot], self.slot_size)])))
+		return frames
+	
+	def dump(self, path = None):
+		"""Write the recorded packets to a flicrecord log at path (by default dump_path). Returns the path."""
+		import flicrecord
+		
+		if path is None:
+			path = self.dump_path
+		if path is None:
+			raise ValueError("No path given to dump() and no dump_path set")
+		path = path.replace("%d", str(os.getpid())).replace("%t", time.strftime("%Y%m%d-%H%M%S"))
+		flicrecord.write_frames(path, self.frames())
+		self.dumps += 1
+		return path
+	
+	def dump_on_signal(self, signum = None):
+		"""Dump to dump_path whenever the process receives signum (by default SIGUSR1). Must be called on the main thread."""
+		import signal
+		
+		if self.dump_path is None:
+			raise ValueError("dump_on_signal needs dump_path to be set")
+		signal.signal(signum if signum is not None else signal.SIGUSR1, lambda signum, frame: self.dump())
+	
+	def _dispatch_failed(self):
+		if self.dump_path is not None:
+			self.dump()
+
+class FlicClientBase(metaclass=ABCMeta):
+	"""Common part of the Flic clients.
+	
+	Keeps track of scanners, scan wizards, connection channels and battery status listeners, wraps all commands
+	and dispatches events to the callbacks. A transport adapter subclass must set self._lock (a reentrant lock, or _NullLock()
+	if everything runs on one thread), implement _write(data) and run_on_handle_events_thread(callback),
+	and pass every received packet to _dispatch_event. _write may refuse the commands by raising BlockingIOError, in which case
+	the state changes made for them (such as a registered connection channel or a queued response callback) are undone.
+	The transport calls _commands_written(data) with the commands it actually writes, so that only those are recorded.
+	
+	Other events are handled by the following callback functions that can be assigned to this object (and a list of the callback function parameters):
+	on_new_verified_button: bd_addr
+	on_no_space_for_new_connection: max_concurrently_connected_buttons
+	on_got_space_for_new_connection: max_concurrently_connected_buttons
+	on_bluetooth_controller_state_change: state
+	on_button_deleted: bd_addr, deleted_by_this_client
+	on_get_info: info (for get_info calls without callback)
+	
+	flight_recorder is a FlightRecorder of the last flight_recorder_size packets, or None if flight_recorder_size is 0.
+	
+	Events that only would reach a callback that has not been assigned are skipped right after reading the opcode
+	(and the connection channel, scanner or listener id), without being decoded. skipped_events tells how many were skipped.
+	
+	The registries of scanners, scan wizards, connection channels and battery status listeners are copied on write:
+	they are only replaced as a whole, under self._lock, and never changed in place, so _dispatch_event reads them without taking the lock.
+	This keeps the client correct on free-threaded (no GIL) builds of python as well.
+	A transport adapter may set _channel_callback_executor to a function (key, callback, args) to run the callbacks of connection channels
+	on other threads. All callbacks of one connection channel are given the same key (its conn_id), so that they can be kept in order.
+	
+	By default enum fields are given to the callbacks as the enums of this module. Set enum_values to "int" to get the raw integer codes instead,
+	or to "intenum" to get IntEnum members that also compare equal to the codes (see enum_tables()).
+	"""
+	
+	_EVENTS = _EVENTS
+	_EVENT_STRUCTS = _EVENT_STRUCTS
+	_EVENT_NAMED_TUPLES = _EVENT_NAMED_TUPLES
+	
+	_COMMANDS = _COMMANDS
+	_COMMAND_STRUCTS = _COMMAND_STRUCTS
+	_COMMAND_NAMED_TUPLES = _COMMAND_NAMED_TUPLES
+	_COMMAND_NAME_TO_OPCODE = _COMMAND_NAME_TO_OPCODE
+	
+	_bdaddr_bytes_to_string = staticmethod(bdaddr_bytes_to_string)
+	_bdaddr_string_to_bytes = staticmethod(bdaddr_string_to_bytes)
+	_encode_command = staticmethod(encode_command)
+	
+	flight_recorder_size = 256
+	
+	def __init__(self):
+		self._lock = _NullLock()
+		self._scanners = {}
+		self._scan_wizards = {}
+		self._connection_channels = {}
+		self._battery_status_listeners = {}
+		self._get_info_response_queue = deque()
+		self._get_button_info_queue = deque()
+		self._ping_callbacks = {}
+		self._ping_ids = itertools.count(1)
+		self._button_info_cache = {}
+		self._closed = False
+		self._recorder = None
+		self.flight_recorder = FlightRecorder(self.flight_recorder_size) if self.flight_recorder_size > 0 else None
+		self._enum_values = "enum"
+		self._enum_tables = enum_tables("enum")
+		self._subscriptions = None
+		self._skipped = [0] * len(_EVENTS)
+		self._channel_callback_executor = None
+		
+		self.on_new_verified_button = _unhandled
+		self.on_no_space_for_new_connection = _unhandled
+		self.on_got_space_for_new_connection = _unhandled
+		self.on_bluetooth_controller_state_change = _unhandled
+		self.on_button_deleted = _unhandled
+		self.on_get_info = _unhandled
+	
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		if name.startswith("on_"):
+			with self._lock:
+				object.__setattr__(self, "_subscriptions", None)
+	
+	@property
+	def skipped_events(self):
+		"""A dictionary event name -> number of events of that kind that were skipped because nothing handled them."""
+		return dict((_EVENTS[opcode][0], count) for opcode, count in enumerate(self._skipped) if count > 0)
+	
+	@property
+	def enum_values(self):
+		return self._enum_values
+	
+	@enum_values.setter
+	def enum_values(self, enum_values):
+		self._enum_tables = enum_tables(enum_values)
+		self._enum_values = enum_values
+	
+	@abstractmethod
+	def _write(self, data):
+		"""Send data (one or more packets with length prefix) to the server, or raise BlockingIOError to refuse all of it.
+		
+		Called with self._lock held. Must call _commands_written with the data that is actually written.
+		"""
+	
+	@abstractmethod
+	def run_on_handle_events_thread(self, callback):
+		"""Run a function on the thread (or event loop) that handles the events."""
+	
+	def start_capture(self, recorder):
+		"""Start recording all events and commands to a recorder, such as a flicrecord.FrameRecorder.
+		
+		The recorder's record_event and record_command methods are called with each packet (without the length prefix).
+		"""
+		with self._lock:
+			self._recorder = recorder
+	
+	def stop_capture(self):
+		"""Stop recording. The recorder is not closed."""
+		with self._lock:
+			self._recorder = None
+	
+	def add_scanner(self, scanner):
+		"""Add a ButtonScanner object.
+		
+		The scan will start directly once the scanner is added.
+		"""
+		with self._lock:
+			if scanner._scan_id in self._scanners:
+				return
+			
+			scanner._client = self
+			self._register("_scanners", scanner._scan_id, scanner)
+			self._send_command("CmdCreateScanner", {"scan_id": scanner._scan_id}, lambda: self._unregister("_scanners", scanner._scan_id))
+	
+	def remove_scanner(self, scanner):
+		"""Remove a ButtonScanner object.
+		
+		You will no longer receive advertisement packets.
+		"""
+		with self._lock:
+			if scanner._scan_id not in self._scanners:
+				return
+			
+			self._unregister("_scanners", scanner._scan_id)
+			self._send_command("CmdRemoveScanner", {"scan_id": scanner._scan_id}, lambda: self._register("_scanners", scanner._scan_id, scanner))
+	
+	def add_scan_wizard(self, scan_wizard):
+		"""Add a ScanWizard object.
+		
+		The scan wizard will start directly once the scan wizard is added.
+		"""
+		with self._lock:
+			if scan_wizard._scan_wizard_id in self._scan_wizards:
+				return
+			
+			self._register("_scan_wizards", scan_wizard._scan_wizard_id, scan_wizard)
+			self._send_command("CmdCreateScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id}, lambda: self._unregister("_scan_wizards", scan_wizard._scan_wizard_id))
+	
+	def cancel_scan_wizard(self, scan_wizard):
+		"""Cancel a ScanWizard.
+		
+		Note: The effect of this command will take place at the time the on_completed event arrives on the scan wizard object.
+		If cancelled due to this command, "result" in the on_completed event will be "WizardCancelledByUser".
+		"""
+		with self._lock:
+			if scan_wizard._scan_wizard_id not in self._scan_wizards:
+				return
+			
+			self._send_command("CmdCancelScanWizard", {"scan_wizard_id": scan_wizard._scan_wizard_id})
+	
+	def add_connection_channel(self, channel):
+		"""Adds a connection channel to a specific Flic button.
+		
+		This will start listening for a specific Flic button's connection and button events.
+		Make sure the Flic is either in public mode (by holding it down for 7 seconds) or already verified before calling this method.
+		
+		The on_create_connection_channel_response callback property will be called on the
+		connection channel after this command has been received by the server.
+		
+		You may have as many connection channels as you wish for a specific Flic Button.
+		"""
+		with self._lock:
+			if channel._conn_id in self._connection_channels:
+				return
+			
+			channel._client = self
+			
+			self._register("_connection_channels", channel._conn_id, channel)
+			def rollback():
+				self._unregister("_connection_channels", channel._conn_id)
+				channel._client = None
+			self._send_command("CmdCreateConnectionChannel", {"conn_id": channel._conn_id, "bd_addr": channel.bd_addr, "latency_mode": channel._latency_mode, "auto_disconnect_time": channel._auto_disconnect_time}, rollback)
+	
+	def remove_connection_channel(self, channel):
+		"""Remove a connection channel.
+		
+		This will stop listening for new events for a specific connection channel that has previously been added.
+		Note: The effect of this command will take place at the time the on_removed event arrives on the connection channel object.
+		"""
+		with self._lock:
+			if channel._conn_id not in self._connection_channels:
+				return
+			
+			self._send_command("CmdRemoveConnectionChannel", {"conn_id": channel._conn_id})
+	
+	def add_battery_status_listener(self, listener):
+		"""Adds a battery status listener for a specific Flic button.
+		"""
+		with self._lock:
+			if listener._listener_id in self._battery_status_listeners:
+				return
+			
+			listener._client = self
+			self._register("_battery_status_listeners", listener._listener_id, listener)
+			self._send_command("CmdCreateBatteryStatusListener", {"listener_id": listener._listener_id, "bd_addr": listener._bd_addr}, lambda: self._unregister("_battery_status_listeners", listener._listener_id))
+	
+	def remove_battery_status_listener(self, listener):
+		"""Remove a battery status listener.
+		"""
+		with self._lock:
+			if listener._listener_id not in self._battery_status_listeners:
+				return
+			
+			self._unregister("_battery_status_listeners", listener._listener_id)
+			self._send_command("CmdRemoveBatteryStatusListener", {"listener_id": listener._listener_id}, lambda: self._register("_battery_status_listeners", listener._listener_id, listener))
+	
+	def force_disconnect(self, bd_addr):
+		"""Force disconnection or cancel pending connection of a specific Flic button.
+		
+		This removes all connection channels for all clients connected to the server for this specific Flic button.
+		"""
+		self._send_command("CmdForceDisconnect", {"bd_addr": bd_addr})
+	
+	def get_info(self, callback = None):
+		"""Get info about the current state of the server.
+		
+		The server will send back its information directly and the callback will be called once the response arrives.
+		If no callback is given, the on_get_info callback property of this object is called instead.
+		The callback takes only one parameter: info. This info parameter is a dictionary with the following objects:
+		bluetooth_controller_state, my_bd_addr, my_bd_addr_type, max_pending_connections, max_concurrently_connected_buttons,
+		current_pending_connections, currently_no_space_for_new_connection, bd_addr_of_verified_buttons (a list of bd addresses).
+		"""
+		with self._lock:
+			self._get_info_response_queue.append(callback)
+			self._send_command("CmdGetInfo", {}, self._get_info_response_queue.pop)
+	
+	def ping(self, callback):
+		"""Send a ping to the server. The callback, without parameters, is called when the response arrives."""
+		with self._lock:
+			ping_id = next(self._ping_ids) & 0xffffffff
+			self._ping_callbacks[ping_id] = callback
+			if len(self._ping_callbacks) == 1:
+				self._subscriptions = None
+			self._send_command("CmdPing", {"ping_id": ping_id}, lambda: self._pop_ping_callback(ping_id))
+	
+	def delete_button(self, bd_addr):
+		"""Delete a verified button.
+		"""
+		self._send_command("CmdDeleteButton", {"bd_addr": bd_addr})
+	
+	def get_button_info(self, bd_addr, callback):
+		"""Get button info for a verified button.
+		
+		The server will send back its information directly and the callback will be called once the response arrives.
+		Responses will arrive in the same order as requested.
+		
+		The callback takes four parameters: bd_addr, uuid (hex string of 32 characters), color (string and None if unknown), serial_number, flic_version, firmware_version.
+		
+		Note: if the button isn't verified, the uuid sent to the callback will rather be None.
+		"""
+		with self._lock:
+			self._get_button_info_queue.append(callback)
+			self._send_command("CmdGetButtonInfo", {"bd_addr": bd_addr}, self._get_button_info_queue.pop)
+	
+	def _get_buttons_info(self, bd_addrs, callback):
+		with self._lock:
+			missing = []
+			missing_set = set()
+			for bd_addr in bd_addrs:
+				if bd_addr not in self._button_info_cache and bd_addr not in missing_set:
+					missing.append(bd_addr)
+					missing_set.add(bd_addr)
+			
+			if len(missing) == 0:
+				result = [self._button_info_cache[bd_addr] for bd_addr in bd_addrs]
+				self.run_on_handle_events_thread(lambda: callback(result))
+				return
+			
+			responses = dict((bd_addr, self._button_info_cache[bd_addr]) for bd_addr in bd_addrs if bd_addr not in missing_set)
+			remaining = [len(missing)]
+			def on_response(bd_addr, uuid, color, serial_number, flic_version, firmware_version):
+				responses[bd_addr] = {"bd_addr": bd_addr, "uuid": uuid, "color": color, "serial_number": serial_number, "flic_version": flic_version, "firmware_version": firmware_version}
+				remaining[0] -= 1
+				if remaining[0] == 0:
+					callback([responses[bd_addr] for bd_addr in bd_addrs])
+			
+			for bd_addr in missing:
+				self._get_button_info_queue.append(on_response)
+			def rollback():
+				for bd_addr in missing:
+					self._get_button_info_queue.pop()
+			self._send_commands([("CmdGetButtonInfo", {"bd_addr": bd_addr}) for bd_addr in missing], rollback)
+	
+	def _send_command(self, name, items, rollback = None):
+		self._send_commands([(name, items)], rollback)
+	
+	def _send_commands(self, commands, rollback = None):
+		# rollback undoes the state changes the caller made for the commands, if the transport refuses them
+		packets = [encode_command(name, items) for name, items in commands]
+		with self._lock:
+			if not self._closed:
+				try:
+					self._write(b"".join(packets))
+				except BlockingIOError:
+					if rollback is not None:
+						rollback()
+					raise
+	
+	def _commands_written(self, data):
+		# Records the commands in data (one or more packets with length prefix)
+		recorder = self._recorder
+		flight_recorder = self.flight_recorder
+		if recorder is None and flight_recorder is None:
+			return
+		pos = 0
+		while pos + 2 <= len(data):
+			end = pos + 2 + (data[pos] | (data[pos + 1] << 8))
+			if recorder is not None:
+				recorder.record_command(data[pos + 2 : end])
+			if flight_recorder is not None:
+				flight_recorder.record_command(data[pos + 2 : end])
+			pos = end
+	
+	def _register(self, registry, key, obj):
+		# Copy on write, see the class documentation
+		with self._lock:
+			updated = dict(getattr(self, registry))
+			updated[key] = obj
+			setattr(self, registry, updated)
+			self._subscriptions = None
+	
+	def _unregister(self, registry, key):
+		# Returns the removed object, or None
+		with self._lock:
+			current = getattr(self, registry)
+			if key not in current:
+				return None
+			updated = dict(current)
+			obj = updated.pop(key)
+			setattr(self, registry, updated)
+			self._subscriptions = None
+			return obj
+	
+	def _pop_ping_callback(self, ping_id):
+		# Pending pings are not a copy on write registry, since there can be very many of them
+		with self._lock:
+			callback = self._ping_callbacks.pop(ping_id, None)
+			if len(self._ping_callbacks) == 0:
+				self._subscriptions = None
+			return callback
+	
+	def _call_channel_callback(self, channel, callback, args):
+		executor = self._channel_callback_executor
+		if executor is None:
+			callback(*args)
+		else:
+			executor(channel._conn_id, callback, args)
+	
+	def _packet_received(self, data):
+		recorder = self._recorder
+		if recorder is not None:
+			recorder.record_event(data)
+		flight_recorder = self.flight_recorder
+		if flight_recorder is not None:
+			flight_recorder.record_event(data)
+		try:
+			self._dispatch_event(data)
+		except Exception:
+			if flight_recorder is not None:
+				flight_recorder._dispatch_failed()
+			raise
+	
+	def _build_subscriptions(self):
+		# For each opcode, None if the event must always be dispatched, or else the set of ids that have a callback for it
+		with self._lock:
+			subscriptions = [None] * len(_EVENTS)
+			for event_name, registry, callback in _SKIPPABLE_EVENTS:
+				opcode = _EVENT_NAME_TO_OPCODE[event_name]
+				if registry is None:
+					if callback is None or getattr(self, callback) is _unhandled:
+						subscriptions[opcode] = frozenset()
+				elif callback is None:
+					# Dispatched while anything is pending, without looking at the id
+					if len(getattr(self, registry)) == 0:
+						subscriptions[opcode] = frozenset()
+				else:
+					subscriptions[opcode] = frozenset(id for id, obj in getattr(self, registry).items() if getattr(obj, callback) is not _unhandled)
+			self._subscriptions = subscriptions
+			return subscriptions
+	
+	def _dispatch_event(self, data):
+		subscriptions = self._subscriptions
+		if subscriptions is None:
+			subscriptions = self._build_subscriptions()
+		if len(data) > 0 and data[0] < len(subscriptions):
+			subscribed = subscriptions[data[0]]
+			# The id (conn_id, scan_id or listener_id) is the first field of all skippable events that have one
+			if subscribed is not None and (len(subscribed) == 0 or (len(data) >= 5 and (data[1] | (data[2] << 8) | (data[3] << 16) | (data[4] << 24)) not in subscribed)):
+				self._skipped[data[0]] += 1
+				return
+		
+		event = decode_event(data, self._enum_tables)
+		if event is None:
+			return
+		event_name, items = event
+		
+		# Process event
+		if event_name == "EvtAdvertisementPacket":
+			scanner = self._scanners.get(items["scan_id"])
+			if scanner is not None:
+				scanner.on_advertisement_packet(scanner, items["bd_addr"], items["name"], items["rssi"], items["is_private"], items["already_verified"], items["already_connected_to_this_device"], items["already_connected_to_other_device"])
+		
+		if event_name == "EvtCreateConnectionChannelResponse":
+			channel = self._connection_channels[items["conn_id"]]
+			if items["error"] != self._enum_tables[CreateConnectionChannelError][CreateConnectionChannelError.NoError.value]:
+				self._unregister("_connection_channels", items["conn_id"])
+			self._call_channel_callback(channel, channel.on_create_connection_channel_response, (channel, items["error"], items["connection_status"]))
+		
+		if event_name == "EvtConnectionStatusChanged":
+			channel = self._connection_channels[items["conn_id"]]
+			self._call_channel_callback(channel, channel.on_connection_status_changed, (channel, items["connection_status"], items["disconnect_reason"]))
+		
+		if event_name == "EvtConnectionChannelRemoved":
+			channel = self._unregister("_connection_channels", items["conn_id"])
+			self._call_channel_callback(channel, channel.on_removed, (channel, items["removed_reason"]))
+		
+		if event_name == "EvtButtonUpOrDown":
+			channel = self._connection_channels[items["conn_id"]]
+			self._call_channel_callback(channel, channel.on_button_up_or_down, (channel, items["click_type"], items["was_queued"], items["time_diff"]))
+		if event_name == "EvtButtonClickOrHold":
+			channel = self._connection_channels[items["conn_id"]]
+			self._call_channel_callback(channel, channel.on_button_click_or_hold, (channel, items["click_type"], items["was_queued"], items["time_diff"]))
+		if event_name == "EvtButtonSingleOrDoubleClick":
+			channel = self._connection_channels[items["conn_id"]]
+			self._call_channel_callback(channel, channel.on_button_single_or_double_click, (channel, items["click_type"], items["was_queued"], items["time_diff"]))
+		if event_name == "EvtButtonSingleOrDoubleClickOrHold":
+			channel = self._connection_channels[items["conn_id"]]
+			self._call_channel_callback(channel, channel.on_button_single_or_double_click_or_hold, (channel, items["click_type"], items["was_queued"], items["time_diff"]))
+		
+		if event_name == "EvtNewVerifiedButton":
+			with self._lock:
+				self._button_info_cache.pop(items["bd_addr"], None)
+			self.on_new_verified_button(items["bd_addr"])
+		
+		if event_name == "EvtGetInfoResponse":
+			callback = self._get_info_response_queue.popleft() if len(self._get_info_response_queue) > 0 else None
+			(callback if callback is not None else self.on_get_info)(items)
+		
+		if event_name == "EvtNoSpaceForNewConnection":
+			self.on_no_space_for_new_connection(items["max_concurrently_connected_buttons"])
+		
+		if event_name == "EvtGotSpaceForNewConnection":
+			self.on_got_space_for_new_connection(items["max_concurrently_connected_buttons"])
+		
+		if event_name == "EvtBluetoothControllerStateChange":
+			self.on_bluetooth_controller_state_change(items["state"])
+		
+		if event_name == "EvtGetButtonInfoResponse":
+			with self._lock:
+				self._button_info_cache[items["bd_addr"]] = {"bd_addr": items["bd_addr"], "uuid": items["uuid"], "color": items["color"], "serial_number": items["serial_number"], "flic_version": items["flic_version"], "firmware_version": items["firmware_version"]}
+			self._get_button_info_queue.popleft()(items["bd_addr"], items["uuid"], items["color"], items["serial_number"], items["flic_version"], items["firmware_version"])
+		
+		if event_name == "EvtScanWizardFoundPrivateButton":
+			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
+			scan_wizard.on_found_private_button(scan_wizard)
+		
+		if event_name == "EvtScanWizardFoundPublicButton":
+			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
+			scan_wizard._bd_addr = items["bd_addr"]
+			scan_wizard._name = items["name"]
+			scan_wizard.on_found_public_button(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
+		
+		if event_name == "EvtScanWizardButtonConnected":
+			scan_wizard = self._scan_wizards[items["scan_wizard_id"]]
+			scan_wizard.on_button_connected(scan_wizard, scan_wizard._bd_addr, scan_wizard._name)
+		
+		if event_name == "EvtScanWizardCompleted":
+			scan_wizard = self._unregister("_scan_wizards", items["scan_wizard_id"])
+			scan_wizard.on_completed(scan_wizard, items["result"], scan_wizard._bd_addr, scan_wizard._name)
+		
+		if event_name == "EvtButtonDeleted":
+			with self._lock:
+				self._button_info_cache.pop(items["bd_addr"], None)
+			self.on_button_deleted(items["bd_addr"], items["deleted_by_this_client"])
+		
+		if event_name == "EvtPingResponse":
+			callback = self._pop_ping_callback(items["ping_id"])
+			if callback is not None:
+				callback()
+		
+		if event_name == "EvtBatteryStatus":
+			listener = self._battery_status_listeners.get(items["listener_id"])
+			if listener is not None:
+				listener.on_battery_status(listener, items["battery_percentage"], items["timestamp"])
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""Multiplexing proxy that shares one flicd connection between many local processes
+
+The proxy holds a single aioflic FlicClient and at most one connection channel per button.
+Subscribers connect over a Unix socket, send one line of JSON with their filter, and then receive
+one line of JSON per matching event.
+
+Subscription line (a JSON object; all keys optional, a missing or null key matches everything, and a subscriber sending anything after it is disconnected):
+{"bd_addrs": ["aa:bb:cc:dd:ee:ff"], "events": ["EvtButtonSingleOrDoubleClickOrHold"], "click_types": ["ButtonDoubleClick", "ButtonHold"]}
+
+Event lines:
+{"event": "EvtButtonSingleOrDoubleClickOrHold", "bd_addr": "aa:bb:cc:dd:ee:ff", "click_type": "ButtonHold", "was_queued": 0, "time_diff": 0}
+{"event": "EvtConnectionStatusChanged", "bd_addr": "aa:bb:cc:dd:ee:ff", "connection_status": "Ready", "disconnect_reason": "Unspecified"}
+
+Every subscriber has a bounded queue. If a subscriber doesn't keep up, the oldest events are dropped
+and a {"event": "Dropped", "count": n} line is sent once it catches up.
+
+If the connection to flicd is lost, the proxy connects again and recreates its channels; subscribers stay connected.
+
+Usage:
+python3 flicproxy.py --socket /tmp/flicproxy.sock
+
+and in the worker processes:
+async for event in flicproxy.subscribe("/tmp/flicproxy.sock", bd_addrs=[...]):
+    ...
+"""
+
+import argparse
+import asyncio
+import json
+
+import aioflic
+
+_BUTTON_EVENTS = [
+    ("EvtButtonUpOrDown", "on_button_up_or_down"),
+    ("EvtButtonClickOrHold", "on_button_click_or_hold"),
+    ("EvtButtonSingleOrDoubleClick", "on_button_single_or_double_click"),
+    ("EvtButtonSingleOrDoubleClickOrHold", "on_button_single_or_double_click_or_hold")
+]
+
+def _name(enum_class, value):
+    # The upstream client may deliver enums, IntEnums or plain ints, depending on its enum_values
+    return enum_class(getattr(value, "value", value)).name
+
+class _Subscriber:
+    def __init__(self, writer, max_queue, bd_addrs, events, click_types):
+        self.writer = writer
+        self.queue = asyncio.Queue(max_queue)
+        self.dropped = 0
+        self.bd_addrs = None if bd_addrs is None else frozenset(bd_addrs)
+        self.events = None if events is None else frozenset(events)
+        self.click_types = None if click_types is None else frozenset(click_types)
+
+    def matches(self, event_name, click_type):
+        if self.events is not None and event_name not in self.events:
+            return False
+        if click_type is not None and self.click_types is not None and click_type not in self.click_types:
+            return False
+        return True
+
+    def put(self, line):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+class FlicProxy:
+    """FlicProxy class.
+
+    Attaches one connection channel to every verified button of the upstream client (and to new ones as they get verified),
+    and to any other button a subscriber asks for. Events are encoded once and fanned out to the queues of all matching subscribers.
+
+    Channels are reference counted per bd addr: a verified button holds one reference until it is deleted, and every subscriber
+    holds one for each button it asks for. The channel is removed upstream when the last reference goes away,
+    and created again if the server removes it while it is still referenced.
+
+    Call start() once the upstream client is connected, then serve_unix() to accept subscribers.
+    If the upstream connection is lost, call reconnect() with a new connected client to create the channels again.
+    """
+
+    def __init__(self, client, max_queue=1000, latency_mode=aioflic.LatencyMode.NormalLatency):
+        self._client = client
+        self._max_queue = max_queue
+        self._latency_mode = latency_mode
+        self._channels = {}
+        self._refs = {}
+        self._verified = set()
+        self._subscribers_by_bd_addr = {}
+        self._wildcard_subscribers = set()
+
+    @property
+    def subscriber_count(self):
+        return len(self._wildcard_subscribers) + len(set().union(*self._subscribers_by_bd_addr.values()))
+
+    @property
+    def channel_count(self):
+        """Number of connection channels currently held on the upstream client."""
+        return len(self._channels)
+
+    def start(self):
+        """Request the verified buttons from the upstream client and attach channels to them."""
+        client = self._client
+        previous_on_get_info = client.on_get_info
+        previous_on_new_verified_button = client.on_new_verified_button
+        previous_on_button_deleted = client.on_button_deleted
+
+        def on_get_info(items):
+            for bd_addr in items["bd_addr_of_verified_buttons"]:
+                self._add_verified(bd_addr)
+            previous_on_get_info(items)
+
+        def on_new_verified_button(bd_addr):
+            self._add_verified(bd_addr)
+            previous_on_new_verified_button(bd_addr)
+
+        def on_button_deleted(bd_addr, deleted_by_this_client):
+            if bd_addr in self._verified:
+                self._verified.discard(bd_addr)
+                self._release(bd_addr)
+            previous_on_button_deleted(bd_addr, deleted_by_this_client)
+
+        client.on_get_info = on_get_info
+        client.on_new_verified_button = on_new_verified_button
+        client.on_button_deleted = on_button_deleted
+        client.get_info()
+
+    def reconnect(self, client):
+        """Continue on a new upstream client after the previous connection was lost.
+
+        The channels of the buttons subscribers ask for are created again on the new client. The verified buttons are taken
+        from a new get_info, since buttons may have been deleted or verified while disconnected. Call it once the new client is connected.
+        """
+        self._client = client
+        self._channels = {}
+        for bd_addr in self._verified:
+            refs = self._refs[bd_addr] - 1
+            if refs > 0:
+                self._refs[bd_addr] = refs
+            else:
+                del self._refs[bd_addr]
+        self._verified = set()
+        for bd_addr in self._refs:
+            self._add_channel(bd_addr)
+        self.start()
+
+    async def serve_unix(self, path):
+        """Start accepting subscribers on a Unix socket. Returns the asyncio server."""
+        return await asyncio.start_unix_server(self._handle_subscriber, path)
+
+    def _add_verified(self, bd_addr):
+        if bd_addr not in self._verified:
+            self._verified.add(bd_addr)
+            self._acquire(bd_addr)
+
+    def _acquire(self, bd_addr):
+        self._refs[bd_addr] = self._refs.get(bd_addr, 0) + 1
+        if bd_addr not in self._channels:
+            self._add_channel(bd_addr)
+
+    def _release(self, bd_addr):
+        refs = self._refs[bd_addr] - 1
+        if refs > 0:
+            self._refs[bd_addr] = refs
+            return
+        del self._refs[bd_addr]
+        channel = self._channels.pop(bd_addr, None)
+        if channel is not None:
+            self._client.remove_connection_channel(channel)
+
+    def _add_channel(self, bd_addr):
+        channel = aioflic.ButtonConnectionChannel(bd_addr, self._latency_mode)
+        for event_name, attr in _BUTTON_EVENTS:
+            setattr(channel, attr, self._make_button_handler(event_name))
+        channel.on_connection_status_changed = \
+            lambda channel, connection_status, disconnect_reason: \
+                self._publish(channel.bd_addr, "EvtConnectionStatusChanged", None, {"connection_status": _name(aioflic.ConnectionStatus, connection_status), "disconnect_reason": _name(aioflic.DisconnectReason, disconnect_reason)})
+        channel.on_removed = lambda channel, removed_reason: self._on_removed(channel)
+        self._channels[bd_addr] = channel
+        self._client.add_connection_channel(channel)
+
+    def _on_removed(self, channel):
+        # A removed channel may already have been replaced by a newer one for the same button
+        if self._channels.get(channel.bd_addr) is channel:
+            del self._channels[channel.bd_addr]
+            # Removed by the server, but still wanted
+            if channel.bd_addr in self._refs:
+                self._add_channel(channel.bd_addr)
+
+    def _make_button_handler(self, event_name):
+        def handler(channel, click_type, was_queued, time_diff):
+            click_type = _name(aioflic.ClickType, click_type)
+            self._publish(channel.bd_addr, event_name, click_type, {"click_type": click_type, "was_queued": was_queued, "time_diff": time_diff})
+        return handler
+
+    def _publish(self, bd_addr, event_name, click_type, fields):
+        line = None
+        for subscribers in (self._subscribers_by_bd_addr.get(bd_addr, ()), self._wildcard_subscribers):
+            for subscriber in subscribers:
+                if not subscriber.matches(event_name, click_type):
+                    continue
+                if line is None:
+                    message = {"event": event_name, "bd_addr": bd_addr}
+                    message.update(fields)
+                    line = (json.dumps(message) + "\n").encode("utf-8")
+                subscriber.put(line)
+
+    async def _handle_subscriber(self, reader, writer):
+        try:
+            request = json.loads((await reader.readline()).decode("utf-8") or "{}")
+        except ValueError:
+            writer.close()
+            return
+        if not isinstance(request, dict) or not all(isinstance(request.get(key), (list, type(None))) for key in ("bd_addrs", "events", "click_types")):
+            writer.close()
+            return
+
+        subscriber = _Subscriber(writer, self._max_queue, request.get("bd_addrs"), request.get("events"), request.get("click_types"))
+        if subscriber.bd_addrs is None:
+            self._wildcard_subscribers.add(subscriber)
+        else:
+            for bd_addr in subscriber.bd_addrs:
+                self._subscribers_by_bd_addr.setdefault(bd_addr, set()).add(subscriber)
+                self._acquire(bd_addr)
+
+        # Reading only serves to notice when the subscriber goes away; anything it sends after the subscription line also disconnects it
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            while not closed.done():
+                get = asyncio.ensure_future(subscriber.queue.get())
+                await asyncio.wait([get, closed], return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                if subscriber.dropped > 0:
+                    writer.write((json.dumps({"event": "Dropped", "count": subscriber.dropped}) + "\n").encode("utf-8"))
+                    subscriber.dropped = 0
+                writer.write(get.result())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            closed.cancel()
+            self._wildcard_subscribers.discard(subscriber)
+            for bd_addr in subscriber.bd_addrs or ():
+                subscribers = self._subscribers_by_bd_addr.get(bd_addr)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if len(subscribers) == 0:
+                        del self._subscribers_by_bd_addr[bd_addr]
+                self._release(bd_addr)
+            writer.close()
+
+async def subscribe(path, bd_addrs=None, events=None, click_types=None):
+    """Connect to a FlicProxy and yield the matching events as dictionaries.
+
+    Enum values (click_type, connection_status, disconnect_reason) are given by their names.
+    """
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write((json.dumps({"bd_addrs": bd_addrs, "events": events, "click_types": click_types}) + "\n").encode("utf-8"))
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                return
+            yield json.loads(line.decode("utf-8"))
+    finally:
+        writer.close()
+
+class _UpstreamClient(aioflic.FlicClient):
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.lost = loop.create_future()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+async def _serve(loop, args):
+    proxy = None
+    server = None
+    try:
+        while True:
+            try:
+                transport, client = await loop.create_connection(lambda: _UpstreamClient(loop), args.host, args.port)
+            except OSError:
+                await asyncio.sleep(args.reconnect_delay)
+                continue
+            if proxy is None:
+                proxy = FlicProxy(client, args.max_queue)
+                proxy.start()
+                server = await proxy.serve_unix(args.socket)
+            else:
+                proxy.reconnect(client)
+            await client.lost
+            transport.close()
+            await asyncio.sleep(args.reconnect_delay)
+    finally:
+        if server is not None:
+            server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one flicd connection between many local processes.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5551)
+    parser.add_argument("--socket", default="/tmp/flicproxy.sock")
+    parser.add_argument("--max-queue", type=int, default=1000)
+    parser.add_argument("--reconnect-delay", type=float, default=1.0, help="seconds to wait before connecting to flicd again")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(_serve(loop, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+if __name__ == "__main__":
+    main()
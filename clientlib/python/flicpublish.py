@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""Batching publisher of button events to a message bus, for aioflic
+
+Publishing from inside a button callback would block the event loop that reads from flicd. Instead, an EventPublisher
+encodes every event into a fixed size record right away, and a background task publishes the records in batches,
+once max_batch_events have been collected or max_batch_delay seconds after the first one.
+
+The publish function is any coroutine function taking (topic, payload), for example a wrapper around an MQTT client,
+or InProcessBroker.publish for tests. Failed batches are retried with exponential backoff, up to max_retries times.
+
+Memory is bounded by max_queued_events. When the queue fills up to the high watermark (three quarters), every attached client
+is paused (see aioflic.FlicClient.pause_reading), so that the backlog stays in the socket buffers and eventually in flicd,
+and it is resumed when the queue has drained to a quarter. Events that still don't fit, for example when submit() is also called directly, are dropped and counted.
+
+Batch format: a 7 byte header (magic "FLPB", uint8 version, uint16 number of records) followed by 21 byte records of
+float64 timestamp (time.time()), bd addr (6 bytes, protocol byte order), uint8 opcode, uint8 click type, uint8 was_queued and uint32 time_diff.
+All integers are little endian. decode_batch() turns a payload back into dictionaries.
+
+Usage:
+publisher = EventPublisher(mqtt_publish, "flic/events")
+publisher.attach(client, channel)
+publisher.start()
+...
+await publisher.close()
+"""
+
+import argparse
+import asyncio
+import struct
+import time
+from collections import deque
+
+import flicprotocol
+
+_MAGIC = b"FLPB"
+_VERSION = 1
+_BATCH_HEADER = struct.Struct("<4sBH")
+_RECORD = struct.Struct("<d6sBBBI")
+
+_BUTTON_CALLBACKS = [
+    ("EvtButtonUpOrDown", "on_button_up_or_down"),
+    ("EvtButtonClickOrHold", "on_button_click_or_hold"),
+    ("EvtButtonSingleOrDoubleClick", "on_button_single_or_double_click"),
+    ("EvtButtonSingleOrDoubleClickOrHold", "on_button_single_or_double_click_or_hold")
+]
+
+def decode_batch(payload):
+    """Returns a list of dictionaries with timestamp, bd_addr, event, click_type (name), was_queued and time_diff."""
+    magic, version, count = _BATCH_HEADER.unpack_from(payload)
+    if magic != _MAGIC or version != _VERSION or len(payload) != _BATCH_HEADER.size + count * _RECORD.size:
+        raise ValueError("Not an event batch")
+    events = []
+    for timestamp, bd_addr, opcode, click_type, was_queued, time_diff in _RECORD.iter_unpack(payload[_BATCH_HEADER.size:]):
+        events.append({"timestamp": timestamp, "bd_addr": flicprotocol.bdaddr_bytes_to_string(bd_addr), "event": flicprotocol._EVENTS[opcode][0],
+                       "click_type": flicprotocol.ClickType(click_type).name, "was_queued": bool(was_queued), "time_diff": time_diff})
+    return events
+
+class InProcessBroker:
+    """InProcessBroker class.
+
+    Stand-in for a message broker: delivers payloads to the asyncio queues returned by subscribe(topic).
+    Set delay to simulate a slow broker, and fail_next to make the next publish calls raise ConnectionError.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.fail_next = 0
+        self.published = 0
+        self._subscribers = {}
+
+    def subscribe(self, topic):
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(topic, []).append(queue)
+        return queue
+
+    async def publish(self, topic, payload):
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise ConnectionError("Simulated broker failure")
+        self.published += 1
+        for queue in self._subscribers.get(topic, []):
+            queue.put_nowait(payload)
+
+class EventPublisher:
+    """EventPublisher class.
+
+    Counters: published_batches, published_events, retries, failed_batches (after all retries), dropped_events (including those of failed batches).
+    """
+
+    def __init__(self, publish, topic="flic/events", max_batch_events=256, max_batch_delay=0.05, max_queued_events=65536, max_retries=5, retry_delay=0.1):
+        self.publish = publish
+        self.topic = topic
+        self.max_batch_events = min(max_batch_events, 0xffff)
+        self.max_batch_delay = max_batch_delay
+        self.max_queued_events = max_queued_events
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.published_batches = 0
+        self.published_events = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.dropped_events = 0
+        self._queue = deque()
+        self._clients = []
+        self._paused = False
+        self._closing = False
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+
+    @property
+    def queued_events(self):
+        return len(self._queue)
+
+    def attach(self, client, channel, events=("EvtButtonSingleOrDoubleClickOrHold",)):
+        """Publish the given button events of a connection channel. The client is paused when the queue is full."""
+        if client not in self._clients:
+            self._clients.append(client)
+        bd_addr = bytes(flicprotocol.bdaddr_string_to_bytes(channel.bd_addr))
+        for event_name, callback in _BUTTON_CALLBACKS:
+            if event_name in events:
+                opcode = flicprotocol._EVENT_NAME_TO_OPCODE[event_name]
+                setattr(channel, callback, lambda channel, click_type, was_queued, time_diff, opcode=opcode: self.submit(bd_addr, opcode, getattr(click_type, "value", click_type), was_queued, time_diff))
+
+    def submit(self, bd_addr, opcode, click_type, was_queued, time_diff):
+        """Queue one event (bd_addr as 6 bytes in protocol byte order). Returns False if it had to be dropped."""
+        queue = self._queue
+        if len(queue) >= self.max_queued_events:
+            self.dropped_events += 1
+            return False
+        queue.append(_RECORD.pack(time.time(), bd_addr, opcode, click_type, was_queued, time_diff))
+        if len(queue) == 1:
+            self._wakeup.set()
+        if len(queue) >= self.max_batch_events:
+            self._full.set()
+        if not self._paused and len(queue) >= self.max_queued_events * 3 // 4:
+            self._set_paused(True)
+        return True
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Publish everything still queued, then stop. Also works if start() was never called."""
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        if self._task is not None:
+            await self._task
+        else:
+            await self._run()
+        self._set_paused(False)
+
+    def _set_paused(self, paused):
+        self._paused = paused
+        for client in self._clients:
+            if paused:
+                client.pause_reading()
+            else:
+                client.resume_reading()
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            if len(queue) == 0:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if len(queue) < self.max_batch_events and not self._closing:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_batch_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            count = min(len(queue), self.max_batch_events)
+            payload = bytearray(_BATCH_HEADER.pack(_MAGIC, _VERSION, count))
+            for i in range(count):
+                payload += queue.popleft()
+            await self._publish(bytes(payload), count)
+
+            if self._paused and len(queue) <= self.max_queued_events // 4:
+                self._set_paused(False)
+
+    async def _publish(self, payload, count):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.publish(self.topic, payload)
+                self.published_batches += 1
+                self.published_events += count
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    self.failed_batches += 1
+                    self.dropped_events += count
+                    return
+                self.retries += 1
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+
+async def benchmark(nb_buttons, nb_events, broker_delay, failure_every):
+    import aioflic
+    import fakeflicd
+
+    bd_addrs = ["00:00:00:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(nb_buttons)]
+    flicd = fakeflicd.FakeFlicd(bd_addrs)
+    host, port = await flicd.start_tcp()
+    loop = asyncio.get_event_loop()
+    transport, client = await loop.create_connection(lambda: aioflic.FlicClient(loop), host, port)
+
+    broker = InProcessBroker(broker_delay)
+    received = broker.subscribe("flic/events")
+    publisher = EventPublisher(broker.publish, retry_delay=0.001)
+    ready = []
+    for bd_addr in bd_addrs:
+        channel = aioflic.ButtonConnectionChannel(bd_addr)
+        channel.on_connection_status_changed = lambda channel, status, reason: ready.append(channel) if status == aioflic.ConnectionStatus.Ready else None
+        publisher.attach(client, channel, ["EvtButtonUpOrDown"])
+        client.add_connection_channel(channel)
+    publisher.start()
+    while len(ready) < nb_buttons:
+        await asyncio.sleep(0.001)
+
+    start = time.perf_counter()
+    for i in range(nb_events):
+        flicd.emit_button_event(bd_addrs[i % nb_buttons], i % 2)
+        if failure_every > 0 and i % failure_every == 0:
+            broker.fail_next = 1
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    while publisher.published_events + publisher.dropped_events < nb_events:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    await publisher.close()
+
+    delivered = 0
+    while not received.empty():
+        delivered += len(decode_batch(received.get_nowait()))
+    print("%d events in %d batches (%d retries, %d dropped), %d delivered in %.3f s: %.0f events/s" %
+          (nb_events, publisher.published_batches, publisher.retries, publisher.dropped_events, delivered, elapsed, nb_events / elapsed))
+    client.close()
+    transport.close()
+    flicd.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish events from a local fakeflicd through an EventPublisher into an in-process broker.")
+    parser.add_argument("--buttons", type=int, default=10)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--broker-delay", type=float, default=0.001, help="seconds per publish call")
+    parser.add_argument("--failure-every", type=int, default=10000, help="make a publish call fail every this many events (0 = never)")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.buttons, args.events, args.broker_delay, args.failure_every))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""Recording and replaying of the Flic protocol stream
+
+A FrameRecorder appends every packet a FlicClient receives (events) and sends (commands) to a compact binary log,
+together with a monotonic timestamp. A FrameReplayer reads such a log and feeds the events to a client's _dispatch_event,
+either with the original timing or as fast as possible, which also makes it a deterministic benchmark of the decode and dispatch path.
+
+Usage:
+recorder = FrameRecorder("capture.flog")
+client.start_capture(recorder)
+...
+client.stop_capture()
+recorder.close()
+
+replayer = FrameReplayer("capture.flog")
+replayer.replay(client, speed = 1.0)
+
+Log format: a 6 byte header (magic "FLRC", uint16 version) followed by records of
+float64 monotonic timestamp, uint8 direction (0 = event, 1 = command), uint16 length and the packet without its length prefix.
+All integers are little endian.
+
+Command line:
+python3 flicrecord.py dump capture.flog
+python3 flicrecord.py bench capture.flog --repeat 10
+"""
+
+import argparse
+import queue
+import struct
+import threading
+import time
+
+import flicprotocol
+
+EVENT = 0
+COMMAND = 1
+
+_MAGIC = b"FLRC"
+_VERSION = 1
+_HEADER = struct.Struct("<4sH")
+_RECORD = struct.Struct("<dBH")
+
+class FrameRecorder:
+	"""FrameRecorder class.
+
+	Records are collected in memory and handed over to a background thread for writing once buffer_size bytes have accumulated,
+	so the thread handling the events never waits for the disk. Call flush() to write everything collected so far, and close() when done.
+	If writing fails, recording stops and the error (an OSError, e.g. for a full disk) is raised by the next flush() or close().
+	"""
+
+	def __init__(self, path, buffer_size = 65536):
+		self._file = open(path, "wb")
+		self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+		self._buffer_size = buffer_size
+		self._buffer = bytearray()
+		self._lock = threading.Lock()
+		self._pending = queue.Queue()
+		self._writer = threading.Thread(target=self._write_loop, name="FrameRecorder", daemon=True)
+		self._writer.start()
+		self._closed = False
+		self._error = None
+
+	def record(self, direction, data):
+		"""Append one packet (without length prefix)."""
+		with self._lock:
+			if self._closed or self._error is not None:
+				return
+			self._buffer += _RECORD.pack(time.monotonic(), direction, len(data))
+			self._buffer += data
+			if len(self._buffer) >= self._buffer_size:
+				self._pending.put(self._buffer)
+				self._buffer = bytearray()
+
+	def record_event(self, data):
+		self.record(EVENT, data)
+
+	def record_command(self, data):
+		self.record(COMMAND, data)
+
+	def flush(self):
+		"""Write all records collected so far and wait until they are written. Does nothing once closed."""
+		with self._lock:
+			if self._closed:
+				return
+			if len(self._buffer) > 0:
+				self._pending.put(self._buffer)
+				self._buffer = bytearray()
+		self._pending.join()
+		if self._error is not None:
+			raise self._error
+		self._file.flush()
+
+	def close(self):
+		"""Flush and close the log file. Closing again does nothing."""
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+			if len(self._buffer) > 0:
+				self._pending.put(self._buffer)
+				self._buffer = bytearray()
+		self._pending.put(None)
+		self._writer.join()
+		try:
+			self._file.close()
+		except OSError as e:
+			if self._error is None:
+				self._error = e
+		if self._error is not None:
+			raise self._error
+
+	def _write_loop(self):
+		while True:
+			buffer = self._pending.get()
+			try:
+				if buffer is not None and self._error is None:
+					self._file.write(buffer)
+			except OSError as e:
+				self._error = e
+				with self._lock:
+					self._buffer = bytearray()
+			finally:
+				self._pending.task_done()
+			if buffer is None:
+				return
+
+def read_frames(path):
+	"""Read a log file. Returns a list of (timestamp, direction, data) tuples. A truncated last record is ignored."""
+	with open(path, "rb") as f:
+		content = f.read()
+
+	if len(content) < _HEADER.size:
+		raise ValueError("Not a frame log: " + path)
+	magic, version = _HEADER.unpack_from(content)
+	if magic != _MAGIC or version != _VERSION:
+		raise ValueError("Not a frame log: " + path)
+
+	frames = []
+	pos = _HEADER.size
+	while pos + _RECORD.size <= len(content):
+		timestamp, direction, length = _RECORD.unpack_from(content, pos)
+		pos += _RECORD.size
+		if pos + length > len(content):
+			break
+		frames.append((timestamp, direction, content[pos : pos + length]))
+		pos += length
+	return frames
+
+def write_frames(path, frames):
+	"""Write (timestamp, direction, data) tuples, as returned by read_frames, to a new log file."""
+	with open(path, "wb") as f:
+		f.write(_HEADER.pack(_MAGIC, _VERSION))
+		for timestamp, direction, data in frames:
+			f.write(_RECORD.pack(timestamp, direction, len(data)))
+			f.write(data)
+
+class FrameReplayer:
+	"""FrameReplayer class.
+
+	Replays the events of a log into a client by calling its _dispatch_event method.
+
+	Recorded commands are applied to the client's registries before the events that follow them, so that connection channels, scanners,
+	scan wizards and battery status listeners exist under the identifiers used in the log, and that responses to get_info and get_button_info
+	have a matching request (the latter are delivered to the client's on_get_info and dropped, respectively).
+	Objects created this way come from create_object(class_name, *constructor_args), which by default constructs
+	the class of that name from flicprotocol; assign callbacks on them there. Nothing is sent to the server when applying commands.
+	"""
+
+	def __init__(self, path_or_frames, create_object = None):
+		self.frames = read_frames(path_or_frames) if isinstance(path_or_frames, str) else list(path_or_frames)
+		self.create_object = create_object
+
+	@property
+	def event_count(self):
+		return sum(1 for frame in self.frames if frame[1] == EVENT)
+
+	def replay(self, client, speed = None):
+		"""Replay all frames into client.
+
+		If speed is None, events are dispatched as fast as possible. Otherwise the original timing is reproduced, scaled by speed (2.0 is twice as fast).
+		Returns the number of dispatched events.
+		"""
+		if len(self.frames) == 0:
+			return 0
+
+		start = time.monotonic()
+		first_timestamp = self.frames[0][0]
+		count = 0
+		for timestamp, direction, data in self.frames:
+			if direction == COMMAND:
+				self._apply_command(client, data)
+				continue
+			if speed is not None:
+				delay = (timestamp - first_timestamp) / speed - (time.monotonic() - start)
+				if delay > 0:
+					time.sleep(delay)
+			client._dispatch_event(data)
+			count += 1
+		return count
+
+	def _create(self, client, class_name, *args):
+		if self.create_object is not None:
+			return self.create_object(class_name, *args)
+		return getattr(flicprotocol, class_name)(*args)
+
+	def _apply_command(self, client, data):
+		if len(data) == 0 or data[0] >= len(flicprotocol._COMMANDS):
+			return
+		opcode = data[0]
+		name = flicprotocol._COMMANDS[opcode][0]
+		items = dict(zip(flicprotocol._COMMAND_FIELDS[opcode], flicprotocol._COMMAND_STRUCTS[opcode].unpack_from(data, 1)))
+		if "bd_addr" in items:
+			items["bd_addr"] = flicprotocol.bdaddr_bytes_to_string(items["bd_addr"])
+
+		if name == "CmdCreateConnectionChannel" and items["conn_id"] not in client._connection_channels:
+			channel = self._create(client, "ButtonConnectionChannel", items["bd_addr"], flicprotocol.LatencyMode(items["latency_mode"]), items["auto_disconnect_time"])
+			channel._conn_id = items["conn_id"]
+			channel._client = client
+			client._register("_connection_channels", channel._conn_id, channel)
+		elif name == "CmdCreateScanner" and items["scan_id"] not in client._scanners:
+			scanner = self._create(client, "ButtonScanner")
+			scanner._scan_id = items["scan_id"]
+			scanner._client = client
+			client._register("_scanners", scanner._scan_id, scanner)
+		elif name == "CmdRemoveScanner":
+			client._unregister("_scanners", items["scan_id"])
+		elif name == "CmdCreateScanWizard" and items["scan_wizard_id"] not in client._scan_wizards:
+			scan_wizard = self._create(client, "ScanWizard")
+			scan_wizard._scan_wizard_id = items["scan_wizard_id"]
+			client._register("_scan_wizards", scan_wizard._scan_wizard_id, scan_wizard)
+		elif name == "CmdCreateBatteryStatusListener" and items["listener_id"] not in client._battery_status_listeners:
+			listener = self._create(client, "BatteryStatusListener", items["bd_addr"])
+			listener._listener_id = items["listener_id"]
+			listener._client = client
+			client._register("_battery_status_listeners", listener._listener_id, listener)
+		elif name == "CmdRemoveBatteryStatusListener":
+			client._unregister("_battery_status_listeners", items["listener_id"])
+		elif name == "CmdGetInfo":
+			client._get_info_response_queue.append(None)
+		elif name == "CmdGetButtonInfo":
+			client._get_button_info_queue.append(lambda bd_addr, uuid, color, serial_number, flic_version, firmware_version: None)
+		client._subscriptions = None
+
+def main():
+	parser = argparse.ArgumentParser(description="Inspect or benchmark a Flic protocol capture.")
+	parser.add_argument("action", choices=["dump", "bench"])
+	parser.add_argument("path")
+	parser.add_argument("--repeat", type=int, default=1, help="number of times to replay the capture (bench)")
+	args = parser.parse_args()
+
+	import socket
+	import fliclib
+
+	frames = read_frames(args.path)
+	if args.action == "dump":
+		names = [flicprotocol._EVENTS, flicprotocol._COMMANDS]
+		for timestamp, direction, data in frames:
+			table = names[direction]
+			name = table[data[0]][0] if len(data) > 0 and data[0] < len(table) else "?"
+			print("%.6f %s %s %s" % (timestamp - frames[0][0], "<" if direction == EVENT else ">", name, data.hex()))
+		return
+
+	def create_object(class_name, *args):
+		# Handle every callback, so that all events are decoded and dispatched rather than skipped
+		obj = getattr(flicprotocol, class_name)(*args)
+		for name in dir(obj):
+			if name.startswith("on_"):
+				setattr(obj, name, lambda *args: None)
+		return obj
+
+	total = 0
+	elapsed = 0
+	for i in range(args.repeat):
+		# A fresh offline client for every round, since replaying changes its registries
+		sock, peer = socket.socketpair()
+		client = fliclib.FlicClient(None, sock = sock)
+		replayer = FrameReplayer(frames, create_object)
+		start = time.perf_counter()
+		total += replayer.replay(client)
+		elapsed += time.perf_counter() - start
+		sock.close()
+		peer.close()
+	print("%d events in %.3f s: %.0f events/s" % (total, elapsed, total / elapsed if elapsed > 0 else 0))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,261 @@
+"""Roaming of buttons between several flicd gateways
+
+With gateways in overlapping radio range, a button can connect to any of them, and the same press can arrive through more than one client,
+for example when queued presses are delivered by a new gateway while an old one still had them. A RoamingCoordinator
+keeps the connection channels of a set of buttons on a set of clients and calls on_button_event exactly once per press.
+
+Press time: every event gets press_time = arrival time (time.monotonic()) - time_diff. Since time_diff has a resolution of one second,
+two arrivals of the same event kind and click type from different gateways are considered the same press if their press times are
+within tolerance seconds. An arrival never matches an earlier one from the same gateway, since flicd delivers each event once per channel.
+Recent presses are kept in a hash index of time buckets (tolerance seconds wide), so a lookup only looks at three buckets,
+and buckets older than retention seconds are dropped.
+
+Roaming: each button normally has one channel, on its active gateway. When the active gateway reports the button as disconnected,
+channels are created on all other gateways as well, the old one included, and the first one that becomes Ready is the new active gateway;
+the others are then removed. flicd reports no signal strength for connected buttons, so that is the only automatic choice of gateway.
+move() hands a button over to a given gateway: the old channels are kept, and events still arrive through them, until the new channel is Ready,
+so there is no gap in event delivery. A button that only accepts one connection at a time can't connect to the new
+gateway while the old one holds it, so if the new channel is not Ready after handover_timeout seconds, the old channels are removed anyway;
+the button queues presses while it reconnects and they are delivered through the new gateway. Presses arriving through both are suppressed as duplicates.
+
+Callbacks:
+on_button_event: bd_addr, event (e.g. "ButtonSingleOrDoubleClickOrHold"), click_type, was_queued, press_time, client
+on_active_gateway_changed: bd_addr, client
+
+Usage:
+coordinator = RoamingCoordinator([client1, client2])
+coordinator.on_button_event = lambda bd_addr, event, click_type, was_queued, press_time, client: ...
+coordinator.add_button("aa:bb:cc:dd:ee:ff")
+"""
+
+import threading
+import time
+
+from flicprotocol import ConnectionStatus, CreateConnectionChannelError, LatencyMode, ButtonConnectionChannel, _unhandled
+
+_BUTTON_CALLBACKS = {
+	"ButtonUpOrDown": "on_button_up_or_down",
+	"ButtonClickOrHold": "on_button_click_or_hold",
+	"ButtonSingleOrDoubleClick": "on_button_single_or_double_click",
+	"ButtonSingleOrDoubleClickOrHold": "on_button_single_or_double_click_or_hold"
+}
+
+class PressIndex:
+	"""PressIndex class.
+
+	Duplicate detection of presses arriving through several sources. Not thread safe; RoamingCoordinator serializes the calls.
+	"""
+
+	def __init__(self, tolerance = 1.5, retention = 120.0):
+		self.tolerance = tolerance
+		self.retention = retention
+		self.duplicates = 0
+		self._buckets = {}
+		self._oldest_bucket = None
+
+	def __len__(self):
+		return sum(len(bucket) for bucket in self._buckets.values())
+
+	def add(self, key, press_time, source):
+		"""Returns True if this is a new press, or False if it is the same press as an earlier one from another source."""
+		tolerance = self.tolerance
+		bucket_index = int(press_time // tolerance)
+		buckets = self._buckets
+		best = None
+		for index in (bucket_index - 1, bucket_index, bucket_index + 1):
+			bucket = buckets.get(index)
+			if bucket is None:
+				continue
+			for entry_time, sources in bucket.get(key, ()):
+				distance = abs(entry_time - press_time)
+				if distance <= tolerance and source not in sources and (best is None or distance < best[0]):
+					best = (distance, sources)
+		if best is not None:
+			best[1].add(source)
+			self.duplicates += 1
+			return False
+
+		buckets.setdefault(bucket_index, {}).setdefault(key, []).append((press_time, set([source])))
+		self._expire(bucket_index)
+		return True
+
+	def _expire(self, newest_bucket):
+		oldest = self._oldest_bucket
+		last = newest_bucket - int(self.retention // self.tolerance) - 1
+		if oldest is None or oldest > newest_bucket:
+			self._oldest_bucket = newest_bucket
+			return
+		for index in range(oldest, last + 1):
+			self._buckets.pop(index, None)
+		self._oldest_bucket = max(oldest, last + 1)
+
+class _Button:
+	def __init__(self, bd_addr):
+		self.bd_addr = bd_addr
+		self.channels = {}
+		self.active = None
+		self.handover = None
+
+class RoamingCoordinator:
+	"""RoamingCoordinator class.
+
+	Works with fliclib clients (each handling events on its own thread) as well as with aioflic clients.
+	events selects the button event kinds to listen to. duplicates tells how many arrivals were suppressed.
+	handover_timeout is how long move() keeps the old channels while waiting for the new one to become Ready.
+	"""
+
+	def __init__(self, clients, latency_mode = LatencyMode.NormalLatency, events = ("ButtonSingleOrDoubleClickOrHold",), tolerance = 1.5, retention = 120.0, handover_timeout = 10.0):
+		for event in events:
+			if event not in _BUTTON_CALLBACKS:
+				raise ValueError("Unknown event %r" % event)
+		self.clients = list(clients)
+		self.latency_mode = latency_mode
+		self.events = tuple(events)
+		self.handover_timeout = handover_timeout
+		self._index = PressIndex(tolerance, retention)
+		self._buttons = {}
+		self._lock = threading.RLock()
+
+		self.on_button_event = _unhandled
+		self.on_active_gateway_changed = _unhandled
+
+	@property
+	def duplicates(self):
+		return self._index.duplicates
+
+	def active_gateway(self, bd_addr):
+		"""The client whose channel to the button is connected, or None while it is not connected anywhere."""
+		button = self._buttons.get(bd_addr)
+		return button.active if button is not None else None
+
+	def add_button(self, bd_addr, client = None):
+		"""Start listening to a button, with a channel on the given client (by default the first one)."""
+		with self._lock:
+			if bd_addr in self._buttons:
+				return
+			button = _Button(bd_addr)
+			self._buttons[bd_addr] = button
+			self._add_channel(button, client if client is not None else self.clients[0])
+
+	def remove_button(self, bd_addr):
+		with self._lock:
+			button = self._buttons.pop(bd_addr, None)
+			if button is None:
+				return
+			for client, channel in list(button.channels.items()):
+				client.remove_connection_channel(channel)
+			button.channels = {}
+
+	def move(self, bd_addr, client):
+		"""Hand a button over to another gateway. The other channels are removed once the new one is Ready, or after handover_timeout seconds."""
+		with self._lock:
+			button = self._buttons[bd_addr]
+			if button.active is client:
+				button.handover = None
+				for other in list(button.channels):
+					if other is not client:
+						self._remove_channel(button, other)
+				return
+			button.handover = client
+			if client not in button.channels:
+				self._add_channel(button, client)
+			client.set_timer(int(self.handover_timeout * 1000), lambda: self._on_handover_timeout(button, client))
+
+	def gateway_lost(self, client):
+		"""Call when the connection to a gateway is lost: its buttons are looked for on the other gateways."""
+		with self._lock:
+			if client in self.clients:
+				self.clients.remove(client)
+			for button in self._buttons.values():
+				if button.handover is client:
+					button.handover = None
+				if client in button.channels:
+					del button.channels[client]
+					if button.active is client or len(button.channels) == 0:
+						self._set_active(button, None)
+						self._hunt(button)
+
+	def _add_channel(self, button, client):
+		channel = ButtonConnectionChannel(button.bd_addr, self.latency_mode)
+		channel.on_create_connection_channel_response = lambda channel, error, connection_status: self._on_create_response(button, client, channel, error, connection_status)
+		channel.on_connection_status_changed = lambda channel, connection_status, disconnect_reason: self._on_status(button, client, channel, connection_status)
+		channel.on_removed = lambda channel, removed_reason: self._on_removed(button, client, channel)
+		for event in self.events:
+			setattr(channel, _BUTTON_CALLBACKS[event], self._receiver(button.bd_addr, event, client))
+		button.channels[client] = channel
+		client.add_connection_channel(channel)
+
+	def _remove_channel(self, button, client):
+		channel = button.channels.pop(client)
+		client.remove_connection_channel(channel)
+		if button.handover is client:
+			button.handover = None
+		if button.active is client:
+			self._set_active(button, None)
+
+	def _set_active(self, button, client):
+		if button.active is not client:
+			button.active = client
+			self.on_active_gateway_changed(button.bd_addr, client)
+
+	def _hunt(self, button):
+		# Let every gateway try to connect; the first one that becomes Ready wins
+		for client in self.clients:
+			if client not in button.channels:
+				self._add_channel(button, client)
+
+	def _on_create_response(self, button, client, channel, error, connection_status):
+		with self._lock:
+			if getattr(error, "value", error) != CreateConnectionChannelError.NoError.value:
+				if button.channels.get(client) is channel:
+					del button.channels[client]
+					if button.handover is client:
+						button.handover = None
+				return
+		self._on_status(button, client, channel, connection_status)
+
+	def _on_status(self, button, client, channel, connection_status):
+		with self._lock:
+			if button.channels.get(client) is not channel or self._buttons.get(button.bd_addr) is not button:
+				return
+			status = getattr(connection_status, "value", connection_status)
+			if status == ConnectionStatus.Ready.value:
+				if button.handover is client:
+					button.handover = None
+				self._set_active(button, client)
+				# A handover still in progress keeps its new channel
+				for other in list(button.channels):
+					if other is not client and other is not button.handover:
+						self._remove_channel(button, other)
+			elif status == ConnectionStatus.Disconnected.value and button.active is client:
+				self._set_active(button, None)
+				self._hunt(button)
+
+	def _on_handover_timeout(self, button, client):
+		with self._lock:
+			if button.handover is not client or self._buttons.get(button.bd_addr) is not button:
+				return
+			# The button may only accept one connection at a time, so release it from the other gateways
+			for other in list(button.channels):
+				if other is not client:
+					self._remove_channel(button, other)
+
+	def _on_removed(self, button, client, channel):
+		with self._lock:
+			if button.channels.get(client) is not channel:
+				return
+			del button.channels[client]
+			if button.handover is client:
+				button.handover = None
+			if self._buttons.get(button.bd_addr) is button and (button.active is client or len(button.channels) == 0):
+				self._set_active(button, None)
+				self._hunt(button)
+
+	def _receiver(self, bd_addr, event, client):
+		def receive(channel, click_type, was_queued, time_diff):
+			press_time = time.monotonic() - time_diff
+			with self._lock:
+				is_new = self._index.add((bd_addr, event, getattr(click_type, "value", click_type)), press_time, client)
+			if is_new:
+				self.on_button_event(bd_addr, event, click_type, was_queued, press_time, client)
+		return receive
@@ -0,0 +1,275 @@
+"""Declarative button-to-action rules
+
+A RuleEngine reads a rule file (JSON, or YAML if PyYAML is installed), creates one connection channel per button
+and compiles the rules into a dispatch table keyed by (conn_id, opcode, click_type). Each button event costs one dictionary lookup.
+Actions run on a thread pool, so that a slow webhook never blocks the thread that handles the events, and every action has its own concurrency limit.
+
+Rule file:
+{
+	"actions": {
+		"lights": {"type": "webhook", "url": "http://hub.local/lights/toggle", "max_concurrency": 2},
+		"door": {"type": "command", "argv": ["/usr/local/bin/open-door"], "max_concurrency": 1, "max_pending": 0},
+		"notify": {"type": "python", "function": "mymodule:on_press"},
+		"bus": {"type": "mqtt", "hostname": "localhost", "topic": "flic/presses"}
+	},
+	"rules": [
+		{"bd_addr": "aa:bb:cc:dd:ee:ff", "click_type": "ButtonSingleClick", "actions": ["lights"]},
+		{"bd_addr": "aa:bb:cc:dd:ee:ff", "event": "ButtonClickOrHold", "click_type": "ButtonHold", "actions": ["door", "notify"]}
+	]
+}
+
+event is one of ButtonUpOrDown, ButtonClickOrHold, ButtonSingleOrDoubleClick and ButtonSingleOrDoubleClickOrHold (the default),
+and click_type must be one that the event delivers (e.g. ButtonClick or ButtonHold for ButtonClickOrHold).
+bd_addr, click_type and actions are required.
+Every action gets a dictionary with bd_addr, event, click_type (name), was_queued, time_diff and timestamp (time.time() at arrival).
+webhook actions POST it as JSON, command actions get it in the FLIC_* environment variables, python actions are called with it
+and mqtt actions (which require paho-mqtt) publish it as JSON.
+
+max_concurrency (default 1) limits how many runs of an action are in progress at once. Further triggers wait in a queue of
+max_pending entries (default 100); beyond that they are dropped and counted in stats.
+
+Usage:
+engine = RuleEngine(client, "rules.json")
+engine.start()
+engine.watch()
+client.handle_events()
+"""
+
+import concurrent.futures
+import importlib
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import deque
+
+from flicprotocol import ClickType, LatencyMode, ButtonConnectionChannel, _EVENT_NAME_TO_OPCODE, _unhandled
+
+_EVENT_CALLBACKS = [
+	("ButtonUpOrDown", "on_button_up_or_down"),
+	("ButtonClickOrHold", "on_button_click_or_hold"),
+	("ButtonSingleOrDoubleClick", "on_button_single_or_double_click"),
+	("ButtonSingleOrDoubleClickOrHold", "on_button_single_or_double_click_or_hold")
+]
+
+# The click types each event kind can deliver
+_EVENT_CLICK_TYPES = {
+	"ButtonUpOrDown": ("ButtonDown", "ButtonUp"),
+	"ButtonClickOrHold": ("ButtonClick", "ButtonHold"),
+	"ButtonSingleOrDoubleClick": ("ButtonSingleClick", "ButtonDoubleClick"),
+	"ButtonSingleOrDoubleClickOrHold": ("ButtonSingleClick", "ButtonDoubleClick", "ButtonHold")
+}
+
+def load_rules(path):
+	"""Read a rule file. Files ending in .yaml or .yml are parsed with PyYAML, all others as JSON."""
+	with open(path, "r") as f:
+		if path.endswith((".yaml", ".yml")):
+			import yaml
+			return yaml.safe_load(f)
+		return json.load(f)
+
+def _webhook(config):
+	url = config["url"]
+	timeout = config.get("timeout", 10)
+	def run(event):
+		request = urllib.request.Request(url, data=json.dumps(event).encode("utf-8"), headers={"Content-Type": "application/json"}, method=config.get("method", "POST"))
+		with urllib.request.urlopen(request, timeout=timeout) as response:
+			response.read()
+	return run
+
+def _command(config):
+	argv = list(config["argv"])
+	timeout = config.get("timeout")
+	def run(event):
+		env = dict(os.environ)
+		for key, value in event.items():
+			env["FLIC_" + key.upper()] = str(value)
+		subprocess.run(argv, env=env, timeout=timeout, check=True)
+	return run
+
+def _python(config):
+	module_name, function_name = config["function"].split(":")
+	return getattr(importlib.import_module(module_name), function_name)
+
+def _mqtt(config):
+	import paho.mqtt.publish
+	def run(event):
+		paho.mqtt.publish.single(config["topic"], json.dumps(event), qos=config.get("qos", 0), hostname=config.get("hostname", "localhost"), port=config.get("port", 1883))
+	return run
+
+ACTION_TYPES = {"webhook": _webhook, "command": _command, "python": _python, "mqtt": _mqtt}
+
+class _Action:
+	def __init__(self, name, config, executor):
+		if config.get("type") not in ACTION_TYPES:
+			raise ValueError("Action %s: unknown type %r" % (name, config.get("type")))
+		self.name = name
+		self.config = config
+		self.run = ACTION_TYPES[config["type"]](config)
+		self.max_concurrency = config.get("max_concurrency", 1)
+		self.max_pending = config.get("max_pending", 100)
+		if self.max_concurrency < 1 or self.max_pending < 0:
+			raise ValueError("Action %s: max_concurrency must be positive and max_pending non-negative" % name)
+		self.executor = executor
+		self.lock = threading.Lock()
+		self.pending = deque()
+		self.running = 0
+		self.executed = 0
+		self.failed = 0
+		self.dropped = 0
+
+	def trigger(self, event):
+		with self.lock:
+			if self.running < self.max_concurrency:
+				self.running += 1
+			elif len(self.pending) < self.max_pending:
+				self.pending.append(event)
+				return
+			else:
+				self.dropped += 1
+				return
+		self.executor.submit(self._worker, event)
+
+	def _worker(self, event):
+		# Keeps running queued events on this worker, instead of resubmitting, until the queue is empty
+		while True:
+			try:
+				self.run(event)
+				failed = False
+			except Exception:
+				failed = True
+			with self.lock:
+				if failed:
+					self.failed += 1
+				else:
+					self.executed += 1
+				if len(self.pending) == 0:
+					self.running -= 1
+					return
+				event = self.pending.popleft()
+
+class RuleEngine:
+	"""RuleEngine class.
+
+	start() loads the rules and creates the connection channels. reload() loads the rule file again: channels of buttons that are still used
+	are kept (no events are lost), new ones are added and unused ones removed, and the new dispatch table replaces the old one in a single assignment.
+	Actions whose configuration did not change keep their queue and counters. watch() reloads automatically when the file changes.
+
+	on_error: exception (called when reloading fails, the previous rules then stay active)
+	"""
+
+	def __init__(self, client, path, max_workers = 8, latency_mode = LatencyMode.NormalLatency):
+		self.client = client
+		self.path = path
+		self.latency_mode = latency_mode
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flicrules")
+		self._channels = {}
+		self._actions = {}
+		self._table = {}
+		self._dispatchers = {}
+		self._mtime = None
+		self._watching = False
+		self.on_error = lambda exception: None
+
+	def start(self):
+		self.reload()
+
+	def reload(self):
+		"""Load the rule file again and apply it. Raises on invalid rules, leaving the previous ones active."""
+		mtime = os.stat(self.path).st_mtime
+		config = load_rules(self.path)
+
+		actions = {}
+		for name, action_config in config.get("actions", {}).items():
+			old = self._actions.get(name)
+			actions[name] = old if old is not None and old.config == action_config else _Action(name, action_config, self._executor)
+
+		rules = []
+		for index, rule in enumerate(config.get("rules", [])):
+			for key in ("bd_addr", "actions"):
+				if key not in rule:
+					raise ValueError("Rule %d: missing %s" % (index, key))
+			event = rule.get("event", "ButtonSingleOrDoubleClickOrHold")
+			if event not in dict(_EVENT_CALLBACKS):
+				raise ValueError("Unknown event %r" % event)
+			if rule.get("click_type") not in ClickType.__members__:
+				raise ValueError("Unknown click type %r" % rule.get("click_type"))
+			if rule["click_type"] not in _EVENT_CLICK_TYPES[event]:
+				raise ValueError("Rule %d: %s events never have click type %s, use one of %s" % (index, event, rule["click_type"], ", ".join(_EVENT_CLICK_TYPES[event])))
+			for name in rule["actions"]:
+				if name not in actions:
+					raise ValueError("Unknown action %r" % name)
+			rules.append((rule["bd_addr"], event, ClickType[rule["click_type"]].value, [actions[name] for name in rule["actions"]]))
+
+		bd_addrs = set(rule[0] for rule in rules)
+		for bd_addr in bd_addrs:
+			if bd_addr not in self._channels:
+				self._channels[bd_addr] = ButtonConnectionChannel(bd_addr, self.latency_mode)
+
+		table = {}
+		callbacks = dict((bd_addr, set()) for bd_addr in bd_addrs)
+		for bd_addr, event, click_type, rule_actions in rules:
+			key = (self._channels[bd_addr]._conn_id, _EVENT_NAME_TO_OPCODE["Evt" + event], click_type)
+			table[key] = table.get(key, ()) + tuple(rule_actions)
+			callbacks[bd_addr].add(event)
+
+		# Swap in the new table before touching the channels, so that every event is dispatched with either the old or the new rules
+		self._table = table
+		self._actions = actions
+		self._mtime = mtime
+
+		for bd_addr, channel in list(self._channels.items()):
+			if bd_addr not in bd_addrs:
+				del self._channels[bd_addr]
+				self.client.remove_connection_channel(channel)
+				continue
+			for event, callback in _EVENT_CALLBACKS:
+				# Unused event kinds are left unhandled, so that the client skips them without decoding
+				dispatcher = self._dispatcher(event) if event in callbacks[bd_addr] else _unhandled
+				if getattr(channel, callback) is not dispatcher:
+					setattr(channel, callback, dispatcher)
+			self.client.add_connection_channel(channel)
+
+	def watch(self, interval_millis = 2000):
+		"""Check the rule file for changes every interval_millis, on the thread that handles the events."""
+		self._watching = True
+		def check():
+			if not self._watching:
+				return
+			try:
+				if os.stat(self.path).st_mtime != self._mtime:
+					self.reload()
+			except Exception as e:
+				self.on_error(e)
+			self.client.set_timer(interval_millis, check)
+		self.client.set_timer(interval_millis, check)
+
+	def close(self, wait = True):
+		"""Stop watching, remove the connection channels and shut down the action threads."""
+		self._watching = False
+		self._table = {}
+		for channel in self._channels.values():
+			self.client.remove_connection_channel(channel)
+		self._channels = {}
+		self._executor.shutdown(wait=wait)
+
+	@property
+	def stats(self):
+		"""A dictionary action name -> dictionary with executed, failed, dropped, running and pending counts."""
+		return dict((name, {"executed": action.executed, "failed": action.failed, "dropped": action.dropped, "running": action.running, "pending": len(action.pending)}) for name, action in self._actions.items())
+
+	def _dispatcher(self, event):
+		dispatchers = self._dispatchers
+		if event not in dispatchers:
+			opcode = _EVENT_NAME_TO_OPCODE["Evt" + event]
+			def dispatch(channel, click_type, was_queued, time_diff):
+				actions = self._table.get((channel._conn_id, opcode, getattr(click_type, "value", click_type)))
+				if actions is None:
+					return
+				event_dict = {"bd_addr": channel.bd_addr, "event": event, "click_type": ClickType(getattr(click_type, "value", click_type)).name, "was_queued": bool(was_queued), "time_diff": time_diff, "timestamp": time.time()}
+				for action in actions:
+					action.trigger(dict(event_dict))
+			dispatchers[event] = dispatch
+		return dispatchers[event]
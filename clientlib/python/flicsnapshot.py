@@ -0,0 +1,156 @@
+"""Snapshot of the verified button registry for fast startup
+
+Normally a client has to wait for the get_info response before it knows which buttons to create connection channels for.
+With a snapshot saved by a previous run, channels can instead be created optimistically right away,
+and the snapshot is reconciled against the server's list of verified buttons once get_info responds.
+
+Usage:
+def create_channel(bd_addr, latency_mode, auto_disconnect_time):
+	channel = fliclib.ButtonConnectionChannel(bd_addr, latency_mode, auto_disconnect_time)
+	channel.on_button_up_or_down = ...
+	return channel
+
+startup = FastStartup(client, "buttons.snapshot", create_channel)
+startup.start()
+client.on_new_verified_button = startup.add_button
+client.handle_events()
+"""
+
+import os
+import struct
+
+from fliclib import CreateConnectionChannelError, LatencyMode
+
+_MAGIC = b"FLSN"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBI")
+_RECORD = struct.Struct("<6sBh")
+
+class ButtonRegistrySnapshot:
+	"""ButtonRegistrySnapshot class.
+
+	An ordered mapping from bd addr to the channel configuration (latency_mode, auto_disconnect_time) of that button.
+	Stored on disk in a compact binary format, with bd addrs in the same byte order as in the protocol.
+	"""
+
+	def __init__(self, buttons = None):
+		self.buttons = dict(buttons) if buttons is not None else {}
+
+	@staticmethod
+	def load(path):
+		"""Load a snapshot from a file.
+
+		A missing, truncated or otherwise unreadable file results in an empty snapshot, since a snapshot is only an optimization.
+		"""
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+		except OSError:
+			return ButtonRegistrySnapshot()
+
+		if len(data) < _HEADER.size:
+			return ButtonRegistrySnapshot()
+		magic, version, count = _HEADER.unpack_from(data)
+		if magic != _MAGIC or version != _VERSION or len(data) != _HEADER.size + count * _RECORD.size:
+			return ButtonRegistrySnapshot()
+
+		buttons = {}
+		for bd_addr, latency_mode, auto_disconnect_time in _RECORD.iter_unpack(data[_HEADER.size:]):
+			try:
+				latency_mode = LatencyMode(latency_mode)
+			except ValueError:
+				latency_mode = LatencyMode.NormalLatency
+			buttons["%02x:%02x:%02x:%02x:%02x:%02x" % tuple(reversed(bd_addr))] = (latency_mode, auto_disconnect_time)
+		return ButtonRegistrySnapshot(buttons)
+
+	def save(self, path):
+		"""Save the snapshot to a file. The file is replaced atomically."""
+		data = bytearray(_HEADER.pack(_MAGIC, _VERSION, len(self.buttons)))
+		for bd_addr, (latency_mode, auto_disconnect_time) in self.buttons.items():
+			data += _RECORD.pack(bytes(reversed(bytes.fromhex(bd_addr.replace(":", "")))), latency_mode.value, auto_disconnect_time)
+
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "wb") as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, path)
+
+class FastStartup:
+	"""FastStartup class.
+
+	Creates connection channels from a snapshot as soon as start() is called, then reconciles them against get_info:
+	channels of buttons that are no longer verified are removed, and channels are created for verified buttons missing in the snapshot.
+	A channel whose creation fails is dropped; if that happens before the reconciliation and the button is verified, it is created again.
+	The snapshot file is rewritten after each reconciliation and whenever add_button or remove_button is called.
+
+	create_channel is called as create_channel(bd_addr, latency_mode, auto_disconnect_time) and must return a ButtonConnectionChannel
+	(with its callbacks set up) or None to skip the button. Buttons unknown to the snapshot get default_latency_mode and default_auto_disconnect_time.
+
+	on_reconciled, if assigned, is called with the get_info items once the reconciliation is done.
+	"""
+
+	def __init__(self, client, path, create_channel, default_latency_mode = LatencyMode.NormalLatency, default_auto_disconnect_time = 511):
+		self._client = client
+		self._path = path
+		self._create_channel = create_channel
+		self._default_config = (default_latency_mode, default_auto_disconnect_time)
+		self._channels = {}
+		self.on_reconciled = lambda items: None
+
+	@property
+	def channels(self):
+		"""The connection channels created by this object, by bd addr."""
+		return dict(self._channels)
+
+	def start(self):
+		"""Create the channels of the snapshot and request info from the server for the reconciliation."""
+		snapshot = ButtonRegistrySnapshot.load(self._path)
+		for bd_addr, config in snapshot.buttons.items():
+			self._add(bd_addr, config)
+		self._client.get_info(self._reconcile)
+
+	def add_button(self, bd_addr):
+		"""Create a channel for a newly verified button. Suitable as the client's on_new_verified_button callback."""
+		if bd_addr not in self._channels:
+			self._add(bd_addr, self._default_config)
+			self.save()
+
+	def remove_button(self, bd_addr):
+		"""Remove the channel of a button, e.g. after it was deleted."""
+		channel = self._channels.pop(bd_addr, None)
+		if channel is not None:
+			self._client.remove_connection_channel(channel)
+			self.save()
+
+	def save(self):
+		"""Write the current channel configuration to the snapshot file."""
+		ButtonRegistrySnapshot(dict((bd_addr, (channel.latency_mode, channel.auto_disconnect_time)) for bd_addr, channel in self._channels.items())).save(self._path)
+
+	def _add(self, bd_addr, config):
+		channel = self._create_channel(bd_addr, config[0], config[1])
+		if channel is not None:
+			previous = channel.on_create_connection_channel_response
+			def on_create_connection_channel_response(channel, error, connection_status):
+				# A failed channel is forgotten, so that the reconciliation creates it again if the button is verified
+				if getattr(error, "value", error) != CreateConnectionChannelError.NoError.value and self._channels.get(bd_addr) is channel:
+					del self._channels[bd_addr]
+				previous(channel, error, connection_status)
+			channel.on_create_connection_channel_response = on_create_connection_channel_response
+			self._channels[bd_addr] = channel
+			self._client.add_connection_channel(channel)
+
+	def _reconcile(self, items):
+		verified = items["bd_addr_of_verified_buttons"]
+		verified_set = set(verified)
+
+		for bd_addr in list(self._channels):
+			if bd_addr not in verified_set:
+				self._client.remove_connection_channel(self._channels.pop(bd_addr))
+
+		for bd_addr in verified:
+			if bd_addr not in self._channels:
+				self._add(bd_addr, self._default_config)
+
+		self.save()
+		self.on_reconciled(items)
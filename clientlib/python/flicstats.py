@@ -0,0 +1,223 @@
+"""Fixed-memory streaming usage statistics per button
+
+ButtonStatistics keeps, for up to max_buttons buttons, counters of presses, single clicks, double clicks and holds
+in a ring of per-minute buckets covering the last window_minutes, and quantile sketches of hold durations
+(time from ButtonDown to ButtonUp, using press times corrected by time_diff) and of the time_diff of ButtonDown and click events. Everything lives in preallocated arrays indexed by a slot per button,
+so an update costs O(1) and memory does not grow with the number of events. When a new button arrives and all slots are taken,
+the slot of the button that was recorded least recently is reused, found in O(1) from a least recently used order of the buttons.
+
+The sketches are log-scale histograms: a quantile is accurate to within the relative error (gamma - 1) / (gamma + 1).
+Each has two generations of window_minutes; the older one is dropped when a new one starts,
+so quantiles cover between one and two windows of recent history.
+
+Usage:
+stats = ButtonStatistics()
+stats.attach(channel)  # or call stats.record(...) from your own callbacks
+...
+print(json.dumps(stats.snapshot(), indent = 1))
+"""
+
+import array
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flicprotocol import ClickType, _unhandled
+
+_PRESSES = 0
+_SINGLE = 1
+_DOUBLE = 2
+_HOLD = 3
+_NB_COUNTERS = 4
+
+class LogHistogram:
+	"""LogHistogram class.
+
+	Bin layout of a quantile sketch: values up to min_value go to bin 0 and are reported as 0, and bin i > 0 holds values in
+	(min_value * gamma ** (i - 1), min_value * gamma ** i]. The last bin also holds everything larger.
+	"""
+
+	def __init__(self, min_value, gamma, nb_bins):
+		self.min_value = min_value
+		self.gamma = gamma
+		self.nb_bins = nb_bins
+		self._log_gamma = math.log(gamma)
+
+	def bin(self, value):
+		if value <= self.min_value:
+			return 0
+		return min(self.nb_bins - 1, 1 + int(math.log(value / self.min_value) / self._log_gamma))
+
+	def value(self, bin):
+		"""A representative value of a bin, with at most the relative error of the sketch for values in range."""
+		if bin == 0:
+			return 0
+		return self.min_value * self.gamma ** (bin - 1) * (1 + self.gamma) / 2
+
+	def quantile(self, counts, offset, q):
+		"""The q quantile of the counts[offset:offset + nb_bins] histogram, or None if it is empty."""
+		total = sum(counts[offset:offset + self.nb_bins])
+		if total == 0:
+			return None
+		rank = q * (total - 1)
+		seen = 0
+		for bin in range(self.nb_bins):
+			seen += counts[offset + bin]
+			if seen > rank:
+				return self.value(bin)
+		return self.value(self.nb_bins - 1)
+
+HOLD_DURATIONS = LogHistogram(0.01, 1.15, 64)
+TIME_DIFFS = LogHistogram(0.9, 1.25, 48)
+
+class ButtonStatistics:
+	"""ButtonStatistics class.
+
+	Thread safe: record() may be called from the thread that handles the events while snapshot() runs on another one.
+	"""
+
+	def __init__(self, max_buttons = 4096, window_minutes = 60, bucket_seconds = 60):
+		self.max_buttons = max_buttons
+		self.window_minutes = window_minutes
+		self.bucket_seconds = bucket_seconds
+		self._lock = threading.Lock()
+		# bd_addr -> slot, least recently seen first
+		self._slots = OrderedDict()
+		self._last_down = array.array("d", bytes(8 * max_buttons))
+		self._buckets = array.array("I", bytes(array.array("I").itemsize * max_buttons * window_minutes * _NB_COUNTERS))
+		self._bucket_times = array.array("q", [-1] * (max_buttons * window_minutes))
+		# Two sketch generations, newest first, each indexed by slot * nb_bins + bin
+		self._generation_start = None
+		self._hold_durations = [array.array("I", bytes(array.array("I").itemsize * max_buttons * HOLD_DURATIONS.nb_bins)) for i in range(2)]
+		self._time_diffs = [array.array("I", bytes(array.array("I").itemsize * max_buttons * TIME_DIFFS.nb_bins)) for i in range(2)]
+
+	@property
+	def nb_buttons(self):
+		return len(self._slots)
+
+	def attach(self, channel):
+		"""Feed the button events of a connection channel into these statistics.
+
+		Sets on_button_up_or_down and on_button_single_or_double_click_or_hold, calling the callbacks that were assigned before as well.
+		"""
+		for callback in ("on_button_up_or_down", "on_button_single_or_double_click_or_hold"):
+			previous = getattr(channel, callback)
+			def on_event(channel, click_type, was_queued, time_diff, previous = previous):
+				self.record(channel.bd_addr, click_type, time_diff)
+				if previous is not _unhandled:
+					previous(channel, click_type, was_queued, time_diff)
+			setattr(channel, callback, on_event)
+
+	def record(self, bd_addr, click_type, time_diff = 0, timestamp = None):
+		"""Count one button event. click_type may be a ClickType or its integer value. timestamp defaults to time.monotonic()."""
+		if timestamp is None:
+			timestamp = time.monotonic()
+		click_type = getattr(click_type, "value", click_type)
+		press_time = timestamp - time_diff
+		with self._lock:
+			slot = self._slots.get(bd_addr)
+			if slot is None:
+				slot = self._allocate(bd_addr)
+			else:
+				self._slots.move_to_end(bd_addr)
+			self._rotate(timestamp)
+
+			counter = None
+			if click_type == ClickType.ButtonDown.value:
+				counter = _PRESSES
+				self._last_down[slot] = press_time
+			elif click_type == ClickType.ButtonUp.value:
+				if self._last_down[slot] > 0:
+					self._hold_durations[0][slot * HOLD_DURATIONS.nb_bins + HOLD_DURATIONS.bin(press_time - self._last_down[slot])] += 1
+					self._last_down[slot] = 0
+			elif click_type == ClickType.ButtonSingleClick.value:
+				counter = _SINGLE
+			elif click_type == ClickType.ButtonDoubleClick.value:
+				counter = _DOUBLE
+			elif click_type == ClickType.ButtonHold.value:
+				counter = _HOLD
+			if counter is not None:
+				self._buckets[self._bucket(slot, timestamp) * _NB_COUNTERS + counter] += 1
+				self._time_diffs[0][slot * TIME_DIFFS.nb_bins + TIME_DIFFS.bin(time_diff)] += 1
+
+	def snapshot(self, now = None):
+		"""Returns a dictionary bd_addr -> statistics over the window, ready to be serialized as JSON:
+		presses, single_clicks, double_clicks, holds, presses_per_minute, double_click_ratio (double clicks per click, or None),
+		hold_duration_p50, hold_duration_p95 (seconds), time_diff_p50, time_diff_p95 (None while nothing has been recorded).
+		"""
+		if now is None:
+			now = time.monotonic()
+		current = int(now // self.bucket_seconds)
+		window = self.window_minutes
+		result = {}
+		with self._lock:
+			self._rotate(now)
+			for bd_addr, slot in self._slots.items():
+				counters = [0] * _NB_COUNTERS
+				for i in range(window):
+					bucket_time = self._bucket_times[slot * window + i]
+					if bucket_time >= 0 and current - bucket_time < window:
+						base = (slot * window + i) * _NB_COUNTERS
+						for counter in range(_NB_COUNTERS):
+							counters[counter] += self._buckets[base + counter]
+				hold_durations = self._merged(self._hold_durations, slot, HOLD_DURATIONS)
+				time_diffs = self._merged(self._time_diffs, slot, TIME_DIFFS)
+				clicks = counters[_SINGLE] + counters[_DOUBLE]
+				result[bd_addr] = {
+					"presses": counters[_PRESSES],
+					"single_clicks": counters[_SINGLE],
+					"double_clicks": counters[_DOUBLE],
+					"holds": counters[_HOLD],
+					"presses_per_minute": counters[_PRESSES] * 60.0 / (window * self.bucket_seconds),
+					"double_click_ratio": counters[_DOUBLE] / clicks if clicks > 0 else None,
+					"hold_duration_p50": HOLD_DURATIONS.quantile(hold_durations, 0, 0.5),
+					"hold_duration_p95": HOLD_DURATIONS.quantile(hold_durations, 0, 0.95),
+					"time_diff_p50": TIME_DIFFS.quantile(time_diffs, 0, 0.5),
+					"time_diff_p95": TIME_DIFFS.quantile(time_diffs, 0, 0.95)
+				}
+		return result
+
+	def _merged(self, generations, slot, layout):
+		offset = slot * layout.nb_bins
+		return [generations[0][offset + i] + generations[1][offset + i] for i in range(layout.nb_bins)]
+
+	def _bucket(self, slot, timestamp):
+		# Returns the index of the bucket for timestamp, clearing it first if it still holds an older minute
+		bucket_time = int(timestamp // self.bucket_seconds)
+		index = slot * self.window_minutes + bucket_time % self.window_minutes
+		if self._bucket_times[index] != bucket_time:
+			self._bucket_times[index] = bucket_time
+			base = index * _NB_COUNTERS
+			for counter in range(_NB_COUNTERS):
+				self._buckets[base + counter] = 0
+		return index
+
+	def _rotate(self, timestamp):
+		# Starts a new sketch generation every window, dropping the oldest
+		if self._generation_start is None:
+			self._generation_start = timestamp
+		elif timestamp - self._generation_start >= self.window_minutes * self.bucket_seconds:
+			self._generation_start = timestamp
+			for generations in (self._hold_durations, self._time_diffs):
+				oldest = generations.pop()
+				generations.insert(0, array.array("I", bytes(oldest.itemsize * len(oldest))))
+
+	def _allocate(self, bd_addr):
+		if len(self._slots) < self.max_buttons:
+			slot = len(self._slots)
+		else:
+			slot = self._slots.popitem(last = False)[1]
+			self._clear(slot)
+		self._slots[bd_addr] = slot
+		return slot
+
+	def _clear(self, slot):
+		window = self.window_minutes
+		for i in range(slot * window, (slot + 1) * window):
+			self._bucket_times[i] = -1
+		self._last_down[slot] = 0
+		for generations, layout in ((self._hold_durations, HOLD_DURATIONS), (self._time_diffs, TIME_DIFFS)):
+			for counts in generations:
+				for i in range(slot * layout.nb_bins, (slot + 1) * layout.nb_bins):
+					counts[i] = 0
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""Live terminal monitor of a flicd server
+
+Connects as an ordinary client, creates a connection channel and a battery status listener for every verified button
+(and for buttons verified later), and shows per button the event rate, total events, connection status, battery level
+and time since the last event, together with the server state and the round trip time of a ping.
+
+The table is redrawn at most once per interval, and only the lines that changed are rewritten, so the monitor adds
+one ping and a few terminal writes per interval on top of the events it receives. Only ButtonUpOrDown events are
+subscribed to; all other button event kinds are skipped by the client without being decoded.
+When the output is not a terminal, the full table is printed once per interval instead.
+
+Usage:
+python3 flictop.py --host localhost --interval 2
+python3 -m flictop
+"""
+
+import argparse
+import shutil
+import sys
+import time
+
+import fliclib
+
+class _Button:
+	def __init__(self, bd_addr):
+		self.bd_addr = bd_addr
+		self.events = 0
+		self.events_at_last_refresh = 0
+		self.rate = 0.0
+		self.status = "-"
+		self.battery = None
+		self.last_event = None
+
+class Monitor:
+	"""Monitor class.
+
+	Collects the state shown by flictop from a fliclib.FlicClient. render() returns the lines of the table.
+	"""
+
+	def __init__(self, client, interval = 1.0):
+		self.client = client
+		self.interval = interval
+		self.info = None
+		self.ping_rtt = None
+		self.ping_sent = None
+		self.buttons = {}
+		self._last_refresh = None
+
+	def start(self):
+		self.client.on_new_verified_button = self.add_button
+		self.client.get_info(self._on_info)
+
+	def add_button(self, bd_addr):
+		if bd_addr in self.buttons:
+			return
+		button = _Button(bd_addr)
+		self.buttons[bd_addr] = button
+
+		channel = fliclib.ButtonConnectionChannel(bd_addr)
+		def on_event(channel, click_type, was_queued, time_diff):
+			button.events += 1
+			button.last_event = time.monotonic()
+		def on_status(channel, connection_status, disconnect_reason):
+			button.status = connection_status.name if hasattr(connection_status, "name") else str(connection_status)
+		channel.on_button_up_or_down = on_event
+		channel.on_connection_status_changed = on_status
+		channel.on_create_connection_channel_response = lambda channel, error, connection_status: on_status(channel, connection_status, None)
+		self.client.add_connection_channel(channel)
+
+		listener = fliclib.BatteryStatusListener(bd_addr)
+		def on_battery_status(listener, battery_percentage, timestamp):
+			button.battery = battery_percentage
+		listener.on_battery_status = on_battery_status
+		self.client.add_battery_status_listener(listener)
+
+	def refresh(self):
+		"""Update the rates and send a ping. Called once per interval."""
+		now = time.monotonic()
+		elapsed = now - self._last_refresh if self._last_refresh is not None else None
+		self._last_refresh = now
+		for button in self.buttons.values():
+			if elapsed is not None and elapsed > 0:
+				button.rate = (button.events - button.events_at_last_refresh) / elapsed
+			button.events_at_last_refresh = button.events
+
+		if self.ping_sent is None:
+			self.ping_sent = now
+			self.client.ping(self._on_ping_response)
+		self.client.get_info(self._on_info)
+
+	def render(self, max_lines = None):
+		now = time.monotonic()
+		lines = []
+		info = self.info
+		if info is not None:
+			lines.append("controller %s  pending connections %d/%d  no space %s  verified %d" % (
+				getattr(info["bluetooth_controller_state"], "name", info["bluetooth_controller_state"]), info["current_pending_connections"],
+				info["max_pending_connections"], "yes" if info["currently_no_space_for_new_connection"] else "no", len(info["bd_addr_of_verified_buttons"])))
+		else:
+			lines.append("waiting for the server...")
+		total_rate = sum(button.rate for button in self.buttons.values())
+		lines.append("ping %s  events %.1f/s  skipped %d" % ("%.2f ms" % (self.ping_rtt * 1000) if self.ping_rtt is not None else "-",
+			total_rate, sum(self.client.skipped_events.values())))
+		lines.append("")
+		lines.append("%-17s %10s %10s %-12s %8s %10s" % ("BD ADDR", "EVENTS/S", "EVENTS", "STATUS", "BATTERY", "LAST"))
+		buttons = sorted(self.buttons.values(), key=lambda button: (-button.rate, button.bd_addr))
+		if max_lines is not None:
+			buttons = buttons[:max(0, max_lines - len(lines))]
+		for button in buttons:
+			battery = "-" if button.battery is None or button.battery < 0 else "%d%%" % button.battery
+			last = "-" if button.last_event is None else "%.0f s" % (now - button.last_event)
+			lines.append("%-17s %10.1f %10d %-12s %8s %10s" % (button.bd_addr, button.rate, button.events, button.status, battery, last))
+		return lines
+
+	def _on_info(self, info):
+		self.info = info
+		for bd_addr in info["bd_addr_of_verified_buttons"]:
+			self.add_button(bd_addr)
+
+	def _on_ping_response(self):
+		self.ping_rtt = time.monotonic() - self.ping_sent
+		self.ping_sent = None
+
+class TerminalView:
+	"""TerminalView class.
+
+	Draws lines on a terminal, rewriting only the lines that differ from the previous frame.
+	"""
+
+	def __init__(self, stream):
+		self.stream = stream
+		self._previous = []
+
+	def draw(self, lines):
+		output = []
+		if len(self._previous) == 0:
+			output.append("\x1b[2J")
+		for row, line in enumerate(lines):
+			if row >= len(self._previous) or self._previous[row] != line:
+				output.append("\x1b[%d;1H%s\x1b[K" % (row + 1, line))
+		for row in range(len(lines), len(self._previous)):
+			output.append("\x1b[%d;1H\x1b[K" % (row + 1))
+		output.append("\x1b[%d;1H" % (len(lines) + 1))
+		self._previous = list(lines)
+		self.stream.write("".join(output))
+		self.stream.flush()
+
+def main():
+	parser = argparse.ArgumentParser(description="Live monitor of the buttons of a flicd server.")
+	parser.add_argument("--host", default="localhost", help="host name, or unix:/path of a Unix socket")
+	parser.add_argument("--port", type=int, default=5551)
+	parser.add_argument("--interval", type=float, default=1.0, help="seconds between refreshes (minimum 0.2)")
+	parser.add_argument("--count", type=int, default=0, help="exit after this many refreshes (0 = run until interrupted)")
+	args = parser.parse_args()
+
+	interval = max(args.interval, 0.2)
+	client = fliclib.FlicClient(args.host, args.port)
+	monitor = Monitor(client, interval)
+	view = TerminalView(sys.stdout) if sys.stdout.isatty() else None
+	refreshes = [0]
+
+	def tick():
+		monitor.refresh()
+		if view is not None:
+			view.draw(monitor.render(shutil.get_terminal_size().lines - 1))
+		else:
+			print("\n".join(monitor.render()) + "\n")
+		refreshes[0] += 1
+		if args.count > 0 and refreshes[0] >= args.count:
+			client.close()
+			return
+		client.set_timer(int(interval * 1000), tick)
+
+	monitor.start()
+	client.set_timer(int(interval * 1000), tick)
+	try:
+		client.handle_events()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
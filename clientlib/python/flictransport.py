@@ -0,0 +1,84 @@
+"""Transport options for the Flic clients
+
+The protocol sends many small packets in both directions, so by default TCP_NODELAY is set: without it, a command written right after
+another one can be held back by Nagle's algorithm until the server's delayed ACK of the first one arrives.
+TransportOptions also sets the socket buffer sizes and TCP keepalive, and limits the time to connect.
+
+Endpoints: a host name and port for TCP, or "unix:" followed by a path (the port is then ignored) for a Unix socket,
+for example a local stand-in such as fakeflicd --unix. An already connected socket, such as one end of a socket.socketpair(),
+can be given to fliclib.FlicClient or aioflic.open_connection as sock, and gets the options that apply to it.
+
+Usage:
+options = TransportOptions(keepalive = True, connect_timeout = 5)
+client = fliclib.FlicClient("localhost", transport_options = options)
+transport, client = await aioflic.open_connection(loop, "unix:/run/flicd.sock", transport_options = options)
+"""
+
+_UNIX_PREFIX = "unix:"
+
+def unix_path(host):
+	"""Returns the socket path if host is a "unix:" endpoint, otherwise None."""
+	if isinstance(host, str) and host.startswith(_UNIX_PREFIX):
+		return host[len(_UNIX_PREFIX):]
+	return None
+
+class TransportOptions:
+	"""TransportOptions class.
+
+	nodelay: set TCP_NODELAY (default True)
+	rcvbuf, sndbuf: SO_RCVBUF and SO_SNDBUF in bytes (None leaves the system default)
+	keepalive: enable SO_KEEPALIVE; keepalive_idle, keepalive_interval (seconds) and keepalive_count tune it where the platform supports it
+	connect_timeout: seconds to wait for the connection to be established (None waits as long as the system does)
+
+	TCP options are skipped for Unix sockets.
+	"""
+
+	def __init__(self, nodelay = True, rcvbuf = None, sndbuf = None, keepalive = False, keepalive_idle = None, keepalive_interval = None, keepalive_count = None, connect_timeout = None):
+		self.nodelay = nodelay
+		self.rcvbuf = rcvbuf
+		self.sndbuf = sndbuf
+		self.keepalive = keepalive
+		self.keepalive_idle = keepalive_idle
+		self.keepalive_interval = keepalive_interval
+		self.keepalive_count = keepalive_count
+		self.connect_timeout = connect_timeout
+
+	def __repr__(self):
+		return "TransportOptions(%s)" % ", ".join("%s=%r" % item for item in sorted(vars(self).items()))
+
+	def apply(self, sock):
+		"""Set the options on a socket (or on the socket of an asyncio transport, from get_extra_info("socket"))."""
+		import socket
+
+		if self.rcvbuf is not None:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+		if self.sndbuf is not None:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+		if sock.family not in (socket.AF_INET, socket.AF_INET6):
+			return
+
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if self.keepalive else 0)
+		if self.keepalive:
+			for name, value in (("TCP_KEEPIDLE", self.keepalive_idle), ("TCP_KEEPINTVL", self.keepalive_interval), ("TCP_KEEPCNT", self.keepalive_count)):
+				if value is not None and hasattr(socket, name):
+					sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+	def connect(self, host, port = 5551):
+		"""Connect a blocking socket to a TCP or "unix:" endpoint and apply the options to it."""
+		import socket
+
+		path = unix_path(host)
+		if path is not None:
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				sock.settimeout(self.connect_timeout)
+				sock.connect(path)
+			except OSError:
+				sock.close()
+				raise
+		else:
+			sock = socket.create_connection((host, port), self.connect_timeout)
+		sock.settimeout(None)
+		self.apply(sock)
+		return sock
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""WebSocket bridge for the Flic protocol
+
+A Python equivalent of clientlib/websocket/server, for use with clientlib/websocket/client/fliclib.js.
+As in the native proxy, every command and event is one binary WebSocket message holding a Flic protocol packet without the length prefix.
+
+Unlike the native proxy, many browser sessions share one upstream aioflic FlicClient connection to flicd.
+Packets are forwarded as they are; the only change made to them is that the identifier a command or event starts with
+(scan_id, conn_id, ping_id, scan_wizard_id or listener_id) is swapped between the session's own value and a value that is unique on the upstream connection.
+Responses to CmdGetInfo and CmdGetButtonInfo are routed back in request order, and events that are not tied to an identifier are sent to every session.
+When a session closes, its scanners, connection channels, scan wizards and battery status listeners are removed upstream.
+
+Usage:
+python3 flicwsbridge.py localhost 5551 127.0.0.1 5553
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import hashlib
+import itertools
+import struct
+
+import aioflic
+
+_WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_ID_FIELDS = ("scan_id", "conn_id", "ping_id", "scan_wizard_id", "listener_id")
+_ID = struct.Struct("<I")
+_FRAME_HEADER = struct.Struct("<H")
+
+# Close frame payloads with status 1002, protocol error, and 1009, message too big
+_CLOSE_PROTOCOL_ERROR = struct.pack(">H", 1002)
+_CLOSE_MESSAGE_TOO_BIG = struct.pack(">H", 1009)
+# Seconds to wait for the peer to close after we sent a close frame
+_CLOSE_TIMEOUT = 5
+
+def _opcodes(table):
+    return dict((x[0], i) for i, x in enumerate(table))
+
+def _id_fields(table):
+    result = {}
+    for opcode, x in enumerate(table):
+        fields = x[2].split()
+        if len(fields) > 0 and fields[0] in _ID_FIELDS:
+            result[opcode] = fields[0]
+    return result
+
+_COMMAND_OPCODES = _opcodes(aioflic.FlicClient._COMMANDS)
+_EVENT_OPCODES = _opcodes(aioflic.FlicClient._EVENTS)
+_COMMAND_ID_FIELDS = _id_fields(aioflic.FlicClient._COMMANDS)
+_EVENT_ID_FIELDS = _id_fields(aioflic.FlicClient._EVENTS)
+
+# Commands after which an identifier is released right away, since flicd doesn't confirm them
+_RELEASING_COMMANDS = frozenset([_COMMAND_OPCODES["CmdRemoveScanner"], _COMMAND_OPCODES["CmdRemoveBatteryStatusListener"]])
+
+# Events after which an identifier is released
+_RELEASING_EVENTS = frozenset([_EVENT_OPCODES["EvtConnectionChannelRemoved"], _EVENT_OPCODES["EvtScanWizardCompleted"], _EVENT_OPCODES["EvtPingResponse"]])
+
+# Commands sent upstream for the identifiers still held by a session when it closes
+_CLEANUP_COMMANDS = {
+    "scan_id": _COMMAND_OPCODES["CmdRemoveScanner"],
+    "conn_id": _COMMAND_OPCODES["CmdRemoveConnectionChannel"],
+    "scan_wizard_id": _COMMAND_OPCODES["CmdCancelScanWizard"],
+    "listener_id": _COMMAND_OPCODES["CmdRemoveBatteryStatusListener"]
+}
+
+_BROADCAST_EVENTS = frozenset(opcode for opcode in range(len(aioflic.FlicClient._EVENTS)) if opcode not in _EVENT_ID_FIELDS) - frozenset([_EVENT_OPCODES["EvtGetInfoResponse"], _EVENT_OPCODES["EvtGetButtonInfoResponse"]])
+
+def websocket_frame_header(opcode, length):
+    """Header of an unmasked, final WebSocket frame."""
+    if length < 126:
+        return bytes([0x80 | opcode, length])
+    if length < 65536:
+        return struct.pack(">BBH", 0x80 | opcode, 126, length)
+    return struct.pack(">BBQ", 0x80 | opcode, 127, length)
+
+def unmask(payload, mask):
+    if len(payload) == 0:
+        return payload
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")).to_bytes(len(payload), "little")
+
+async def _discard_until_eof(reader, timeout):
+    # Closing the socket while the peer is still sending resets the connection, and the peer may then never see our close frame
+    async def discard():
+        while len(await reader.read(65536)) > 0:
+            pass
+    try:
+        await asyncio.wait_for(discard(), timeout)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+async def _fail(session, reader, close_payload):
+    session.send_frame(websocket_frame_header(0x8, len(close_payload)), close_payload)
+    await _discard_until_eof(reader, _CLOSE_TIMEOUT)
+
+class _Session:
+    def __init__(self, upstream, writer, max_buffer):
+        self.upstream = upstream
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.closed = False
+
+    def send_packet(self, packet):
+        self.send_frame(websocket_frame_header(0x2, len(packet)), packet)
+
+    def send_frame(self, header, payload):
+        if self.closed:
+            return
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() > self.max_buffer:
+            # The browser doesn't keep up, so rather disconnect it than buffering without limit
+            self.closed = True
+            transport.abort()
+            return
+        transport.writelines([header, payload])
+
+class _Upstream(aioflic.FlicClient):
+    def __init__(self, loop, bridge):
+        super().__init__(loop)
+        self._bridge = bridge
+        self.sessions = set()
+        self._ids = itertools.count(1)
+        self._local_to_global = {}
+        self._global_to_local = {}
+        self._get_info_sessions = collections.deque()
+        self._get_button_info_sessions = collections.deque()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._bridge._upstreams.discard(self)
+        for session in list(self.sessions):
+            session.closed = True
+            session.writer.close()
+
+    def forward_command(self, session, packet):
+        if len(packet) == 0:
+            return
+        opcode = packet[0]
+        field = _COMMAND_ID_FIELDS.get(opcode)
+        if field is not None:
+            if len(packet) < 5:
+                return
+            local_id = _ID.unpack_from(packet, 1)[0]
+            key = (session, field, local_id)
+            global_id = self._local_to_global.get(key)
+            if field == "ping_id" or global_id is None:
+                global_id = next(self._ids)
+                if field != "ping_id":
+                    self._local_to_global[key] = global_id
+                self._global_to_local[(field, global_id)] = (session, local_id)
+            packet = bytearray(packet)
+            _ID.pack_into(packet, 1, global_id)
+            if opcode in _RELEASING_COMMANDS:
+                self._release(field, global_id)
+        elif opcode == _COMMAND_OPCODES["CmdGetInfo"]:
+            self._get_info_sessions.append(session)
+        elif opcode == _COMMAND_OPCODES["CmdGetButtonInfo"]:
+            self._get_button_info_sessions.append(session)
+        self.transport.write(_FRAME_HEADER.pack(len(packet)) + packet)
+
+    def remove_session(self, session):
+        self.sessions.discard(session)
+        cleanup = bytearray()
+        for (owner, field, local_id), global_id in list(self._local_to_global.items()):
+            if owner is not session:
+                continue
+            del self._local_to_global[(owner, field, local_id)]
+            # Events that still arrive for this identifier are dropped until it is released
+            self._global_to_local[(field, global_id)] = (None, local_id)
+            opcode = _CLEANUP_COMMANDS.get(field)
+            if opcode is not None:
+                cleanup += _FRAME_HEADER.pack(5) + bytes([opcode]) + _ID.pack(global_id)
+                if opcode in _RELEASING_COMMANDS:
+                    del self._global_to_local[(field, global_id)]
+        for key in [key for key, value in self._global_to_local.items() if value[0] is session]:
+            self._global_to_local[key] = (None, self._global_to_local[key][1])
+        if len(cleanup) > 0 and not self._closed:
+            self.transport.write(cleanup)
+
+    def _release(self, field, global_id):
+        session, local_id = self._global_to_local.pop((field, global_id), (None, None))
+        if session is not None:
+            self._local_to_global.pop((session, field, local_id), None)
+
+    def _dispatch_event(self, data):
+        if len(data) == 0:
+            return
+        opcode = data[0]
+        field = _EVENT_ID_FIELDS.get(opcode)
+        if field is not None:
+            if len(data) < 5:
+                return
+            global_id = _ID.unpack_from(data, 1)[0]
+            session, local_id = self._global_to_local.get((field, global_id), (None, None))
+            if opcode in _RELEASING_EVENTS or (opcode == _EVENT_OPCODES["EvtCreateConnectionChannelResponse"] and len(data) > 5 and data[5] != 0):
+                self._release(field, global_id)
+            if session is not None:
+                session.send_packet(data[:1] + _ID.pack(local_id) + data[5:])
+        elif opcode == _EVENT_OPCODES["EvtGetInfoResponse"]:
+            if len(self._get_info_sessions) > 0:
+                self._get_info_sessions.popleft().send_packet(data)
+        elif opcode == _EVENT_OPCODES["EvtGetButtonInfoResponse"]:
+            if len(self._get_button_info_sessions) > 0:
+                self._get_button_info_sessions.popleft().send_packet(data)
+        elif opcode in _BROADCAST_EVENTS:
+            header = websocket_frame_header(0x2, len(data))
+            for session in self.sessions:
+                session.send_frame(header, data)
+
+class WebSocketBridge:
+    """WebSocketBridge class.
+
+    Accepts WebSocket connections from browsers and multiplexes them onto upstream connections to flicd,
+    with at most sessions_per_upstream browser sessions per upstream connection.
+    A session whose unsent data exceeds max_session_buffer bytes is disconnected.
+    A session that sends a message longer than max_message_size bytes, counting all of its fragments, is closed with status 1009.
+    """
+
+    def __init__(self, flicd_host="localhost", flicd_port=5551, sessions_per_upstream=256, max_session_buffer=1 << 20, max_message_size=65535):
+        self._flicd_host = flicd_host
+        self._flicd_port = flicd_port
+        self._sessions_per_upstream = sessions_per_upstream
+        self._max_session_buffer = max_session_buffer
+        self._max_message_size = max_message_size
+        self._upstreams = set()
+        self._connecting = None
+
+    @property
+    def upstream_count(self):
+        return len(self._upstreams)
+
+    @property
+    def session_count(self):
+        return sum(len(upstream.sessions) for upstream in self._upstreams)
+
+    async def serve(self, host="127.0.0.1", port=5553):
+        """Start accepting WebSocket connections. Returns the asyncio server."""
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _get_upstream(self):
+        while True:
+            for upstream in self._upstreams:
+                if len(upstream.sessions) < self._sessions_per_upstream:
+                    return upstream
+            if self._connecting is None:
+                loop = asyncio.get_event_loop()
+                self._connecting = asyncio.ensure_future(loop.create_connection(lambda: _Upstream(loop, self), self._flicd_host, self._flicd_port))
+                try:
+                    transport, upstream = await self._connecting
+                    self._upstreams.add(upstream)
+                finally:
+                    self._connecting = None
+                return upstream
+            await asyncio.wait([self._connecting])
+
+    async def _handle_connection(self, reader, writer):
+        websocket_key = None
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                writer.close()
+                return
+            line = line.strip()
+            if len(line) == 0:
+                break
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                websocket_key = value.strip()
+
+        if websocket_key is None:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\nConnection: close\r\nContent-Length: 9\r\n\r\nNot Found")
+            writer.close()
+            return
+
+        try:
+            upstream = await self._get_upstream()
+        except OSError:
+            writer.write(b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+            writer.close()
+            return
+
+        accept = base64.b64encode(hashlib.sha1(websocket_key + _WEBSOCKET_GUID).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+        session = _Session(upstream, writer, self._max_session_buffer)
+        upstream.sessions.add(session)
+        try:
+            fragments = []
+            message_size = 0
+            while not session.closed:
+                header = await reader.readexactly(2)
+                opcode = header[0] & 0xf
+                length = header[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack(">H", await reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", await reader.readexactly(8))[0]
+                mask = await reader.readexactly(4) if header[1] & 0x80 else None
+                if opcode >= 8:
+                    # Control frames are at most 125 bytes and never fragmented
+                    if length > 125 or not header[0] & 0x80:
+                        await _fail(session, reader, _CLOSE_PROTOCOL_ERROR)
+                        break
+                else:
+                    message_size += length
+                    if message_size > self._max_message_size:
+                        await _fail(session, reader, _CLOSE_MESSAGE_TOO_BIG)
+                        break
+                payload = await reader.readexactly(length)
+                if mask is not None:
+                    payload = unmask(payload, mask)
+
+                if opcode < 8:
+                    fragments.append(payload)
+                    if header[0] & 0x80:
+                        upstream.forward_command(session, b"".join(fragments))
+                        fragments = []
+                        message_size = 0
+                elif opcode == 0x8:
+                    # Echo the status code, as the closing handshake asks for
+                    session.send_frame(websocket_frame_header(0x8, min(len(payload), 2)), payload[:2])
+                    break
+                elif opcode == 0x9:
+                    session.send_frame(websocket_frame_header(0xa, len(payload)), payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            session.closed = True
+            upstream.remove_session(session)
+            writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket bridge for the Flic protocol.")
+    parser.add_argument("flicd_host")
+    parser.add_argument("flicd_port", type=int)
+    parser.add_argument("bind_addr")
+    parser.add_argument("bind_port", type=int)
+    parser.add_argument("--sessions-per-upstream", type=int, default=256)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    bridge = WebSocketBridge(args.flicd_host, args.flicd_port, args.sessions_per_upstream)
+    server = loop.run_until_complete(bridge.serve(args.bind_addr, args.bind_port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.close()
+
+if __name__ == "__main__":
+    main()
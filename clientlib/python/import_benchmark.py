@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Import time benchmark with a budget.
+#
+# Imports a module in fresh interpreters with -X importtime and reports the median cumulative import time of the module
+# itself (interpreter startup excluded). Exits with status 1 if the median exceeds the budget, so that it can be run in CI.
+# One import is done first to write the bytecode cache, since that is the normal situation on a gateway that restarts.
+#
+# Usage:
+# python3 import_benchmark.py --module fliclib --budget-ms 20
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)\s*$")
+
+def import_time_us(module, env):
+	"""Returns the cumulative import time of module in microseconds, measured in a new interpreter."""
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+	for line in result.stderr.splitlines():
+		match = _IMPORTTIME_LINE.match(line)
+		if match is not None and match.group(3) == module:
+			return int(match.group(2))
+	raise RuntimeError("No import time reported for " + module)
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the import time of a module and check it against a budget.")
+	parser.add_argument("--module", action="append", help="module to import (default fliclib), may be repeated")
+	parser.add_argument("--runs", type=int, default=15)
+	parser.add_argument("--budget-ms", type=float, default=20.0, help="maximum median import time per module")
+	args = parser.parse_args()
+
+	env = dict(os.environ)
+	env.pop("PYTHONDONTWRITEBYTECODE", None)
+	env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + env.get("PYTHONPATH", "")
+
+	over_budget = False
+	for module in args.module or ["fliclib"]:
+		import_time_us(module, env)
+		times = [import_time_us(module, env) / 1000.0 for i in range(args.runs)]
+		median = statistics.median(times)
+		verdict = "ok" if median <= args.budget_ms else "OVER BUDGET"
+		print("%s: median %.2f ms, min %.2f ms, max %.2f ms (budget %.2f ms) %s" % (module, median, min(times), max(times), args.budget_ms, verdict))
+		over_budget = over_budget or median > args.budget_ms
+	sys.exit(1 if over_budget else 0)
+
+if __name__ == "__main__":
+	main()
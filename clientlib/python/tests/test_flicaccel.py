@@ -0,0 +1,32 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import accel_check
+import flicprotocol
+
+@unittest.skipIf(accel_check._flicaccel is None, "_flicaccel is not built, run make first")
+class DifferentialTest(unittest.TestCase):
+	def test_random_and_edge_case_input(self):
+		for seed in range(1, 4):
+			self.assertIsNone(accel_check.check(2000, seed))
+
+	def test_valid_packets_of_every_event(self):
+		for opcode, event_struct in enumerate(flicprotocol._EVENT_STRUCTS):
+			data = bytes([opcode]) + bytes(range(event_struct.size))
+			for arg in (data, bytearray(data), memoryview(data)):
+				expected = flicprotocol._py_unpack_event(arg)
+				actual = accel_check._flicaccel.unpack_event(arg)
+				self.assertTrue(accel_check.same(expected, actual), "%s: %r != %r" % (flicprotocol._EVENTS[opcode][0], expected, actual))
+
+	def test_split_packets(self):
+		stream = bytearray(b"\x02\x00\x12\x34\x00\x00\x03\x00\xff")
+		for end in range(len(stream) + 1):
+			expected = flicprotocol._py_split_packets(stream[:end])
+			actual = accel_check._flicaccel.split_packets(stream[:end])
+			self.assertTrue(accel_check.same(expected, actual), "%d: %r != %r" % (end, expected, actual))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,46 @@
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flicbatch
+import flicprotocol
+
+def _frame(name, *fields):
+	opcode = flicprotocol._EVENT_NAME_TO_OPCODE[name]
+	packet = bytes([opcode]) + flicprotocol._EVENT_STRUCTS[opcode].pack(*fields)
+	return struct.pack("<H", len(packet)) + packet
+
+def _stream():
+	return b"".join([
+		_frame("EvtButtonUpOrDown", 7, 0, 0, 0),
+		_frame("EvtButtonUpOrDown", 7, 1, 121, 3),
+		_frame("EvtButtonSingleOrDoubleClickOrHold", 8, 5, 1, 0xffffffff),
+		_frame("EvtNewVerifiedButton", bytes([0xff, 0xee, 0xdd, 0xcc, 0xbb, 0xaa])),
+		_frame("EvtConnectionStatusChanged", 9, 2, 0),
+		_frame("EvtPingResponse", 1)
+	]) + b"\x05\x00\x04" # incomplete packet
+
+class DecodeBatchTest(unittest.TestCase):
+	def test_array_columns(self):
+		columns, consumed = flicbatch.decode_batch(_stream(), use_numpy = False)
+		self.assertEqual(consumed, len(_stream()) - 3)
+		self.assertEqual(list(columns["conn_id"]), [7, 7, 8, 0, 9, 0])
+		self.assertEqual(list(columns["click_type"]), [0, 1, 5, 0, 0, 0])
+		self.assertEqual(list(columns["was_queued"]), [0, 1, 1, 0, 0, 0])
+		self.assertEqual(list(columns["time_diff"]), [0, 3, 0xffffffff, 0, 0, 0])
+		self.assertEqual(list(columns["bd_addr"]), [0, 0, 0, 0xaabbccddeeff, 0, 0])
+
+	@unittest.skipIf(flicbatch.numpy is None, "NumPy is not installed")
+	def test_numpy_matches_array(self):
+		for opcodes in (None, [flicprotocol._EVENT_NAME_TO_OPCODE["EvtButtonUpOrDown"]]):
+			numpy_columns, numpy_consumed = flicbatch.decode_batch(_stream(), opcodes, use_numpy = True)
+			array_columns, array_consumed = flicbatch.decode_batch(_stream(), opcodes, use_numpy = False)
+			self.assertEqual(numpy_consumed, array_consumed)
+			for name in flicbatch.COLUMNS:
+				self.assertEqual([int(x) for x in numpy_columns[name]], [int(x) for x in array_columns[name]], name)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeflicd
+import fliclib
+
+class RaisePolicyTest(unittest.TestCase):
+	def setUp(self):
+		self.client_sock, self.server_sock = socket.socketpair()
+		self.client = fliclib.FlicClient(None, sock = self.client_sock, send_high_watermark = 1024, send_policy = "raise")
+		self.loop = None
+
+	def tearDown(self):
+		self.client.close()
+		if self.loop is not None:
+			self.loop.call_soon_threadsafe(self.flicd.close)
+			self.loop.call_soon_threadsafe(self.loop.stop)
+		else:
+			self.server_sock.close()
+
+	def fill_send_queue(self):
+		# The server does not read yet, so the socket buffers fill up and the commands start being queued
+		for i in range(1000000):
+			try:
+				self.client.ping(lambda: None)
+			except BlockingIOError:
+				return
+		self.fail("The send queue never filled up")
+
+	def start_server(self):
+		self.loop = asyncio.new_event_loop()
+		self.flicd = fakeflicd.FakeFlicd(["00:00:00:00:00:01"])
+		threading.Thread(target=self.loop.run_forever, daemon=True).start()
+		asyncio.run_coroutine_threadsafe(self.flicd.serve_socket(self.server_sock), self.loop).result()
+		threading.Thread(target=self.client.handle_events, daemon=True).start()
+
+	def call_when_accepted(self, function):
+		# Retries a command until the drained send queue accepts it
+		for i in range(1000):
+			try:
+				return function()
+			except BlockingIOError:
+				threading.Event().wait(0.01)
+		self.fail("The send queue never drained")
+
+	def test_refused_get_info_leaves_no_callback_behind(self):
+		self.fill_send_queue()
+		refused = []
+		with self.assertRaises(BlockingIOError):
+			self.client.get_info(refused.append)
+
+		self.start_server()
+		received = threading.Event()
+		infos = []
+		def on_info(info):
+			infos.append(info)
+			received.set()
+		self.call_when_accepted(lambda: self.client.get_info(on_info))
+		self.assertTrue(received.wait(10))
+		self.assertEqual(infos[0]["bd_addr_of_verified_buttons"], ["00:00:00:00:00:01"])
+
+		received.clear()
+		self.call_when_accepted(lambda: self.client.get_info(on_info))
+		self.assertTrue(received.wait(10))
+		self.assertEqual(len(infos), 2)
+		self.assertEqual(refused, [])
+
+	def test_refused_commands_leave_no_state_behind(self):
+		self.fill_send_queue()
+		channel = fliclib.ButtonConnectionChannel("00:00:00:00:00:01")
+		with self.assertRaises(BlockingIOError):
+			self.client.add_connection_channel(channel)
+		self.assertNotIn(channel._conn_id, self.client._connection_channels)
+
+		scanner = fliclib.ButtonScanner()
+		with self.assertRaises(BlockingIOError):
+			self.client.add_scanner(scanner)
+		self.assertNotIn(scanner._scan_id, self.client._scanners)
+
+		nb_pings = len(self.client._ping_callbacks)
+		with self.assertRaises(BlockingIOError):
+			self.client.ping(lambda: None)
+		self.assertEqual(len(self.client._ping_callbacks), nb_pings)
+		with self.assertRaises(BlockingIOError):
+			self.client.get_button_info("00:00:00:00:00:01", lambda *args: None)
+		self.assertEqual(len(self.client._get_button_info_queue), 0)
+
+	def test_refused_commands_are_not_recorded(self):
+		self.fill_send_queue()
+		recorded = len(self.client.flight_recorder.frames())
+		with self.assertRaises(BlockingIOError):
+			self.client.get_info(lambda info: None)
+		self.assertEqual(len(self.client.flight_recorder.frames()), recorded)
+
+class DropCoalescePolicyTest(unittest.TestCase):
+	def test_pings_are_not_dropped(self):
+		client_sock, server_sock = socket.socketpair()
+		client = fliclib.FlicClient(None, sock = client_sock, send_high_watermark = 1024, send_policy = "drop-coalesce")
+		nb_pings = 50000
+		for i in range(nb_pings):
+			client.ping(lambda: None)
+		self.assertEqual(len(client._ping_callbacks), nb_pings)
+		self.assertGreater(client.queued_bytes, 1024)
+
+		loop = asyncio.new_event_loop()
+		flicd = fakeflicd.FakeFlicd()
+		threading.Thread(target=loop.run_forever, daemon=True).start()
+		asyncio.run_coroutine_threadsafe(flicd.serve_socket(server_sock), loop).result()
+		thread = threading.Thread(target=client.handle_events, daemon=True)
+		thread.start()
+		done = threading.Event()
+		client.ping(done.set)
+		self.assertTrue(done.wait(30))
+		self.assertEqual(len(client._ping_callbacks), 0)
+		client.close()
+		thread.join()
+		loop.call_soon_threadsafe(flicd.close)
+		loop.call_soon_threadsafe(loop.stop)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Loopback latency benchmark of the transport options.
+#
+# Runs fakeflicd on a background thread and measures, for each configuration, the round trip of a typical interaction:
+# a command without response (a latency mode change) immediately followed by get_info, until the get_info callback runs.
+# The second command is the one Nagle's algorithm can hold back, so the difference between nodelay and no nodelay shows up here.
+#
+# Usage:
+# python3 transport_benchmark.py --rounds 200
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+import fakeflicd
+import fliclib
+from flictransport import TransportOptions
+
+_BD_ADDR = "00:00:00:00:00:01"
+
+def start_flicd(unix_path):
+	"""Run a FakeFlicd on a new thread. Returns (flicd, loop, (host, port))."""
+	loop = asyncio.new_event_loop()
+	flicd = fakeflicd.FakeFlicd([_BD_ADDR])
+	address = loop.run_until_complete(flicd.start_tcp())
+	loop.run_until_complete(flicd.start_unix(unix_path))
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+	return flicd, loop, address
+
+def measure(client, rounds):
+	"""Returns the round trip times in microseconds."""
+	thread = threading.Thread(target=client.handle_events, daemon=True)
+	thread.start()
+	channel = fliclib.ButtonConnectionChannel(_BD_ADDR)
+	client.add_connection_channel(channel)
+	done = threading.Event()
+
+	times = []
+	for i in range(rounds + 10):
+		done.clear()
+		start = time.perf_counter()
+		channel.latency_mode = fliclib.LatencyMode.LowLatency if i % 2 == 0 else fliclib.LatencyMode.NormalLatency
+		client.get_info(lambda info: done.set())
+		done.wait()
+		if i >= 10:
+			times.append((time.perf_counter() - start) * 1e6)
+	client.close()
+	thread.join()
+	return times
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the command round trip over loopback with different transport options.")
+	parser.add_argument("--rounds", type=int, default=200)
+	args = parser.parse_args()
+
+	unix_path = os.path.join(tempfile.mkdtemp(), "flicd.sock")
+	flicd, loop, (host, port) = start_flicd(unix_path)
+
+	configurations = [
+		("tcp nodelay", lambda: fliclib.FlicClient(host, port, transport_options = TransportOptions())),
+		("tcp without nodelay", lambda: fliclib.FlicClient(host, port, transport_options = TransportOptions(nodelay = False))),
+		("tcp nodelay, 4 KiB buffers", lambda: fliclib.FlicClient(host, port, transport_options = TransportOptions(rcvbuf = 4096, sndbuf = 4096))),
+		("tcp nodelay, keepalive", lambda: fliclib.FlicClient(host, port, transport_options = TransportOptions(keepalive = True, keepalive_idle = 10, keepalive_interval = 5, keepalive_count = 3))),
+		("unix socket", lambda: fliclib.FlicClient("unix:" + unix_path)),
+		("socketpair", None)
+	]
+	for name, create_client in configurations:
+		if create_client is None:
+			sock, server_sock = socket.socketpair()
+			asyncio.run_coroutine_threadsafe(flicd.serve_socket(server_sock), loop).result()
+			client = fliclib.FlicClient(None, sock = sock)
+		else:
+			client = create_client()
+		times = sorted(measure(client, args.rounds))
+		print("%-28s median %8.1f us, p99 %8.1f us, max %8.1f us" % (name, statistics.median(times), times[int(len(times) * 0.99) - 1], times[-1]))
+
+	loop.call_soon_threadsafe(flicd.close)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# WebSocket bridge throughput benchmark.
+#
+# This program starts a fakeflicd stand-in and a flicwsbridge on loopback, connects many simulated browser clients
+# that each create connection channels to the same set of buttons, and then measures how fast button events
+# emitted by the stand-in reach all browsers through the bridge.
+
+import argparse
+import asyncio
+import os
+import struct
+import time
+
+import aioflic
+import fakeflicd
+import flicwsbridge
+
+_CREATE_CONNECTION_CHANNEL = aioflic.FlicClient._COMMAND_NAME_TO_OPCODE["CmdCreateConnectionChannel"]
+_BUTTON_UP_OR_DOWN = [x[0] for x in aioflic.FlicClient._EVENTS].index("EvtButtonUpOrDown")
+_CONNECTION_STATUS_CHANGED = [x[0] for x in aioflic.FlicClient._EVENTS].index("EvtConnectionStatusChanged")
+
+class SimulatedBrowser:
+	def __init__(self, bd_addrs):
+		self.bd_addrs = bd_addrs
+		self.ready = 0
+		self.events = 0
+		self.all_ready = asyncio.Event()
+
+	async def connect(self, host, port):
+		self.reader, self.writer = await asyncio.open_connection(host, port)
+		self.writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+		while len((await self.reader.readline()).strip()) > 0:
+			pass
+		for conn_id, bd_addr in enumerate(self.bd_addrs):
+			self.send(bytes([_CREATE_CONNECTION_CHANNEL]) + struct.pack("<I6sBh", conn_id, bytes(aioflic.FlicClient._bdaddr_string_to_bytes(bd_addr)), 0, 511))
+
+	def send(self, packet):
+		mask = os.urandom(4)
+		self.writer.write(bytes([0x82, 0x80 | len(packet)]) + mask + flicwsbridge.unmask(packet, mask))
+
+	async def run(self):
+		try:
+			while True:
+				header = await self.reader.readexactly(2)
+				length = header[1] & 0x7f
+				if length == 126:
+					length = struct.unpack(">H", await self.reader.readexactly(2))[0]
+				payload = await self.reader.readexactly(length)
+				if payload[0] == _BUTTON_UP_OR_DOWN:
+					self.events += 1
+				elif payload[0] == _CONNECTION_STATUS_CHANGED and payload[5] == aioflic.ConnectionStatus.Ready.value:
+					self.ready += 1
+					if self.ready == len(self.bd_addrs):
+						self.all_ready.set()
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+
+async def benchmark(nb_browsers, nb_buttons, nb_rounds, sessions_per_upstream):
+	bd_addrs = ["00:00:00:00:%02x:%02x" % (i >> 8, i & 0xff) for i in range(nb_buttons)]
+	flicd = fakeflicd.FakeFlicd(bd_addrs)
+	flicd_host, flicd_port = await flicd.start_tcp()
+	bridge = flicwsbridge.WebSocketBridge(flicd_host, flicd_port, sessions_per_upstream)
+	server = await bridge.serve("127.0.0.1", 0)
+	host, port = server.sockets[0].getsockname()[:2]
+
+	browsers = [SimulatedBrowser(bd_addrs) for i in range(nb_browsers)]
+	for browser in browsers:
+		await browser.connect(host, port)
+	tasks = [asyncio.ensure_future(browser.run()) for browser in browsers]
+	await asyncio.gather(*[browser.all_ready.wait() for browser in browsers])
+
+	expected = nb_browsers * nb_buttons * nb_rounds
+	start = time.perf_counter()
+	for i in range(nb_rounds):
+		for bd_addr in bd_addrs:
+			flicd.emit_button_event(bd_addr, aioflic.ClickType.ButtonDown if i % 2 == 0 else aioflic.ClickType.ButtonUp)
+		# Let the bridge and the browsers run between rounds, like a real burst of button events would
+		await asyncio.sleep(0)
+	while sum(browser.events for browser in browsers) < expected:
+		await asyncio.sleep(0.001)
+	elapsed = time.perf_counter() - start
+
+	print("browsers=%d upstreams=%d buttons=%d events delivered=%d in %.3f s: %.0f events/s" % (nb_browsers, bridge.upstream_count, nb_buttons, expected, elapsed, expected / elapsed))
+
+	for browser in browsers:
+		browser.writer.close()
+	await asyncio.gather(*tasks)
+	while bridge.session_count > 0:
+		await asyncio.sleep(0.001)
+	server.close()
+	await server.wait_closed()
+	flicd.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="WebSocket bridge throughput benchmark on loopback.")
+	parser.add_argument("--browsers", type=int, nargs="*", default=[1, 10, 100])
+	parser.add_argument("--buttons", type=int, default=10)
+	parser.add_argument("--rounds", type=int, default=200)
+	parser.add_argument("--sessions-per-upstream", type=int, default=256)
+	args = parser.parse_args()
+
+	for nb_browsers in args.browsers:
+		asyncio.run(benchmark(nb_browsers, args.buttons, args.rounds, args.sessions_per_upstream))
+
+if __name__ == "__main__":
+	main()